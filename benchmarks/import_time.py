@@ -0,0 +1,78 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import sys
+import subprocess
+import argparse
+
+## CLEAN CODE
+from typing import Dict, List, Tuple
+
+## libraries that simulation workers should not import, these are only needed by checkups and aftercare
+DEFERRED_LIBRARIES: List[str] = ["matplotlib", "weasyprint", "jinja2", "MDAnalysis", "mdtraj", "scipy", "sklearn"]
+## default budget for "import drMD", in seconds
+DEFAULT_BUDGET: float = 3.0
+#####################################################################################
+def main() -> None:
+    """
+    Measures how long it takes to import a drMD module with "python -X importtime"
+    Reports the slowest imports and any deferred libraries that were loaded,
+    and exits with a non-zero code if the import is over budget
+
+    Usage:
+        python benchmarks/import_time.py --module drMD --budget 3.0
+    """
+    parser = argparse.ArgumentParser(description="Import time budget for drMD")
+    parser.add_argument("--module", default="drMD", help="module to import, relative to src")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="import time budget in seconds")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to report")
+    args = parser.parse_args()
+
+    importTimes: List[Tuple[str, int, int]] = measure_import_times(args.module)
+    totalSeconds: float = sum([cumulative for _, cumulative, level in importTimes if level == 0]) / 1e6
+
+    print(f"import {args.module}: {totalSeconds:.3f} s (budget {args.budget:.3f} s)")
+    print(f"slowest top-level imports:")
+    topLevelImports = sorted([entry for entry in importTimes if entry[2] == 0], key=lambda entry: entry[1], reverse=True)
+    for moduleName, cumulative, _ in topLevelImports[:args.top]:
+        print(f"\t{cumulative / 1e6:8.3f} s\t{moduleName}")
+
+    loadedModules: set = set([moduleName.split(".")[0] for moduleName, _, _ in importTimes])
+    loadedDeferred: List[str] = [library for library in DEFERRED_LIBRARIES if library in loadedModules]
+    if len(loadedDeferred) > 0:
+        print(f"deferred libraries imported at start up: {', '.join(loadedDeferred)}")
+
+    if totalSeconds > args.budget or len(loadedDeferred) > 0:
+        sys.exit(1)
+#####################################################################################
+def measure_import_times(moduleName: str) -> List[Tuple[str, int, int]]:
+    """
+    Imports a module in a fresh interpreter with -X importtime and parses its report
+
+    Args:
+        moduleName (str): the module to import
+
+    Returns:
+        importTimes (List[Tuple[str, int, int]]): module name, cumulative time in microseconds and nesting level
+    """
+    srcDir: str = p.join(p.dirname(p.dirname(p.abspath(__file__))), "src")
+    env: Dict[str, str] = {**os.environ, "PYTHONPATH": srcDir}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {moduleName}"],
+                             cwd=srcDir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    importTimes: List[Tuple[str, int, int]] = []
+    for line in result.stderr.splitlines():
+        ## lines look like "import time:       123 |        456 |   package.module"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, importedName = line[len("import time:"):].split("|")
+        ## nested imports are indented by two spaces per level
+        level: int = (len(importedName) - len(importedName.lstrip()) - 1) // 2
+        importTimes.append((importedName.strip(), int(cumulative), level))
+    return importTimes
+#####################################################################################
+if __name__ == "__main__":
+    main()
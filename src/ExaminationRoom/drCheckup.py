@@ -9,22 +9,12 @@ from textwrap import fill
 import sys
 from shutil import move
 import warnings
-from scipy.stats import linregress
+import multiprocessing as mp
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future, wait
 
-## PLOTTING LIBRARIES
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use("Agg")
-from matplotlib.ticker import MaxNLocator
-
-## PDF LIBS
-from jinja2 import Environment, FileSystemLoader
-from weasyprint import HTML, CSS
-
-## MDTRAJ AND MDANALYSIS LIBRARIES
-import mdtraj as md
-import MDAnalysis as mda
-from MDAnalysis.analysis import rms
+## PLOTTING, PDF, SCIPY AND MDANALYSIS LIBRARIES ARE IMPORTED IN THE FUNCTIONS THAT USE THEM
+## this module is imported by every simulation process, but only checkup processes need them
 
 ## drMD LIBRARIES
 try:
@@ -40,7 +30,7 @@ except ModuleNotFoundError:
 
 
 ## CLEAN CODE
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
 from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
 
 ## PDB // DATAFRAME UTILS
@@ -51,6 +41,14 @@ import logging
 logging.getLogger('weasyprint').setLevel(logging.ERROR)
 warnings.filterwarnings('ignore')
 
+## backbone RMSD of each frame, written by check_vitals to 00_reporters_and_plots and used to score screening rounds
+RMSD_REPORT: str = "rmsd_report.csv"
+## background pool for vitals reports, created on first use in each simulation process
+CHECKUP_POOL: Optional[ProcessPoolExecutor] = None
+PENDING_CHECKUPS: List[Tuple[DirectoryPath, Future]] = []
+## branches of a protocol finish steps from several threads, see drOperator.run_simulation
+CHECKUP_LOCK: threading.Lock = threading.Lock()
+
 ######################################################################
 def check_vitals(simDir: DirectoryPath,
                   vitalsFiles: Dict[str, FilePath]) -> None:
@@ -83,6 +81,8 @@ def check_vitals(simDir: DirectoryPath,
     ## use mdtraj to calculate RMSD for non water and ions, get that data into a dataframe
     rmsdDf: pd.DataFrame = calculate_rmsd_mda(trajectoryDcd = vitalsFiles["trajectory"],
                                                 trajectoryPdb = vitalsFiles["pdb"])
+    ## moved to 00_reporters_and_plots by tidy_up, with the other reporters
+    rmsdDf.to_csv(p.join(simDir, RMSD_REPORT), index=False)
     
     ## join the dataframes 
     vitalsDf: pd.DataFrame = pd.concat([rmsdDf, vitalsDf],axis=1)
@@ -114,6 +114,18 @@ def check_vitals(simDir: DirectoryPath,
     ## tidy up reporters to avoid clutter
     tidy_up(simDir)
 ###############################################################################################
+def load_pyplot():
+    """
+    Imports matplotlib with the non-interactive Agg backend
+    matplotlib is only loaded once a plot is made, so simulation processes don't pay for it
+
+    Returns:
+        plt (module): matplotlib.pyplot
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 ###############################################################################################
 def create_vitals_pdf(simDir):
     """
@@ -123,6 +135,10 @@ def create_vitals_pdf(simDir):
     Args:   
         simDir (DirectoryPath): The directory of the simulation
     """
+    ## PDF LIBS
+    from jinja2 import Environment, FileSystemLoader
+    from weasyprint import HTML, CSS
+
     ## get the instruments directory path
     instrumentsDir: DirectoryPath = p.dirname(__file__)
     env: Environment = Environment(loader=FileSystemLoader(instrumentsDir))
@@ -180,6 +196,7 @@ def plot_system_info(systemName: str, stepName: str, outDir):
         stepName (str): The name of the step
         outDir (str): The output directory
     """
+    plt = load_pyplot()
 
     # Set up plot size and convert cm to inches
     widthInch: float = 25 / 2.54
@@ -371,6 +388,7 @@ def calculate_line_of_best_fit(x, y):
         intercept (float): The intercept of the line of best fit
         r_squared (float): The r squared value
     """
+    from scipy.stats import linregress
     ## calculate the line of best fit
     slope, intercept, r_value, p_value, std_err = linregress(x, y)
     ## calculate r squared
@@ -379,6 +397,9 @@ def calculate_line_of_best_fit(x, y):
 
 
 
+######################################################################
+def get_rmsd_report(simDir: DirectoryPath) -> FilePath:
+    return p.join(simDir, "00_reporters_and_plots", RMSD_REPORT)
 ######################################################################
 def tidy_up(simDir: DirectoryPath):
     """
@@ -387,6 +408,7 @@ def tidy_up(simDir: DirectoryPath):
     Args:
         simDir (DirectoryPath): The directory of the simulation
     """
+    plt = load_pyplot()
     ## make a new directory to tidy up reporters and png files
     tidyDir: DirectoryPath = p.join(simDir, "00_reporters_and_plots")
     os.makedirs(tidyDir, exist_ok=True)
@@ -400,6 +422,8 @@ def tidy_up(simDir: DirectoryPath):
 def check_up_handler():
     """
     Decorator for the check_up function
+    If hardwareInfo.checkupCpus is above zero, check_vitals is run in a background
+    process pool so that the next step of the protocol can start straight away
 
     Returns:
         decorator (function): The decorated function
@@ -408,14 +432,20 @@ def check_up_handler():
         @wraps(simulationFunction)
         def wrapper(*args, **kwargs):
             saveFile: FilePath = simulationFunction(*args, **kwargs)
+            checkupCpus: int = kwargs["config"]["hardwareInfo"].get("checkupCpus", 1)
             try:
+                ## partial outputs are merged here, before the next step can touch them
                 vitalsFiles, simDir = find_vitals_files(simInfo=kwargs["sim"],
                                                      outDir=kwargs["outDir"], 
                                                      pdbFile=kwargs["refPdb"],
                                                      config=kwargs["config"])
-
-                check_vitals(simDir = simDir,
-                            vitalsFiles = vitalsFiles)
+                if checkupCpus > 0:
+                    submit_check_vitals(simDir, vitalsFiles, checkupCpus)
+                else:
+                    ## pyplot is not thread safe, so steps finished by different branches are checked one at a time
+                    with CHECKUP_LOCK:
+                        check_vitals(simDir = simDir,
+                                    vitalsFiles = vitalsFiles)
             except FileNotFoundError as e:
                 drLogger.log_info(f"Error running checkup: File not found: {e}", True, True)
                 raise e
@@ -426,6 +456,81 @@ def check_up_handler():
         return wrapper
     return decorator
 ######################################################################
+def submit_check_vitals(simDir: DirectoryPath,
+                         vitalsFiles: Dict[str, FilePath],
+                           checkupCpus: int) -> None:
+    """
+    Submits check_vitals to the background checkup pool
+    Failed reports are logged when they finish, they do not fail the simulation
+
+    Args:
+        simDir (DirectoryPath): The directory of the simulation
+        vitalsFiles (Dict[str, FilePath]): A dictionary of the vitals files
+        checkupCpus (int): number of processes in the checkup pool
+    """
+    global CHECKUP_POOL
+    with CHECKUP_LOCK:
+        if CHECKUP_POOL is None:
+            ## spawn rather than fork, simulation processes hold OpenMM threads
+            CHECKUP_POOL = ProcessPoolExecutor(max_workers=checkupCpus,
+                                                mp_context=mp.get_context("spawn"))
+            drLogger.add_stall_cleanup(terminate_checkups)
+        checkupFuture: Future = CHECKUP_POOL.submit(check_vitals, simDir, vitalsFiles)
+        PENDING_CHECKUPS.append((simDir, checkupFuture))
+    checkupFuture.add_done_callback(lambda future: log_checkup_failure(simDir, future))
+######################################################################
+def log_checkup_failure(simDir: DirectoryPath, checkupFuture: Future) -> None:
+    """
+    Logs the error from a failed background checkup
+    """
+    if checkupFuture.cancelled() or checkupFuture.exception() is None:
+        return
+    stepName: str = p.basename(simDir)
+    systemName: str = p.basename(p.dirname(simDir))
+    drLogger.log_info(f"Error running checkup for {systemName} {stepName}: {checkupFuture.exception()}", True, True)
+######################################################################
+def wait_for_checkups() -> None:
+    """
+    Waits for every outstanding background checkup to finish, then shuts down the checkup pool
+    This must be called before a simulation process finishes its work
+    """
+    global CHECKUP_POOL
+    if CHECKUP_POOL is None:
+        return
+    if len(PENDING_CHECKUPS) > 0:
+        drLogger.log_info(f"Waiting for {len(PENDING_CHECKUPS)} vitals reports to finish...", True)
+    ## failures have already been logged by log_checkup_failure
+    wait([checkupFuture for _, checkupFuture in PENDING_CHECKUPS])
+    PENDING_CHECKUPS.clear()
+    CHECKUP_POOL.shutdown(wait=True)
+    CHECKUP_POOL = None
+######################################################################
+def wait_for_checkup(simDir: DirectoryPath) -> None:
+    """
+    Waits for the background checkup of one step, so that its reports and plots are complete
+    Failures have already been logged by log_checkup_failure
+    """
+    with CHECKUP_LOCK:
+        checkupFutures: List[Future] = [checkupFuture for checkupDir, checkupFuture in PENDING_CHECKUPS if checkupDir == simDir]
+    wait(checkupFutures)
+######################################################################
+def terminate_checkups() -> None:
+    """
+    Kills the checkup pool without waiting for its reports, when a stalled simulation process exits
+    CHECKUP_LOCK is not taken, as the stalled thread may be holding it
+    """
+    global CHECKUP_POOL
+    if CHECKUP_POOL is None:
+        return
+    ## ProcessPoolExecutor has no public way to kill its workers before python 3.14
+    checkupProcesses: List[mp.Process] = list((CHECKUP_POOL._processes or {}).values())
+    for checkupProcess in checkupProcesses:
+        checkupProcess.terminate()
+    for checkupProcess in checkupProcesses:
+        checkupProcess.join(timeout=5)
+    PENDING_CHECKUPS.clear()
+    CHECKUP_POOL = None
+######################################################################
 def find_vitals_files(simInfo: Dict,
                        outDir: DirectoryPath,
                        pdbFile: FilePath,
@@ -533,6 +638,7 @@ def plot_time_data(timeDf: pd.DataFrame, outDir: str):
         timeDf (pd.DataFrame): The time dataframe
         outDir (str): The output directory
     """
+    plt = load_pyplot()
 
     # Set up plot size and convert cm to inches
     widthInch: float = 7.75 / 2.54
@@ -593,6 +699,8 @@ def calculate_rmsd_mda(trajectoryDcd: FilePath, trajectoryPdb: FilePath) -> pd.D
     Returns:
         rmsdDf (pd.DataFrame): The RMSD dataframe
     """
+    import MDAnalysis as mda
+    from MDAnalysis.analysis import rms
 
 
     universe: mda.Universe = mda.Universe(trajectoryPdb, trajectoryDcd)
@@ -624,6 +732,8 @@ def plot_traces(vitalsDf: pd.DataFrame, plottingData: dict, convergedDiagnosis:
         savePng (FilePath): The path to the saved plot
     
     """
+    plt = load_pyplot()
+    from matplotlib.ticker import MaxNLocator
     ## init some colors to be used
     darkGrey: str = '#1a1a1a'
     white :str = '#FFFFFF'
@@ -5,7 +5,7 @@ from shutil import copy, rmtree
 
 ## drMD LIBRARIES
 from ExaminationRoom import drLogger, drClusterizer
-from UtilitiesCloset import drSelector, drListInitiator
+from UtilitiesCloset import drSelector, drListInitiator, drGovernor
 
 ## PDB // DATAFRAME UTILS
 from pdbUtils import pdbUtils
@@ -29,6 +29,8 @@ def clean_up_handler(batchConfig: dict) -> None:
     if not "aftercareInfo" in batchConfig:
         return
 
+    ## run adaptive sampling if instructed to in config file, before clustering so that new trajectories are clustered too
+    adaptive_sampling_handler(batchConfig)
     ## run clustering if instructed to in config file
     cluster_handler(batchConfig)
     ## collect endpoint PDB files if instructed to in config file
@@ -83,6 +85,26 @@ def collate_vitals_reports(batchConfig: Dict) -> None:
                 copy(vitalsPdf, vitalsPdfDestination)
 
  
+######################################################################################################
+def adaptive_sampling_handler(batchConfig: Dict) -> None:
+    """
+    Function to run rounds of adaptive sampling, seeded from the least populated clusters of each system's trajectories.
+    Will only run if told to in the config file
+
+    Args:
+        batchConfig (dict): The batch configuration dictionary.
+
+    Returns:
+        None
+    """
+    ## skip no adaptiveSamplingInfo key in aftercareInfo exists
+    if not "adaptiveSamplingInfo" in batchConfig["aftercareInfo"]:
+        return
+    ## let user know what's going on
+    drLogger.log_info(f"Running adaptive sampling...", True)
+    ## imported here, as the simulation stack is not needed for the rest of aftercare
+    from Surgery import drAdaptiveSampler
+    drAdaptiveSampler.adaptive_sampling_protocol(batchConfig)
 ######################################################################################################
 def cluster_handler(batchConfig: Dict) -> None:
     """
@@ -106,6 +128,8 @@ s
     drLogger.log_info(f"Performing clustering on MD trajectories...", True )
     ## get clusterInfo dict
     clusterInfo: Dict = aftercareInfo["clusterInfo"]
+    ## clustering reserves memory with the governor, as other workers may still be simulating
+    drGovernor.set_up_governor(pathInfo["outputDir"], batchConfig["hardwareInfo"])
     ## run clustering
     allClusterPdbs: List[FilePath] = drClusterizer.clustering_manager(pathInfo, clusterInfo)
     if not allClusterPdbs:
@@ -275,7 +299,9 @@ def get_endpoint_pdbs(endPointInfo: Dict, pathInfo: Dict) -> List[FilePath]:
     ## create a list of all run directories
     runDirs: List[DirectoryPath] = [p.join(outDir, dir) for dir in os.listdir(outDir) if not dir in notRunDirs]
     ## create a list of step directories that we want to look for endpoint pdb files in 
-    stepDirs: List[DirectoryPath] = [p.join(runDir,stepDir) for runDir in runDirs for stepDir in endPointInfo["stepNames"] if p.isdir(p.join(runDir,stepDir))]
+    ## steps with replicas have one directory per replica
+    stepDirs: List[DirectoryPath] = [stepDir for runDir in runDirs for stepName in endPointInfo["stepNames"]
+                                      for stepDir in drClusterizer.get_step_dirs(runDir, stepName)]
     ## create a list of endpoint pdb files
     endpointPdbs: List[FilePath] = [p.join(stepDir,stepPdb) for stepDir in stepDirs 
                                     for stepPdb in os.listdir(stepDir)
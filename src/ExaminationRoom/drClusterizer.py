@@ -1,20 +1,19 @@
 import mdtraj as md
 ## BASIC PYTHON LIBRARIES
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
 import numpy as np
 import os
 from os import path as p
+import re
 
 ## drMD LIBRARIES
 from ExaminationRoom import drLogger
-from UtilitiesCloset import drSelector, drListInitiator
+from UtilitiesCloset import drSelector, drListInitiator, drGovernor, drMemoryModel
 
 ## PDB // DATAFRAME UTILS
 from pdbUtils import pdbUtils
 
 ## CLEAN CODE
-from typing import Dict, Union, Any, List
+from typing import Dict, Union, Any, List, Tuple
 from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
 #######################################################################
 def clustering_manager(pathInfo: Dict, clusterInfo: Dict) -> List[FilePath]: 
@@ -42,7 +41,8 @@ def clustering_manager(pathInfo: Dict, clusterInfo: Dict) -> List[FilePath]:
     notRunDirs = drListInitiator.get_not_a_run_dir()
     ## create list of dirs to cluster
     runDirs: List[DirectoryPath] = [p.join(outDir, dir) for dir in os.listdir(outDir) if not dir in notRunDirs]
-    dirsToCluster: List[DirectoryPath] = [p.join(runDir,stepDir) for stepDir in clusterInfo["stepNames"] for runDir in runDirs]
+    dirsToCluster: List[DirectoryPath] = [stepDir for stepName in clusterInfo["stepNames"] for runDir in runDirs
+                                           for stepDir in get_step_dirs(runDir, stepName)]
 
     ## init a list of to store pdb files that have been created by clustering
     allClusterPdbs: list[FilePath] = []
@@ -56,6 +56,26 @@ def clustering_manager(pathInfo: Dict, clusterInfo: Dict) -> List[FilePath]:
     return allClusterPdbs
 
 #######################################################################
+def get_step_dirs(runDir: DirectoryPath, stepName: str) -> List[DirectoryPath]:
+    """
+    Returns the directories of a step in a run directory
+    A step with replicas has one directory per replica (<stepName>_rep<N>) rather than one of its own
+
+    Args:
+        runDir (DirectoryPath): the run directory of a system
+        stepName (str): a stepName from simulationInfo
+
+    Returns:
+        stepDirs (List[DirectoryPath]): the step directory, or the directory of each replica
+    """
+    if p.isdir(p.join(runDir, stepName)):
+        return [p.join(runDir, stepName)]
+    if not p.isdir(runDir):
+        return []
+    replicaDirs: List[DirectoryPath] = [p.join(runDir, dirName) for dirName in os.listdir(runDir)
+                                         if re.fullmatch(rf"{re.escape(stepName)}_rep\d+", dirName)]
+    return sorted(replicaDirs, key=lambda replicaDir: int(replicaDir.rsplit("_rep", 1)[1]))
+#######################################################################
 def rmsd_clustering_protocol(inDir: DirectoryPath, clusterInfo: Dict[str, Union[int, str]], clusterDir: DirectoryPath) -> List[FilePath]:
     """
     Clusters a trajectory based on the RMSD values of a subset of atoms.
@@ -99,19 +119,45 @@ def rmsd_clustering_protocol(inDir: DirectoryPath, clusterInfo: Dict[str, Union[
         clusterSelection = clusterBySelection["selection"]
         clusterSelectionAtomIndexes.extend(drSelector.get_atom_indexes(clusterSelection, pdbFile))
 
-    # Load trajectory
-    traj: md.Trajectory = md.load(dcdFile, top=pdbFile)
-    # Optionally, superimpose all frames to the first to remove translational and rotational motions
-    traj.superpose(traj[0])
-
-    # Convert trajectory to RMSD matrix
-    rmsdMatrix: np.ndarray = convert_traj_to_rmsdMatrix(traj,clusterSelectionAtomIndexes)
-
-    # Perform clustering and save the clusters to PDB files
-    clusterPdbs: List[FilePath] = kmeans_clusters_to_pdb(rmsdMatrix, nClusters, thisClusterDir, traj, protName)
+    ## reserve memory for the trajectory and the RMSD matrix before loading anything
+    batchOutDir: DirectoryPath = p.dirname(clusterDir)
+    clusteringSize: float = estimate_clustering_size(dcdFile, pdbFile)
+    clusteringMemory: float = drMemoryModel.predict_peak_memory(batchOutDir, "clustering", clusteringSize)
+    with drGovernor.hold_resources(f"clustering for {protName} {stepName}", cpus=1, pool="clustering", memoryMB=clusteringMemory), \
+          drMemoryModel.measure_peak_memory(batchOutDir, "clustering", f"{protName}/{stepName}", clusteringSize):
+        # Load trajectory
+        traj: md.Trajectory = md.load(dcdFile, top=pdbFile)
+        # Optionally, superimpose all frames to the first to remove translational and rotational motions
+        traj.superpose(traj[0])
+
+        # Convert trajectory to RMSD matrix
+        rmsdMatrix: np.ndarray = convert_traj_to_rmsdMatrix(traj,clusterSelectionAtomIndexes)
+
+        # Perform clustering and save the clusters to PDB files
+        clusterPdbs: List[FilePath] = kmeans_clusters_to_pdb(rmsdMatrix, nClusters, thisClusterDir, traj, protName)
     
     return clusterPdbs
 #######################################################################
+def estimate_clustering_size(dcdFile: FilePath, pdbFile: FilePath) -> float:
+    """
+    Estimates the MB of data held in memory while clustering a trajectory
+    This is the trajectory coordinates, plus the N x N RMSD matrix and the
+    N x N distance matrices made by KMeans and silhouette scoring
+
+    Args:
+        dcdFile (FilePath): the trajectory to be clustered
+        pdbFile (FilePath): the matching PDB file
+
+    Returns:
+        clusteringSize (float): the estimated size in MB
+    """
+    with md.open(dcdFile) as dcd:
+        nFrames: int = len(dcd)
+    with open(pdbFile, "r") as f:
+        nAtoms: int = len([line for line in f if line.startswith(("ATOM", "HETATM"))])
+    ## float32 coordinates and float64 matrices
+    return (nFrames * nAtoms * 3 * 4 + 3 * nFrames ** 2 * 8) / 1e6
+#######################################################################
 def convert_traj_to_rmsdMatrix(traj: md.Trajectory, atomIndexes: List[int]) -> np.ndarray:
     """
     Converts a trajectory to an RMSD matrix.
@@ -153,6 +199,7 @@ def kmeans_clusters_to_pdb(rmsdMatrix: np.ndarray,
     Returns:
         clusterPdbs (List[FilePath]): The list of cluster PDB files.
     """
+    from sklearn.cluster import KMeans
     ## If the user has specified bestK to be -1
     ## We will use silhouette scores to find the best number of clusters
     ## NOTE that this takes a while and produces less clusters than you may want!
@@ -183,6 +230,32 @@ def kmeans_clusters_to_pdb(rmsdMatrix: np.ndarray,
     return clusterPdbs
 
 #######################################################################
+def cluster_frames(rmsdMatrix: np.ndarray, nClusters: int, randomSeed: int = 0) -> Tuple[np.ndarray, List[int]]:
+    """
+    Clusters the frames of a trajectory with KMeans and finds the frame closest to the centre of each cluster
+    A fixed random seed is used, so the same frames always give the same clusters
+
+    Args:
+        rmsdMatrix (np.ndarray): The RMSD matrix.
+        nClusters (int): The number of clusters, capped at the number of frames.
+        randomSeed (int): Random seed for KMeans.
+
+    Returns:
+        clusterLabels (np.ndarray): the cluster of each frame
+        representativeFrames (List[int]): the index of the frame closest to the centre of each cluster
+    """
+    from sklearn.cluster import KMeans
+    nClusters = min(nClusters, rmsdMatrix.shape[0])
+    kmeansModel = KMeans(n_clusters=nClusters, random_state=randomSeed)
+    clusterLabels: np.ndarray = kmeansModel.fit_predict(rmsdMatrix)
+    representativeFrames: List[int] = []
+    for clusterIndex in range(nClusters):
+        ## unlike kmeans_clusters_to_pdb, the representative frame is always a member of its cluster
+        clusterFrameIndexes: np.ndarray = np.where(clusterLabels == clusterIndex)[0]
+        distances: np.ndarray = np.linalg.norm(rmsdMatrix[clusterFrameIndexes] - kmeansModel.cluster_centers_[clusterIndex], axis=1)
+        representativeFrames.append(int(clusterFrameIndexes[np.argmin(distances)]))
+    return clusterLabels, representativeFrames
+#######################################################################
 
 def find_best_k_with_silhouette(rmsdMatrix: np.ndarray) -> int:
     """
@@ -194,6 +267,8 @@ def find_best_k_with_silhouette(rmsdMatrix: np.ndarray) -> int:
     Returns:
         bestK (int): The best number of clusters.
     """
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
 
 
     # Perform silhouette score analysis to find the best number of clusters
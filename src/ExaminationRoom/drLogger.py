@@ -6,12 +6,27 @@ import pandas as pd
 from functools import wraps
 import threading
 import shutil
+import os
 from os import path as p
 
 ## CLEAN CODE
-from typing import List, Dict, Union, Any, Tuple
+from typing import List, Dict, Union, Any, Tuple, Callable
 from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
 
+## drMD LIBRARIES
+from UtilitiesCloset import drLedger
+
+## exit code of a system process whose simulation has stalled, the supervisor restarts it from its last checkpoint
+STALLED_EXIT_CODE: int = 76
+## only system processes started by the supervisor exit when they stall, see enable_stall_exit
+EXIT_ON_STALL: bool = False
+## seconds between reports that are expected before a step has written two reports
+FIRST_REPORT_INTERVAL: float = 60.0
+## a simulation is never treated as stalled before this many seconds without a report,
+## so that writing output files and checkups at the end of a step are not mistaken for a stall
+MIN_STALL_TIME: float = 300.0
+## run before a stalled process exits, eg. to stop the background checkup pool, see add_stall_cleanup
+STALL_CLEANUPS: List[Callable[[], None]] = []
 #################################################################################################
 class OverwriteStreamHandler(logging.StreamHandler):
     """
@@ -108,10 +123,52 @@ def read_simulation_progress(progressReporterCsv: FilePath) -> Tuple[str, str]:
         return "N/A", "N/A", "N/A"
     
 #################################################################################################
+def enable_stall_exit() -> None:
+    """
+    Makes this process exit with STALLED_EXIT_CODE when a simulation stalls
+    Only called in system processes, where the supervisor restarts the system from its last checkpoint
+    """
+    global EXIT_ON_STALL
+    EXIT_ON_STALL = True
+#################################################################################################
+def is_stalled(timeSinceReport: float, reportIntervals: List[float], stallTolerance: float) -> bool:
+    """
+    Checks whether a simulation has gone stallTolerance times longer than expected without writing a report
+    The expected time between reports is the mean of the intervals seen so far in this step
+    """
+    expectedInterval: float = sum(reportIntervals) / len(reportIntervals) if len(reportIntervals) > 0 else FIRST_REPORT_INTERVAL
+    return timeSinceReport > max(stallTolerance * expectedInterval, MIN_STALL_TIME)
+#################################################################################################
+def add_stall_cleanup(cleanup: Callable[[], None]) -> None:
+    """
+    Registers a function to run before a stalled system process exits
+    os._exit skips atexit handlers and finalizers, so anything that would outlive the process must be stopped here
+    """
+    if cleanup not in STALL_CLEANUPS:
+        STALL_CLEANUPS.append(cleanup)
+#################################################################################################
+def handle_stall(stepName: str, protName: str, timeSinceReport: float, config: Dict) -> None:
+    """
+    Reports a stalled simulation, then exits if this is a system process started by the supervisor
+    os._exit is used because the main thread may be stuck inside OpenMM, where it can't be interrupted
+    The restart is counted as a retry of the step in the ledger, against the same budget as firstAid
+    """
+    log_info(f"STALL: {stepName} for {protName} has not written a report for {timeSinceReport:.0f} s", True, True)
+    if EXIT_ON_STALL:
+        log_info(f"Restarting {protName} from its last checkpoint", True, True)
+        try:
+            drLedger.count_step_retry(drLedger.get_ledger_file_for_run(config), protName, stepName)
+            for cleanup in STALL_CLEANUPS:
+                cleanup()
+        finally:
+            logging.shutdown()
+            os._exit(STALLED_EXIT_CODE)
+#################################################################################################
 def monitor_progress_decorator(checkInterval: int = 3):
     """
     Decorator used to monitor the progress of a simulation.
     Prints key simulation monitoring information to the terminal.
+    If miscInfo.stallTolerance is above zero, a simulation that stops writing reports is treated as stalled
     
     Args:
         checkInterval (int): The number of seconds between each check of the progress
@@ -138,6 +195,11 @@ def monitor_progress_decorator(checkInterval: int = 3):
                 simDir: str = p.join(outDir, stepName)
                 progressReporterCsv: str = p.join(simDir, "progress_report.csv")
                 cachedProgress: str = "N/A"
+                stallTolerance: float = kwargs["config"]["miscInfo"].get("stallTolerance", 0)
+                ## a new report grows the progress csv, the time between reports is used to spot stalls
+                lastReportSize: int = -1
+                lastReportTime: float = time.time()
+                reportIntervals: List[float] = []
                 while not monitoring.is_set():
                     progressPercent, timeRemaining, averageSpeed = read_simulation_progress(progressReporterCsv)
                     if progressPercent != cachedProgress:
@@ -146,6 +208,16 @@ def monitor_progress_decorator(checkInterval: int = 3):
                                  f"Time Remaining: {coral}{timeRemaining}{reset} | "
                                  f"Average Speed: {gold}{averageSpeed} ns/day {reset}", True)
                     cachedProgress = progressPercent
+                    if stallTolerance > 0:
+                        reportSize: int = p.getsize(progressReporterCsv) if p.isfile(progressReporterCsv) else 0
+                        if reportSize != lastReportSize:
+                            if lastReportSize > 0:
+                                reportIntervals.append(time.time() - lastReportTime)
+                            lastReportSize, lastReportTime = reportSize, time.time()
+                        elif is_stalled(time.time() - lastReportTime, reportIntervals, stallTolerance):
+                            handle_stall(stepName, protName, time.time() - lastReportTime, kwargs["config"])
+                            ## when not exiting, the stall is reported again after another full wait
+                            lastReportTime = time.time()
                     time.sleep(checkInterval)
 
             monitorThread = threading.Thread(target=monitor_progress)
@@ -0,0 +1,147 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import copy
+import csv
+import math
+import pandas as pd
+
+## drMD LIBRARIES
+from ExaminationRoom import drLogger, drCheckup, drClusterizer
+from UtilitiesCloset import drLedger
+
+## CLEAN CODE
+from typing import Dict, List, Optional, Tuple
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## columns of 00_drMD_logs/screening_scores.csv
+SCORE_COLUMNS: List[str] = ["stepName", "pdbName", "stepHash", "score"]
+#####################################################################################
+def get_screening_rounds(batchConfig: Dict) -> List[Tuple[Dict, Optional[str]]]:
+    """
+    Splits a screening batch into rounds, one for each step in screeningInfo.stepNames and a final round
+    Each round's config runs simulationInfo up to and including the step that ends the round,
+    the final round runs the whole protocol. Steps finished in an earlier round are skipped,
+    so each round carries on from where the last one stopped
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary, with screeningInfo
+
+    Returns:
+        screeningRounds (List[Tuple[Dict, Optional[str]]]): the config of each round, and the step
+                                                             it is scored on (None for the final round)
+    """
+    stepNames: List[str] = [sim["stepName"] for sim in batchConfig["simulationInfo"]]
+    screeningRounds: List[Tuple[Dict, Optional[str]]] = []
+    for roundStepName in batchConfig["screeningInfo"]["stepNames"] + [None]:
+        ## screeningInfo is left out, so that the final round has the same config hash as an unscreened batch
+        roundConfig: Dict = copy.deepcopy({key: value for key, value in batchConfig.items() if key != "screeningInfo"})
+        if roundStepName is not None:
+            roundConfig["simulationInfo"] = roundConfig["simulationInfo"][:stepNames.index(roundStepName) + 1]
+        screeningRounds.append((roundConfig, roundStepName))
+    return screeningRounds
+#####################################################################################
+def select_survivors(batchConfig: Dict, pdbFiles: List[FilePath], stepName: str) -> List[FilePath]:
+    """
+    Scores each system on a screening step and keeps the top keepFraction of them
+    Systems are ranked by the mean backbone RMSD of the last half of the step, lowest first
+    Systems that did not finish the step are dropped
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary, with screeningInfo
+        pdbFiles (List[FilePath]): systems that were run in this round
+        stepName (str): the step that ended this round
+
+    Returns:
+        survivors (List[FilePath]): systems that go on to the next round
+    """
+    outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
+    keepFraction: float = batchConfig["screeningInfo"]["keepFraction"]
+    cachedScores: Dict[Tuple[str, str], Tuple[str, float]] = read_scores(outDir)
+
+    scores: Dict[FilePath, float] = {}
+    for pdbFile in pdbFiles:
+        pdbName: str = p.splitext(p.basename(pdbFile))[0]
+        stepDirs: List[DirectoryPath] = drClusterizer.get_step_dirs(p.join(outDir, pdbName), stepName)
+        ## a step has finished once its XML file has been written
+        if len(stepDirs) == 0 or not all([p.isfile(p.join(stepDir, f"{p.basename(stepDir)}.xml")) for stepDir in stepDirs]):
+            drLogger.log_info(f"{pdbName} did not finish {stepName}, it will not be screened", True)
+            continue
+        ## scores are reused on resubmission, unless the step has been run again since
+        stepHash: str = "|".join([drLedger.read_step_hash(stepDir) or "" for stepDir in stepDirs])
+        cachedScore: Optional[Tuple[str, float]] = cachedScores.get((stepName, pdbName), None)
+        if cachedScore is not None and cachedScore[0] == stepHash:
+            scores[pdbFile] = cachedScore[1]
+            continue
+        score: Optional[float] = score_system(stepDirs)
+        if score is None:
+            drLogger.log_info(f"Could not score {pdbName} on {stepName}, it will not be screened", True)
+            continue
+        record_score(outDir, stepName, pdbName, stepHash, score)
+        scores[pdbFile] = score
+
+    nKeep: int = min(len(scores), max(1, math.ceil(len(scores) * keepFraction)))
+    survivors: List[FilePath] = sorted(scores, key=lambda pdbFile: scores[pdbFile])[:nKeep]
+    drLogger.log_info(f"Screened {len(scores)} systems on {stepName}, {nKeep} go on to the next round", True, True)
+    return survivors
+#####################################################################################
+def score_system(stepDirs: List[DirectoryPath]) -> Optional[float]:
+    """
+    Returns the mean backbone RMSD (Angstrom) over the last half of a step, averaged over its replicas
+    The RMSD of each frame is read from the report written by the vitals checkup, trajectories are not read again
+    Returns None if no step has an RMSD report
+
+    Args:
+        stepDirs (List[DirectoryPath]): the step directory, or the directory of each replica
+
+    Returns:
+        score (Optional[float]): lower scores are more stable
+    """
+    replicaScores: List[float] = []
+    for stepDir in stepDirs:
+        rmsdReport: FilePath = drCheckup.get_rmsd_report(stepDir)
+        if not p.isfile(rmsdReport):
+            drLogger.log_info(f"{stepDir} has no RMSD report from its vitals checkup", True)
+            continue
+        try:
+            rmsdDf: pd.DataFrame = pd.read_csv(rmsdReport)
+        except (pd.errors.EmptyDataError, pd.errors.ParserError) as e:
+            drLogger.log_info(f"Error reading RMSD report for {stepDir}: {e}", True)
+            continue
+        lastHalf = rmsdDf["Backbone RMSD (Angstrom)"].iloc[len(rmsdDf) // 2:]
+        if len(lastHalf) > 0:
+            replicaScores.append(float(lastHalf.mean()))
+    if len(replicaScores) == 0:
+        return None
+    return sum(replicaScores) / len(replicaScores)
+#####################################################################################
+def get_scores_file(batchOutDir: DirectoryPath) -> FilePath:
+    return p.join(batchOutDir, "00_drMD_logs", "screening_scores.csv")
+#####################################################################################
+def read_scores(batchOutDir: DirectoryPath) -> Dict[Tuple[str, str], Tuple[str, float]]:
+    """
+    Reads scores from earlier runs of this batch, the last score of each system and step is kept
+    """
+    scoresFile: FilePath = get_scores_file(batchOutDir)
+    if not p.isfile(scoresFile):
+        return {}
+    scores: Dict[Tuple[str, str], Tuple[str, float]] = {}
+    with open(scoresFile, "r") as f:
+        for row in csv.reader(f):
+            if len(row) != len(SCORE_COLUMNS):
+                continue
+            try:
+                scores[(row[0], row[1])] = (row[2], float(row[3]))
+            except ValueError:
+                continue
+    return scores
+#####################################################################################
+def record_score(batchOutDir: DirectoryPath, stepName: str, pdbName: str, stepHash: str, score: float) -> None:
+    """
+    Appends a score to 00_drMD_logs/screening_scores.csv
+    """
+    scoresFile: FilePath = get_scores_file(batchOutDir)
+    os.makedirs(p.dirname(scoresFile), exist_ok=True)
+    with open(scoresFile, "a", newline="") as f:
+        csv.writer(f).writerow([stepName, pdbName, stepHash, f"{score:.3f}"])
+#####################################################################################
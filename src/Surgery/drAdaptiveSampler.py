@@ -0,0 +1,219 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import copy
+import csv
+import hashlib
+import numpy as np
+import mdtraj as md
+from concurrent.futures import ThreadPoolExecutor
+
+## OPENMM LIBRARIES
+import openmm.app as app
+import openmm as openmm
+import openmm.unit as unit
+
+## drMD LIBRARIES
+from Surgery import drSim, drOperator, drPrep
+from Triage import drConfigTriage
+from ExaminationRoom import drLogger, drClusterizer, drCheckup
+from UtilitiesCloset import drSelector, drGovernor, drListInitiator, drWallClock, drMemoryModel
+
+## CLEAN CODE
+from typing import Dict, List, Tuple
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## columns of <runDir>/adaptive_sampling_report.csv
+REPORT_COLUMNS: List[str] = ["round", "nFrames", "cluster", "clusterFrames", "seeded"]
+#####################################################################################
+def adaptive_sampling_protocol(batchConfig: Dict) -> None:
+    """
+    Runs rounds of adaptive sampling for every system in a batch
+    Each round clusters every trajectory of a system so far, then starts short simulations
+    from the least populated clusters, so that sampling is spent on rarely visited conformations
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary, with aftercareInfo.adaptiveSamplingInfo
+    """
+    outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
+    adaptiveSamplingInfo: Dict = batchConfig["aftercareInfo"]["adaptiveSamplingInfo"]
+    ## simulations hold governor resources, as other workers may still be simulating
+    drGovernor.set_up_governor(outDir, batchConfig["hardwareInfo"])
+
+    notRunDirs = drListInitiator.get_not_a_run_dir()
+    runDirs: List[DirectoryPath] = sorted([p.join(outDir, dir) for dir in os.listdir(outDir)
+                                            if not dir in notRunDirs and p.isdir(p.join(outDir, dir))])
+    for runDir in runDirs:
+        protName: str = p.basename(runDir)
+        configYaml: FilePath = p.join(outDir, "00_configs", f"{protName}_config.yaml")
+        if not p.isfile(configYaml):
+            continue
+        try:
+            run_adaptive_sampling(runDir, drConfigTriage.read_config(configYaml), adaptiveSamplingInfo)
+        except drWallClock.WallTimeExceeded as e:
+            raise e
+        except Exception as e:
+            drLogger.log_info(f"Adaptive sampling failed for {protName}: {e}", True, True)
+    drCheckup.wait_for_checkups()
+#####################################################################################
+def run_adaptive_sampling(runDir: DirectoryPath, runConfig: Dict, adaptiveSamplingInfo: Dict) -> None:
+    """
+    Runs rounds of adaptive sampling for one system
+    New simulations reuse the prepared system and the settings (including restraints) of the first step in stepNames
+    Clustering uses a fixed random seed, so a resubmitted batch picks the same frames and skips finished simulations
+
+    Args:
+        runDir (DirectoryPath): run directory of the system
+        runConfig (dict): per-system config dictionary
+        adaptiveSamplingInfo (dict): adaptiveSamplingInfo from aftercareInfo
+    """
+    protName: str = runConfig["proteinInfo"]["proteinName"]
+    stepNames: List[str] = adaptiveSamplingInfo["stepNames"]
+    sourceSims: List[Dict] = [sim for sim in runConfig["simulationInfo"] if sim["stepName"] == stepNames[0]]
+    ## screened out systems have not been given the later steps
+    if len(sourceSims) == 0:
+        drLogger.log_info(f"{protName} has no {stepNames[0]} step, skipping adaptive sampling", True)
+        return
+    trajectoryDirs: List[DirectoryPath] = [stepDir for stepName in stepNames for stepDir in drClusterizer.get_step_dirs(runDir, stepName)
+                                            if is_finished(stepDir)]
+    if len(trajectoryDirs) == 0:
+        drLogger.log_info(f"{protName} has no finished trajectories to seed adaptive sampling from, skipping", True)
+        return
+
+    _, prepFiles = drPrep.choose_to_skip_prep(runConfig, p.join(runDir, "00_prep"), protName)
+    solvatedPdb, inputCoords, amberParams = prepFiles
+    prmtop: app.AmberPrmtopFile = app.AmberPrmtopFile(amberParams)
+    inpcrd: app.AmberInpcrdFile = app.AmberInpcrdFile(inputCoords)
+    platform: openmm.Platform = drOperator.choose_platform(runConfig)
+    seedTemplate: Dict = make_seed_template(sourceSims[0], adaptiveSamplingInfo["duration"])
+
+    clusterSelectionAtomIndexes: List[int] = []
+    for clusterBySelection in adaptiveSamplingInfo["clusterBy"]:
+        clusterSelectionAtomIndexes.extend(drSelector.get_atom_indexes(clusterBySelection["selection"], p.join(trajectoryDirs[0], "trajectory.pdb")))
+
+    reportRows: List[List] = []
+    for roundIndex in range(1, adaptiveSamplingInfo["nRounds"] + 1):
+        ## every trajectory so far, including those started by earlier rounds
+        traj: md.Trajectory = md.join([md.load(p.join(trajectoryDir, "trajectory.dcd"), top=p.join(trajectoryDir, "trajectory.pdb"))
+                                        for trajectoryDir in trajectoryDirs])
+        if traj.n_atoms != prmtop.topology.getNumAtoms():
+            drLogger.log_info(f"Trajectories of {protName} don't contain every atom, adaptive sampling needs trajectorySelections to be all atoms", True, True)
+            return
+        rmsdMatrix: np.ndarray = drClusterizer.convert_traj_to_rmsdMatrix(traj, clusterSelectionAtomIndexes)
+        clusterLabels, representativeFrames = drClusterizer.cluster_frames(rmsdMatrix, adaptiveSamplingInfo["nClusters"], roundIndex)
+
+        ## the least populated clusters are seeded, more than once each if there are fewer clusters than seeds
+        clusterSizes: List[int] = [int(np.sum(clusterLabels == clusterIndex)) for clusterIndex in range(len(representativeFrames))]
+        rarestClusters: List[int] = sorted(range(len(clusterSizes)), key=lambda clusterIndex: clusterSizes[clusterIndex])
+        seededClusters: List[int] = [rarestClusters[seedIndex % len(rarestClusters)] for seedIndex in range(adaptiveSamplingInfo["nSeeds"])]
+        drLogger.log_info(f"Adaptive sampling round {roundIndex} for {protName}: {traj.n_frames} frames in {len(clusterSizes)} clusters "
+                          f"(occupancy {clusterSizes}), seeding from clusters {[clusterIndex + 1 for clusterIndex in seededClusters]}", True)
+        for clusterIndex, clusterSize in enumerate(clusterSizes):
+            reportRows.append([roundIndex, traj.n_frames, clusterIndex + 1, clusterSize, seededClusters.count(clusterIndex)])
+        write_report(runDir, reportRows)
+
+        seedRuns: List[Tuple[Dict, FilePath]] = []
+        for seedIndex, clusterIndex in enumerate(seededClusters, start=1):
+            seedSim: Dict = copy.deepcopy(seedTemplate)
+            seedSim["stepName"] = f"adaptive_round{roundIndex}_seed{seedIndex}"
+            seedDir: DirectoryPath = p.join(runDir, seedSim["stepName"])
+            trajectoryDirs.append(seedDir)
+            if is_finished(seedDir):
+                continue
+            os.makedirs(seedDir, exist_ok=True)
+            seedXml: FilePath = p.join(seedDir, "adaptive_seed.xml")
+            velocitySeed: int = int(hashlib.sha256(f"{protName}/{seedSim['stepName']}".encode()).hexdigest(), 16) % (2 ** 31 - 1) + 1
+            write_seed_state(prmtop, traj[representativeFrames[clusterIndex]], seedSim["temperature"], velocitySeed, seedXml)
+            seedRuns.append((seedSim, seedXml))
+
+        ## seeds of a round are independent, so they run at the same time like branches of a protocol
+        with ThreadPoolExecutor(max_workers=runConfig["hardwareInfo"].get("parallelBranches", 1)) as seedPool:
+            seedFutures = [seedPool.submit(run_seed, seedSim, seedXml, runDir, runConfig, prmtop, inpcrd, solvatedPdb, platform)
+                           for seedSim, seedXml in seedRuns]
+            for seedFuture in seedFutures:
+                seedFuture.result()
+#####################################################################################
+def make_seed_template(sourceSim: Dict, duration: str) -> Dict:
+    """
+    Makes the settings for new simulations from the step they are seeded from
+    Stepped temperatures are replaced by the last temperature of the step
+    """
+    seedTemplate: Dict = {key: value for key, value in copy.deepcopy(sourceSim).items()
+                          if key not in ["replicas", "startFrom", "temperatureRange"]}
+    if "temperatureRange" in sourceSim:
+        seedTemplate["temperature"] = sourceSim["temperatureRange"][-1]
+    seedTemplate["duration"] = duration
+    return seedTemplate
+#####################################################################################
+def write_seed_state(prmtop: app.AmberPrmtopFile,
+                      frame: md.Trajectory,
+                        temperature: int,
+                          velocitySeed: int,
+                            seedXml: FilePath) -> None:
+    """
+    Writes an OpenMM state XML file for a trajectory frame, with velocities drawn at the simulation temperature
+    Positions are only stored to single precision in the trajectory, so constraints are applied again
+
+    Args:
+        prmtop (app.AmberPrmtopFile): the prepared system
+        frame (md.Trajectory): a single frame containing every atom of the system
+        temperature (int): temperature in Kelvin
+        velocitySeed (int): random seed for the velocities
+        seedXml (FilePath): the state file to write
+    """
+    if frame.unitcell_vectors is None:
+        raise ValueError("trajectory frames have no periodic box, so simulations can't be started from them")
+    system: openmm.System = prmtop.createSystem(nonbondedMethod=app.PME,
+                                                nonbondedCutoff=1 * unit.nanometer,
+                                                constraints=app.HBonds)
+    integrator: openmm.Integrator = openmm.VerletIntegrator(1 * unit.femtosecond)
+    context: openmm.Context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName("Reference"))
+    context.setPeriodicBoxVectors(*[openmm.Vec3(*boxVector) * unit.nanometer for boxVector in frame.unitcell_vectors[0]])
+    context.setPositions(frame.xyz[0] * unit.nanometer)
+    context.applyConstraints(1e-5)
+    context.setVelocitiesToTemperature(temperature * unit.kelvin, velocitySeed)
+    state: openmm.State = context.getState(getPositions=True, getVelocities=True)
+    with open(seedXml, "w") as f:
+        f.write(openmm.XmlSerializer.serialize(state))
+#####################################################################################
+def run_seed(seedSim: Dict,
+              seedXml: FilePath,
+                runDir: DirectoryPath,
+                  runConfig: Dict,
+                    prmtop: app.AmberPrmtopFile,
+                      inpcrd: app.AmberInpcrdFile,
+                        solvatedPdb: FilePath,
+                          platform: openmm.Platform) -> None:
+    """
+    Runs one adaptive sampling simulation from its seed state
+    Like protocol steps, it holds governor resources while it runs
+    """
+    protName: str = runConfig["proteinInfo"]["proteinName"]
+    ## seeds share the CPU threads of this process in the same way as branches, see drSim.get_branch_threads
+    simulationCpus: int = drSim.get_simulation_cpus(runConfig["hardwareInfo"])
+    simulationMemory: float = drMemoryModel.predict_peak_memory(p.dirname(runDir), "simulation", prmtop.topology.getNumAtoms())
+    with drGovernor.hold_resources(f"{seedSim['stepName']} for {protName}", cpus=simulationCpus, pool="simulation", memoryMB=simulationMemory):
+        drSim.run_molecular_dynamics(prmtop=prmtop,
+                                      inpcrd=inpcrd,
+                                      sim=seedSim,
+                                      saveFile=seedXml,
+                                      outDir=runDir,
+                                      platform=platform,
+                                      refPdb=solvatedPdb,
+                                      config=runConfig)
+#####################################################################################
+def is_finished(stepDir: DirectoryPath) -> bool:
+    """
+    A step can be sampled from once its XML file and its trajectory have been written
+    """
+    return all([p.isfile(p.join(stepDir, fileName)) for fileName in [f"{p.basename(stepDir)}.xml", "trajectory.dcd", "trajectory.pdb"]])
+#####################################################################################
+def write_report(runDir: DirectoryPath, reportRows: List[List]) -> None:
+    """
+    Writes the frame count and cluster occupancy of each round to <runDir>/adaptive_sampling_report.csv
+    """
+    with open(p.join(runDir, "adaptive_sampling_report.csv"), "w", newline="") as f:
+        reportWriter = csv.writer(f)
+        reportWriter.writerow(REPORT_COLUMNS)
+        reportWriter.writerows(reportRows)
+#####################################################################################
@@ -11,7 +11,7 @@ import  openmm.unit  as unit
 
 ## drMD LIBRARIES
 from Surgery import drSim
-from UtilitiesCloset import drSplash, drSplicer
+from UtilitiesCloset import drSplash, drSplicer, drWallClock, drLedger
 from ExaminationRoom import drLogger
 
 ## CLEAN CODE
@@ -106,13 +106,18 @@ def firstAid_handler():
     def decorator(simulationFunction):
         @wraps(simulationFunction)
         def wrapper(*args, **kwargs):
-            retries: int = 0
             maxRetries: int = kwargs["config"]["miscInfo"].get("firstAidMaxRetries", 10)
+            ## retries are counted in the ledger, so that restarts after a stall use up the same budget
+            ledgerFile: Union[str, PathLike] = drLedger.get_ledger_file_for_run(kwargs["config"])
+            protName: str = kwargs["config"]["proteinInfo"]["proteinName"]
+            stepName: str = kwargs["sim"]["stepName"]
+            retries: int = drLedger.get_step_retries(ledgerFile, protName, stepName)
+            firstAidRun: bool = False
             lastError = None
-            while retries < maxRetries:
+            while retries <= maxRetries:
                 try:
                     saveFile: Union[str, PathLike] = simulationFunction(*args, **kwargs)
-                    if retries > 0:
+                    if firstAidRun:
                         drLogger.log_info(f"Success after {retries} tries.", True)
                         runOutDir: Union[str, PathLike] = kwargs["outDir"]
                         simDir: Union[str, PathLike] = p.join(runOutDir, kwargs["sim"]["stepName"])
@@ -123,11 +128,17 @@ def firstAid_handler():
                     return saveFile
                 except (OpenMMException, ValueError) as errorOpenMM:
                     lastError = errorOpenMM
-                    saveFile, retries = run_first_aid_protocol(retries, maxRetries, *args, **kwargs)
+                    retries = drLedger.count_step_retry(ledgerFile, protName, stepName)
+                    if retries > maxRetries:
+                        break
+                    saveFile, _ = run_first_aid_protocol(retries - 1, maxRetries, *args, **kwargs)
+                    firstAidRun = True
+                ## a step stopped to stay inside wallTimeBudget is resumed later, it doesn't need firstAid
+                except drWallClock.WallTimeExceeded as error:
+                    raise error
                 except Exception as error:
                     drLogger.log_info(f"Unexpected Error for {kwargs['sim']['stepName']}:\n{error}", True, True)
                     raise error
-                retries += 1
             
             # If max retries are reached, raise the last caught OpenMMException or ValueError
             drLogger.log_info(f"Max retries reached. Stopping.", True, True)
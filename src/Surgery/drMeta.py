@@ -116,10 +116,16 @@ def run_metadynamics(prmtop: app.Topology,
 
     # Set up integrator
     integrator: openmm.LangevinMiddleIntegrator = openmm.LangevinMiddleIntegrator(sim["temperature"], 1/unit.picosecond, sim["timestep"])
+    if "replicaSeed" in sim:
+        integrator.setRandomNumberSeed(sim["replicaSeed"])
     # Create new simulation
-    simulation: app.Simulation = app.simulation.Simulation(prmtop.topology, system, integrator, platform)
+    simulation: app.Simulation = drSim.create_simulation(prmtop.topology, system, integrator, config["hardwareInfo"], platform)
     # Load state from previous simulation (or continue from checkpoint)
     simulation: app.Simulation = drSim.load_simulation_state(simulation, saveFile)
+    drSim.set_up_replica(simulation, sim, saveFile, simDir)
+    ## a resumed step only runs the steps that were not finished before it stopped
+    if simulation.currentStep > 0:
+        sim = {**sim, "nSteps": max(0, sim["nSteps"] - simulation.currentStep)}
     # Set up reporters
     totalSteps: int = simulation.currentStep + sim["nSteps"]
     reportInterval: int = sim["logInterval"]
@@ -130,7 +136,9 @@ def run_metadynamics(prmtop: app.Topology,
                                 dcdAtomSelections= config["miscInfo"]["trajectorySelections"],
                                 refPdb=refPdb)
     # Run metadynamics simulation
-    meta.step(simulation, sim["nSteps"])
+    ## in chunks, so that the step is checkpointed and paused for wallTimeBudget and stop signals like MD steps
+    ## biases are saved to simDir by the Metadynamics object, which loads them again when the step is resumed
+    simulation, integrator = drSim.run_steps(simulation, integrator, sim["nSteps"], sim, config, simDir, stepFunction=meta.step)
  
     # find name to call outFiles
     protName: str = p.basename(p.dirname(simDir))
@@ -0,0 +1,305 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import copy
+import yaml
+import pandas as pd
+import numpy as np
+
+## drMD LIBRARIES
+from Surgery import drPrep
+from Triage import drConfigTriage
+from ExaminationRoom import drLogger
+from UtilitiesCloset import drLedger, drListInitiator
+
+## PDB // DATAFRAME UTILS
+from pdbUtils import pdbUtils
+
+## CLEAN CODE
+from typing import Dict, List, Optional, Tuple
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## mutant PDB files are written here, in the outputDir of the batch
+MUTANT_DIR: str = "00_mutants"
+## atoms of a mutated residue that are kept, tleap builds the rest of the new side chain
+KEPT_ATOM_NAMES: set = {"N", "CA", "C", "O", "OXT", "H", "H1", "H2", "H3"}
+## waters with an oxygen this close (Angstrom) to the CB (or CA) of a mutated residue are removed to make room for the new side chain
+WATER_CLEARANCE: float = 6.0
+## the backbones of residues with a CA further than this (Angstrom) from every mutated residue are restrained while the mutant relaxes
+LOCAL_RELAX_RADIUS: float = 8.0
+## force constant of the relaxation restraints, in kJ/mol A^-2
+RELAX_RESTRAINT_K: int = 1000
+## steps run before a mutant joins the protocol after fromStep
+MINIMISATION_STEP: str = "01_mutant_minimisation"
+RELAXATION_STEP: str = "02_mutant_relaxation"
+#####################################################################################
+def get_wild_type_config(batchConfig: Dict) -> Dict:
+    """
+    Returns the config of the first round of a mutant scan,
+    which runs simulationInfo up to and including mutantInfo.fromStep
+    """
+    stepNames: List[str] = [sim["stepName"] for sim in batchConfig["simulationInfo"]]
+    wildTypeConfig: Dict = copy.deepcopy({key: value for key, value in batchConfig.items() if key != "mutantInfo"})
+    wildTypeConfig["simulationInfo"] = wildTypeConfig["simulationInfo"][:stepNames.index(batchConfig["mutantInfo"]["fromStep"]) + 1]
+    return wildTypeConfig
+#####################################################################################
+def get_wild_type_pdb(batchConfig: Dict) -> FilePath:
+    return p.join(batchConfig["pathInfo"]["inputDir"], f"{batchConfig['mutantInfo']['wildType']}.pdb")
+#####################################################################################
+def build_mutants(batchConfig: Dict) -> List[FilePath]:
+    """
+    Builds each mutant in mutantInfo from the wild type at the end of fromStep, keeping its solvent and box
+    Writes a PDB file for each mutant to 00_mutants, and a per-protein config that
+    re-parameterises it, relaxes it around the mutation and then runs the steps after fromStep
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary, with mutantInfo
+
+    Returns:
+        mutantPdbs (List[FilePath]): PDB files of the mutants that were built
+    """
+    outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
+    mutantInfo: Dict = batchConfig["mutantInfo"]
+    wildType: str = mutantInfo["wildType"]
+    fromStep: str = mutantInfo["fromStep"]
+    wildTypeRunDir: DirectoryPath = p.join(outDir, wildType)
+    wildTypeConfigYaml: FilePath = p.join(outDir, "00_configs", f"{wildType}_config.yaml")
+    wildTypeEndpointPdb: FilePath = p.join(wildTypeRunDir, fromStep, f"{wildType}.pdb")
+    ## a step has finished once its XML file has been written
+    if not all([p.isfile(file) for file in [wildTypeConfigYaml, wildTypeEndpointPdb, p.join(wildTypeRunDir, fromStep, f"{fromStep}.xml")]]):
+        drLogger.log_info(f"{wildType} did not finish {fromStep}, no mutants can be built", True, True)
+        return []
+    wildTypeConfig: Dict = drConfigTriage.read_config(wildTypeConfigYaml)
+    _, prepFiles = drPrep.choose_to_skip_prep(wildTypeConfig, p.join(wildTypeRunDir, "00_prep"), wildType)
+    if prepFiles is None:
+        drLogger.log_info(f"Could not find the prepared files of {wildType}, no mutants can be built", True, True)
+        return []
+    wildTypeSolvatedPdb, _, wildTypeAmberParams = prepFiles
+
+    ## identifiers come from the prepared system (which has the input chains and residue numbers), coordinates from the end of fromStep
+    try:
+        wildTypeDf: pd.DataFrame = load_wild_type_system(wildTypeSolvatedPdb, wildTypeEndpointPdb)
+        box: List[float] = read_box(wildTypeEndpointPdb)
+    except ValueError as e:
+        drLogger.log_info(f"Could not read {wildType} at the end of {fromStep}, no mutants can be built: {e}", True, True)
+        return []
+
+    mutantDir: DirectoryPath = p.join(outDir, MUTANT_DIR)
+    os.makedirs(mutantDir, exist_ok=True)
+    mutantPdbs: List[FilePath] = []
+    for mutant in mutantInfo["mutations"]:
+        mutations: List[Tuple[str, int, str]] = parse_mutant(str(mutant))
+        mutantName: str = get_mutant_name(wildType, mutations)
+        mutantPdb: FilePath = p.join(mutantDir, f"{mutantName}.pdb")
+        try:
+            ## a mutant built by an earlier run of this batch is kept, as it may already have been prepared
+            if not p.isfile(mutantPdb):
+                pdbUtils.df2pdb(mutate_system(wildTypeDf, mutations), mutantPdb)
+            write_mutant_config(batchConfig, wildTypeConfig, mutantName, mutantPdb, mutations, wildTypeDf, box,
+                                p.join(p.dirname(wildTypeAmberParams), "TLEAP.in"))
+        except ValueError as e:
+            drLogger.log_info(f"Could not build mutant {mutantName}: {e}", True, True)
+            continue
+        mutantPdbs.append(mutantPdb)
+    drLogger.log_info(f"Built {len(mutantPdbs)} mutants of {wildType} from the end of {fromStep}", True, True)
+    return mutantPdbs
+#####################################################################################
+def parse_mutant(mutant: str) -> List[Tuple[str, int, str]]:
+    """
+    Reads a mutant written as CHAIN:RES_ID:RES_NAME, with + between mutations (eg. A:45:ALA+A:67:LYS)
+    """
+    mutations: List[Tuple[str, int, str]] = []
+    for mutation in mutant.split("+"):
+        chainId, resId, resName = mutation.split(":")
+        mutations.append((chainId, int(resId), resName))
+    return mutations
+#####################################################################################
+def get_mutant_name(wildType: str, mutations: List[Tuple[str, int, str]]) -> str:
+    return "_".join([wildType] + [f"{chainId}{resId}{resName}" for chainId, resId, resName in mutations])
+#####################################################################################
+def load_wild_type_system(solvatedPdb: FilePath, endpointPdb: FilePath) -> pd.DataFrame:
+    """
+    Puts the coordinates of an endpoint PDB file onto the prepared PDB file of the same system
+    Both are written in the atom order of the prmtop file, so they line up row by row
+    """
+    wildTypeDf: pd.DataFrame = pdbUtils.pdb2df(solvatedPdb)
+    endpointDf: pd.DataFrame = pdbUtils.pdb2df(endpointPdb)
+    if len(wildTypeDf) != len(endpointDf) or not (wildTypeDf["ATOM_NAME"].values == endpointDf["ATOM_NAME"].values).all():
+        raise ValueError(f"the atoms of {endpointPdb} don't match the prepared system {solvatedPdb}")
+    wildTypeDf[["X", "Y", "Z"]] = endpointDf[["X", "Y", "Z"]].values
+    return wildTypeDf
+#####################################################################################
+def read_box(pdbFile: FilePath) -> List[float]:
+    """
+    Reads the box lengths (Angstrom) and angles (degrees) from the CRYST1 record of a PDB file
+    """
+    with open(pdbFile, "r") as f:
+        for line in f:
+            if line.startswith("CRYST1"):
+                return [float(line[6:15]), float(line[15:24]), float(line[24:33]),
+                        float(line[33:40]), float(line[40:47]), float(line[47:54])]
+    raise ValueError(f"{pdbFile} has no CRYST1 record, so its box is not known")
+#####################################################################################
+def mutate_system(wildTypeDf: pd.DataFrame, mutations: List[Tuple[str, int, str]]) -> pd.DataFrame:
+    """
+    Replaces residues in a solvated system
+    Each mutated residue keeps its backbone (and CB, unless either residue is a glycine) and is renamed,
+    tleap rebuilds the rest of the side chain and its hydrogens from the residue template.
+    Waters that would clash with the new side chain are removed
+
+    Args:
+        wildTypeDf (pd.DataFrame): the wild type system, including solvent
+        mutations (List[Tuple[str, int, str]]): chain, residue number and new residue name of each mutation
+
+    Returns:
+        mutantDf (pd.DataFrame): the mutant system
+    """
+    mutantDf: pd.DataFrame = wildTypeDf.copy()
+    clearanceCentres: List[np.ndarray] = []
+    for chainId, resId, resName in mutations:
+        residueMask: pd.Series = (mutantDf["CHAIN_ID"] == chainId) & (mutantDf["RES_ID"] == resId) & (mutantDf["RES_NAME"].isin(drListInitiator.get_amino_acid_residue_names()))
+        if not residueMask.any():
+            raise ValueError(f"there is no amino acid residue {resId} in chain {chainId}")
+        oldResName: str = mutantDf.loc[residueMask, "RES_NAME"].iloc[0]
+        ## HIS is protonated on the epsilon nitrogen, as in prep
+        newResName: str = "HIE" if resName == "HIS" else resName
+        keptAtomNames: set = set(KEPT_ATOM_NAMES)
+        if newResName != "GLY" and oldResName != "GLY":
+            keptAtomNames.add("CB")
+        ## proline has no backbone amide hydrogen
+        if newResName == "PRO":
+            keptAtomNames.discard("H")
+        centreAtomName: str = "CB" if "CB" in keptAtomNames else "CA"
+        centreMask: pd.Series = residueMask & (mutantDf["ATOM_NAME"] == centreAtomName)
+        clearanceCentres.append(mutantDf.loc[centreMask, ["X", "Y", "Z"]].values[0])
+        mutantDf = mutantDf[~residueMask | mutantDf["ATOM_NAME"].isin(keptAtomNames)].copy()
+        mutantDf.loc[residueMask.reindex(mutantDf.index), "RES_NAME"] = newResName
+
+    ## waters are removed as whole molecules, each starts at its oxygen (residue numbers repeat in large systems)
+    waterMask: pd.Series = mutantDf["RES_NAME"].isin(drListInitiator.get_solvent_residue_names())
+    waterOxygenMask: pd.Series = waterMask & (mutantDf["ATOM_NAME"] == "O")
+    waterIds: pd.Series = waterOxygenMask.cumsum()
+    oxygenCoords: np.ndarray = mutantDf.loc[waterOxygenMask, ["X", "Y", "Z"]].values
+    clashingWaterIds: set = set()
+    for clearanceCentre in clearanceCentres:
+        distances: np.ndarray = np.linalg.norm(oxygenCoords - clearanceCentre, axis=1)
+        clashingWaterIds.update(waterIds[waterOxygenMask].values[distances < WATER_CLEARANCE])
+    mutantDf = mutantDf[~(waterMask & waterIds.isin(clashingWaterIds))].copy()
+    mutantDf["ATOM_ID"] = range(1, len(mutantDf) + 1)
+    return mutantDf
+#####################################################################################
+def make_relax_restraints(wildTypeDf: pd.DataFrame, mutations: List[Tuple[str, int, str]]) -> List[Dict]:
+    """
+    Makes a position restraint on the backbone of every residue that is more than LOCAL_RELAX_RADIUS from a mutation,
+    so that only the region around the mutations moves while the mutant is minimised and relaxed
+    """
+    proteinDf: pd.DataFrame = wildTypeDf[wildTypeDf["RES_NAME"].isin(drListInitiator.get_amino_acid_residue_names())]
+    alphaCarbonDf: pd.DataFrame = proteinDf[proteinDf["ATOM_NAME"] == "CA"]
+    mutatedCoords: np.ndarray = np.array([alphaCarbonDf[(alphaCarbonDf["CHAIN_ID"] == chainId) & (alphaCarbonDf["RES_ID"] == resId)][["X", "Y", "Z"]].values[0]
+                                           for chainId, resId, _ in mutations])
+    distances: np.ndarray = np.linalg.norm(alphaCarbonDf[["X", "Y", "Z"]].values[:, None, :] - mutatedCoords[None, :, :], axis=2).min(axis=1)
+    restrainedDf: pd.DataFrame = alphaCarbonDf[distances > LOCAL_RELAX_RADIUS]
+    customSelection: List[Dict] = []
+    for chainId, chainDf in restrainedDf.groupby("CHAIN_ID"):
+        customSelection.append({"CHAIN_ID": str(chainId),
+                                "RES_NAME": "_",
+                                "RES_ID": [int(resId) for resId in chainDf["RES_ID"].unique()],
+                                "ATOM_NAME": sorted(drListInitiator.get_backbone_atom_names())})
+    if len(customSelection) == 0:
+        return []
+    return [{"restraintType": "position",
+             "selection": {"keyword": "custom", "customSelection": customSelection},
+             "parameters": {"k": RELAX_RESTRAINT_K}}]
+#####################################################################################
+def make_mutant_protocol(simulationInfo: List[Dict], fromStep: str, relaxDuration: str, relaxRestraints: List[Dict]) -> List[Dict]:
+    """
+    Makes the simulationInfo of a mutant: a restrained minimisation and relaxation,
+    then every step that starts from fromStep (directly or through other steps) in the batch config
+
+    Args:
+        simulationInfo (List[Dict]): simulationInfo of the batch config
+        fromStep (str): the wild type step that mutants are built from
+        relaxDuration (str): duration of the relaxation
+        relaxRestraints (List[Dict]): restraintInfo for the minimisation and relaxation
+
+    Returns:
+        mutantSimulationInfo (List[Dict]): simulationInfo of the mutant
+    """
+    stepNames: List[str] = [sim["stepName"] for sim in simulationInfo]
+    fromSim: Dict = simulationInfo[stepNames.index(fromStep)]
+    temperature: int = fromSim["temperatureRange"][-1] if fromSim.get("temperatureRange", None) else fromSim["temperature"]
+
+    ## the first minimisation of the batch is used as a template, so that its settings are kept
+    emSims: List[Dict] = [sim for sim in simulationInfo if str(sim["simulationType"]).upper() == "EM"]
+    minimisationSim: Dict = copy.deepcopy(emSims[0]) if len(emSims) > 0 else {"simulationType": "EM", "maxIterations": -1}
+    minimisationSim = {key: value for key, value in minimisationSim.items() if key not in ["startFrom", "replicas", "restraintInfo"]}
+    minimisationSim.update({"stepName": MINIMISATION_STEP, "temperature": temperature})
+    relaxationSim: Dict = {key: value for key, value in copy.deepcopy(fromSim).items()
+                           if key not in ["startFrom", "replicas", "temperatureRange", "restraintInfo"]}
+    relaxationSim.update({"stepName": RELAXATION_STEP, "temperature": temperature, "duration": relaxDuration})
+    if len(relaxRestraints) > 0:
+        minimisationSim["restraintInfo"] = copy.deepcopy(relaxRestraints)
+        relaxationSim["restraintInfo"] = copy.deepcopy(relaxRestraints)
+    mutantSimulationInfo: List[Dict] = [minimisationSim, relaxationSim]
+
+    ## steps after fromStep join on to the relaxation, each is given an explicit startFrom as steps in between may be left out
+    descendantNames: set = {fromStep}
+    previousStepName: Optional[str] = None
+    for sim in simulationInfo:
+        parentName: Optional[str] = sim.get("startFrom", previousStepName)
+        previousStepName = sim["stepName"]
+        if parentName not in descendantNames:
+            continue
+        descendantNames.add(sim["stepName"])
+        mutantSim: Dict = copy.deepcopy(sim)
+        mutantSim["startFrom"] = RELAXATION_STEP if parentName == fromStep else parentName
+        mutantSimulationInfo.append(mutantSim)
+    return mutantSimulationInfo
+#####################################################################################
+def write_mutant_config(batchConfig: Dict,
+                         wildTypeConfig: Dict,
+                           mutantName: str,
+                             mutantPdb: FilePath,
+                               mutations: List[Tuple[str, int, str]],
+                                 wildTypeDf: pd.DataFrame,
+                                   box: List[float],
+                                     wildTypeTleapInput: FilePath) -> FilePath:
+    """
+    Writes the per-protein config of a mutant and records it in the ledger
+    proteinInfo and ligandInfo are those of the wild type, mutantInfo tells prep to re-parameterise
+    the mutant in the wild type box rather than protonating and solvating it again
+    """
+    outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
+    runDir: DirectoryPath = p.join(outDir, mutantName)
+    os.makedirs(runDir, exist_ok=True)
+    proteinInfo: Dict = copy.deepcopy(wildTypeConfig["proteinInfo"])
+    proteinInfo["proteinName"] = mutantName
+    runConfig: Dict = {
+        "pathInfo": {"inputDir": p.dirname(mutantPdb),
+                     "inputPdb": mutantPdb,
+                     "outputDir": runDir,
+                     "outputName": mutantName},
+        "hardwareInfo": batchConfig["hardwareInfo"],
+        "proteinInfo": proteinInfo,
+        "simulationInfo": make_mutant_protocol(batchConfig["simulationInfo"],
+                                               batchConfig["mutantInfo"]["fromStep"],
+                                               batchConfig["mutantInfo"]["relaxDuration"],
+                                               make_relax_restraints(wildTypeDf, mutations)),
+        "miscInfo": batchConfig["miscInfo"],
+        "mutantInfo": {"wildType": batchConfig["mutantInfo"]["wildType"],
+                       "mutations": [f"{chainId}:{resId}:{resName}" for chainId, resId, resName in mutations],
+                       "box": box,
+                       "wildTypeTleapInput": wildTypeTleapInput}
+    }
+    if "ligandInfo" in wildTypeConfig:
+        runConfig["ligandInfo"] = copy.deepcopy(wildTypeConfig["ligandInfo"])
+
+    configYaml: FilePath = p.join(outDir, "00_configs", f"{mutantName}_config.yaml")
+    with open(configYaml, "w") as f:
+        yaml.dump(runConfig, f, default_flow_style=False)
+    drLedger.update_system(drLedger.get_ledger_file(outDir), mutantName,
+                            pdbFile = mutantPdb,
+                              configYaml = configYaml,
+                                configHash = drLedger.hash_batch_config(batchConfig))
+    return configYaml
+#####################################################################################
@@ -2,21 +2,24 @@
 import os
 from os import path as p
 from shutil import rmtree
+import threading
 
 ## OPENMM LIBRARIES
 import openmm.app as app
 import openmm as openmm
 
 ## drMD LIBRARIES
-from Surgery import drPrep, drSim, drMeta, drFirstAid
-from Triage import drConfigTriage
-from ExaminationRoom import drLogger
+from Surgery import drPrep, drSim, drFirstAid
+from Triage import drConfigTriage, drBatchPlanner
+from ExaminationRoom import drLogger, drCheckup
+from UtilitiesCloset import drLedger, drGovernor, drMemoryModel, drWallClock, drMemoStore
 
 ## PDB // DATAFRAME UTILS
 from pdbUtils import pdbUtils
 
 ##  CLEAN CODE
-from typing import Dict, Callable
+from typing import Dict, Callable, Tuple, Optional, List
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
 #####################################################################################
 def drMD_protocol(configYaml: FilePath) -> None:
@@ -31,14 +34,57 @@ def drMD_protocol(configYaml: FilePath) -> None:
 
     This function reads the configuration file, prepares the protocol, and runs the simulation.
     """
+    # Prepare the protocol
+    preparedFiles: Tuple[FilePath, FilePath, FilePath] = run_prep_stage(configYaml)
+    # Run the simulation
+    run_simulation_stage(configYaml, preparedFiles)
+#####################################################################################
+def run_prep_stage(configYaml: FilePath) -> Tuple[FilePath, FilePath, FilePath]:
+    """
+    Runs the preparation stage of the drMD protocol (pdb2pqr, antechamber, tleap etc.)
+    This can be run in a different process to the simulation stage
+
+    Args:
+        configYaml (str): The path to the YAML configuration file.
+
+    Returns:
+        preparedFiles (Tuple[FilePath, FilePath, FilePath]): solvated PDB, inpcrd and prmtop files
+    """
     # Read the configuration file
     config: dict = drConfigTriage.read_config(configYaml)
 
     # Create the output directory if it doesn't exist
     outDir: str = config["pathInfo"]["outputDir"]
     os.makedirs(outDir, exist_ok=True)
+    drGovernor.set_up_governor(p.dirname(config["pathInfo"]["outputDir"]), config["hardwareInfo"])
     # Prepare the protocol
-    solvatedPdb, inputCoords, amberParams = drPrep.prep_protocol(config)
+    try:
+        solvatedPdb, inputCoords, amberParams = drPrep.prep_protocol(config)
+    ## prep failures call exit(), so SystemExit is recorded here too
+    except (Exception, SystemExit) as e:
+        drLedger.update_system(drLedger.get_ledger_file_for_run(config),
+                                config["proteinInfo"]["proteinName"],
+                                  prepState = drLedger.FAILED)
+        raise e
+
+    return solvatedPdb, inputCoords, amberParams
+#####################################################################################
+def run_simulation_stage(configYaml: FilePath, preparedFiles: Tuple[FilePath, FilePath, FilePath]) -> None:
+    """
+    Runs the simulation stage of the drMD protocol on a system that has already been prepared
+
+    Args:
+        configYaml (str): The path to the YAML configuration file.
+        preparedFiles (Tuple[FilePath, FilePath, FilePath]): solvated PDB, inpcrd and prmtop files
+
+    Returns:
+        None
+    """
+    # Read the configuration file
+    config: dict = drConfigTriage.read_config(configYaml)
+    outDir: str = config["pathInfo"]["outputDir"]
+    solvatedPdb, inputCoords, amberParams = preparedFiles
+    drGovernor.set_up_governor(p.dirname(config["pathInfo"]["outputDir"]), config["hardwareInfo"])
 
     # Run the simulation
     run_simulation(config = config,
@@ -50,6 +96,12 @@ def drMD_protocol(configYaml: FilePath) -> None:
 def run_simulation(config: dict, outDir: str, inputCoords: str, amberParams: str, pdbFile: str) -> None:
     """
     Run the simulation according to the given configuration.
+    Each step starts from the step named by its startFrom, or from the step before it if startFrom is not set.
+    With hardwareInfo.parallelBranches above 1, steps whose parents have finished are run at the same time,
+    so branches that start from a shared step (including the replicas of a step) run concurrently
+    Branches are threads of this process: they share its CPU threads (see drSim.get_branch_threads),
+    and the step records they update are guarded by a lock. Prep, which changes the working directory
+    and the log file, has finished before any branch starts
 
     Args:
         config (dict): The configuration dictionary.
@@ -72,39 +124,167 @@ def run_simulation(config: dict, outDir: str, inputCoords: str, amberParams: str
     prmtop: app.Topology = app.AmberPrmtopFile(amberParams)
     inpcrd: app.InpcrdFile = app.AmberInpcrdFile(inputCoords)
 
-    # Loop over simulations
+    ## steps with replicas are run once per replica, from the shared state of the step they start from
+    config["simulationInfo"] = drConfigTriage.expand_replicas(config["simulationInfo"], protName)
+
+    ## read the state of each step from the ledger
+    ledgerFile: FilePath = drLedger.get_ledger_file_for_run(config)
+    stepRecords: Dict[str, Dict] = drLedger.get_steps(ledgerFile, protName)
+    ## hashed before any steps are run, as running a step processes its entry in simulationInfo
+    stepHashes: List[str] = drLedger.hash_steps(config, inputCoords, amberParams)
+    ## keys into the memo store, which is shared between batches
+    memoKeys: Optional[List[str]] = drMemoStore.hash_memo_keys(config) if drMemoStore.get_memo_dir(config) is not None else None
+    ## indexes of steps that have been run (rather than skipped) by this call
+    rerunSteps: set = set()
+    ## guards stepRecords and rerunSteps, which are shared between branches
+    stateLock: threading.Lock = threading.Lock()
+
     simulations = config["simulationInfo"]
-    for i in range(len(simulations)):
-        sim: dict = simulations[i]
-        simDir: str = p.join(outDir, sim["stepName"])
+    stepArgs: Dict = {"config": config, "outDir": outDir, "pdbFile": pdbFile, "prmtop": prmtop, "inpcrd": inpcrd,
+                       "platform": platform, "stepRecords": stepRecords, "stepHashes": stepHashes, "rerunSteps": rerunSteps,
+                       "stateLock": stateLock, "memoKeys": memoKeys}
+    parallelBranches: int = config["hardwareInfo"].get("parallelBranches", 1)
+    ## steps are listed after the step they start from, so running them in order is always safe
+    if parallelBranches == 1:
+        for i in range(len(simulations)):
+            run_step(i, **stepArgs)
+        return
+
+    finishedSteps: set = set()
+    waitingSteps: List[int] = list(range(len(simulations)))
+    runningSteps: Dict[Future, int] = {}
+    firstError: Optional[Exception] = None
+    with ThreadPoolExecutor(max_workers=parallelBranches) as branchPool:
+        while len(waitingSteps) > 0 or len(runningSteps) > 0:
+            ## start every step whose parent has finished, unless a step has failed
+            if firstError is None:
+                for i in list(waitingSteps):
+                    parentIndex: Optional[int] = get_parent_index(simulations, i)
+                    if parentIndex is None or parentIndex in finishedSteps:
+                        waitingSteps.remove(i)
+                        runningSteps[branchPool.submit(run_step, i, **stepArgs)] = i
+            if len(runningSteps) == 0:
+                break
+            doneSteps, _ = wait(runningSteps, return_when=FIRST_COMPLETED)
+            for future in doneSteps:
+                i = runningSteps.pop(future)
+                try:
+                    future.result()
+                    finishedSteps.add(i)
+                except Exception as e:
+                    if firstError is None:
+                        firstError = e
+    ## steps that were already running are allowed to finish (or pause) before the first error is passed on
+    if firstError is not None:
+        raise firstError
+###########################################################################################
+def run_step(i: int,
+              config: Dict,
+                outDir: DirectoryPath,
+                  pdbFile: FilePath,
+                    prmtop: app.AmberPrmtopFile,
+                      inpcrd: app.AmberInpcrdFile,
+                        platform: openmm.Platform,
+                          stepRecords: Dict[str, Dict],
+                            stepHashes: List[str],
+                              rerunSteps: set,
+                                stateLock: threading.Lock,
+                                  memoKeys: Optional[List[str]] = None) -> None:
+    """
+    Skips, resumes or runs one step of a system
+    A step that has to be run from the start is restored from the memo store instead, if it is stored there
+
+    Args:
+        i (int): index of the step in simulationInfo
+        config (dict): per-system config dictionary
+        outDir (DirectoryPath): run directory of the system
+        pdbFile (FilePath): the solvated PDB file, used as a reference by the reporters
+        prmtop, inpcrd: the prepared system
+        platform (openmm.Platform): platform to run on
+        stepRecords (dict): ledger records of the steps of this system, keyed by stepName
+        stepHashes (List[str]): hash of each step, see drLedger.hash_steps
+        rerunSteps (set): indexes of steps that have been run by this call, this step is added if it is run
+        stateLock (threading.Lock): guards stepRecords and rerunSteps, which are shared between branches
+        memoKeys (List[str], optional): memo store key of each step, see drMemoStore.hash_memo_keys
+    """
+    protName: str = config["proteinInfo"]["proteinName"]
+    ledgerFile: FilePath = drLedger.get_ledger_file_for_run(config)
+    simulations: List[Dict] = config["simulationInfo"]
+    sim: dict = simulations[i]
+    stepName: str = sim["stepName"]
+    simDir: str = p.join(outDir, stepName)
+
+    with stateLock:
+        ## steps that have changed since they were run (or that start from a step that has been run again) are run again
+        ## steps run by an older drMD have no stored hash, they are kept unless their parent step has been run again
+        storedHash: Optional[str] = drLedger.read_step_hash(simDir)
+        parentRerun: bool = get_parent_index(simulations, i) in rerunSteps
+        if (storedHash is not None and storedHash != stepHashes[i]) or (storedHash is None and parentRerun and p.isdir(simDir)):
+            drLogger.log_info(f"{stepName} for {protName} has changed since it was run, running it again", True)
+            set_aside_outdated_step(simDir)
+            drLedger.update_step(ledgerFile, protName, stepName, state = drLedger.PENDING, saveFile = None)
+            stepRecords.pop(stepName, None)
 
         saveFile = None
         # Decide whether to skip, resume, or start a new simulation
         skipResumeSim, foundSaveFile = skip_resume_or_simulate(simDir=simDir,
                                                                simulations=simulations,
                                                                i=i, 
-                                                               outDir=outDir)
-
-        if foundSaveFile is not None:
-            saveFile = foundSaveFile
-
-        # Skip or resume simulation
-        if skipResumeSim == "skip":
-            stepName: str = sim["stepName"]
-            drLogger.log_info(f"Skipping {stepName} for run: {protName}", True)
-            continue
-        if skipResumeSim == "resume":
-            drLogger.log_info(f"Resuming {stepName} from checkpoint file for run: {protName}", True)
-            rename_out_files(simDir)    
-
-        # Run simulation
-        simulationFunction = choose_simulation_function(sim["simulationType"])
-
-        firstAidMaxRetries = config["miscInfo"]["firstAidMaxRetries"]
-        if firstAidMaxRetries > 0 and not sim["simulationType"] == "EM":
-            simulationFunction = drFirstAid.firstAid_handler()(simulationFunction)
-
-        try:
+                                                               outDir=outDir,
+                                                               stepRecords=stepRecords)
+        stepState: Optional[str] = stepRecords.get(stepName, {}).get("state")
+        if skipResumeSim != "skip":
+            rerunSteps.add(i)
+
+    if foundSaveFile is not None:
+        saveFile = foundSaveFile
+
+    # Skip or resume simulation
+    if skipResumeSim == "skip":
+        drLogger.log_info(f"Skipping {stepName} for run: {protName}", True)
+        ## steps found on disk by an older drMD are added to the ledger here
+        if stepState != drLedger.DONE:
+            drLedger.update_step(ledgerFile, protName, stepName,
+                                  stepIndex = i, state = drLedger.DONE, saveFile = saveFile)
+        if storedHash is None:
+            drLedger.write_step_hash(simDir, stepHashes[i])
+        return
+    if skipResumeSim == "resume":
+        drLogger.log_info(f"Resuming {stepName} from checkpoint file for run: {protName}", True)
+        rename_out_files(simDir)    
+
+    # Run simulation
+    ## a step with the same input, prep settings and protocol up to here has been run before
+    if skipResumeSim == "simulate" and memoKeys is not None:
+        restoredXml: Optional[FilePath] = drMemoStore.restore_step(config, memoKeys[i], simDir)
+        if restoredXml is not None:
+            drLogger.log_info(f"Reused stored result for {stepName} for {protName} from the memo store ({memoKeys[i][:12]}), skipping the simulation", True)
+            drLedger.write_step_hash(simDir, stepHashes[i])
+            drLedger.update_step(ledgerFile, protName, stepName, stepIndex = i, state = drLedger.DONE, saveFile = restoredXml,
+                                  restoredFrom = memoKeys[i])
+            return
+    drLedger.write_step_hash(simDir, stepHashes[i])
+    simulationFunction = choose_simulation_function(sim["simulationType"])
+
+    firstAidMaxRetries = config["miscInfo"]["firstAidMaxRetries"]
+    if firstAidMaxRetries > 0 and not sim["simulationType"] == "EM":
+        simulationFunction = drFirstAid.firstAid_handler()(simulationFunction)
+
+    ## don't start a step with no time left in wallTimeBudget, it is started on resubmission instead
+    drWallClock.check_time_left(config["hardwareInfo"], f"{stepName} for {protName}")
+    ## a step still marked as running was cut short by a stall or a crash, and carries on with the retries it has left
+    if stepState == drLedger.RUNNING:
+        drLedger.update_step(ledgerFile, protName, stepName, stepIndex = i, state = drLedger.RUNNING)
+    else:
+        drLedger.update_step(ledgerFile, protName, stepName, stepIndex = i, state = drLedger.RUNNING, retries = 0, restoredFrom = None)
+    ## the simulation holds one governor token per OpenMM thread (or one, if it runs on a GPU)
+    simulationCpus: int = drSim.get_simulation_cpus(config["hardwareInfo"])
+    ## memory is reserved from a model fitted to the peak memory of earlier steps in the batch
+    nSolvatedAtoms: int = prmtop.topology.getNumAtoms()
+    simulationMemory: float = drMemoryModel.predict_peak_memory(p.dirname(outDir), "simulation", nSolvatedAtoms)
+    try:
+        with drGovernor.hold_resources(f"{stepName} for {protName}", cpus=simulationCpus, pool="simulation", memoryMB=simulationMemory), \
+              drMemoryModel.measure_peak_memory(p.dirname(outDir), "simulation", f"{protName}/{stepName}", nSolvatedAtoms):
             saveFile = simulationFunction(prmtop=prmtop,
                                           inpcrd=inpcrd,
                                           sim=sim,
@@ -113,11 +293,36 @@ def run_simulation(config: dict, outDir: str, inputCoords: str, amberParams: str
                                           platform=platform,
                                           refPdb=pdbFile,
                                           config=config)
-        except Exception as e:
-            errorMessage = f"Error running simulation: {e}"
-            drLogger.log_info(errorMessage, True)
-            raise e
-
+    except drWallClock.WallTimeExceeded as e:
+        drLogger.log_info(f"Pausing {stepName} for {protName}: {e}", True)
+        drLedger.update_step(ledgerFile, protName, stepName, state = drLedger.PAUSED)
+        raise e
+    except Exception as e:
+        errorMessage = f"Error running simulation: {e}"
+        drLogger.log_info(errorMessage, True)
+        drLedger.update_step(ledgerFile, protName, stepName, state = drLedger.FAILED)
+        raise e
+    drLedger.update_step(ledgerFile, protName, stepName, state = drLedger.DONE, saveFile = saveFile)
+    if memoKeys is not None:
+        ## the step has finished, so a memo store that can't be written to is only logged
+        ## its reports and plots are stored with it, so its vitals checkup has to finish first
+        drCheckup.wait_for_checkup(simDir)
+        try:
+            drMemoStore.store_step(config, memoKeys[i], simDir, saveFile)
+        except OSError as e:
+            drLogger.log_info(f"WARNING: could not add {stepName} for {protName} to the memo store: {e}", True)
+    ## measured speeds calibrate the throughput model used for automatic CPU allocation
+    drBatchPlanner.record_step_throughput(config, sim, simDir, drSim.pop_step_threads(simDir, config["hardwareInfo"]))
+###########################################################################################
+def get_parent_index(simulations: List[Dict], i: int) -> Optional[int]:
+    """
+    Returns the index of the step that a step starts from,
+    the step named by its startFrom or the step before it. The first step has no parent
+    """
+    startFrom: Optional[str] = simulations[i].get("startFrom", None)
+    if startFrom is None:
+        return i - 1 if i > 0 else None
+    return [simulation["stepName"] for simulation in simulations].index(startFrom)
 
 ###########################################################################################
 def choose_platform(config: Dict) -> openmm.Platform:
@@ -148,6 +353,15 @@ def rename_out_files(simDir: DirectoryPath) -> None:
         os.rename(trajectoryDcd, p.join(simDir, f"trajectory_partial_{str(resumeNumber)}.dcd"))
     
 ###########################################################################################
+def set_aside_outdated_step(simDir: DirectoryPath) -> None:
+    """
+    Moves the outputs of an outdated step to <stepName>_outdated, replacing any older outdated outputs
+    """
+    outdatedDir: DirectoryPath = f"{simDir}_outdated"
+    if p.isdir(outdatedDir):
+        rmtree(outdatedDir)
+    os.rename(simDir, outdatedDir)
+###########################################################################################
 def choose_simulation_function(simulationType: str) -> Callable:
     """
     Choose the appropriate simulation function based on the simulation type.
@@ -165,31 +379,41 @@ def choose_simulation_function(simulationType: str) -> Callable:
     elif simulationType.upper() in ["NPT","NVT"]:
         return drSim.run_molecular_dynamics
     elif simulationType.upper() == "META":
+        ## metadynamics is rarely used, so it is only imported when needed
+        from Surgery import drMeta
         return drMeta.run_metadynamics
 ###########################################################################################
-def skip_resume_or_simulate(simDir: str, simulations: list, i: int, outDir: str) -> tuple:
+def skip_resume_or_simulate(simDir: str, simulations: list, i: int, outDir: str,
+                             stepRecords: Optional[Dict[str, Dict]] = None) -> tuple:
     """
     Check if the simulation directory exists and decide whether to skip, resume or start a new simulation.
+    The run ledger is read first, the simulation directories are only searched for steps that are not in the ledger
 
     Args:
         simDir (str): The path to the simulation directory.
         simulations (list): List of simulation information dictionaries.
         i (int): Index of the current simulation in the list.
         outDir (str): The path to the output directory.
+        stepRecords (dict, optional): Ledger records for the steps of this system, keyed by stepName
 
     Returns:
         tuple: A tuple containing the action to be taken (simulate, skip or resume) and the path to the save file.
     """
+    if stepRecords is not None:
+        ledgerDecision: Optional[tuple] = skip_resume_or_simulate_from_ledger(simDir, simulations, i, stepRecords)
+        if ledgerDecision is not None:
+            return ledgerDecision
 
-
+    ## the previous step is the one this step starts from, see get_parent_index
+    parentIndex: Optional[int] = get_parent_index(simulations, i)
     ## if the simDir for this step doesn't exist, find the xml file for the previous step
     if not p.isdir(simDir):
         ## if this is the first simulation in the series and the simDir doesn't exist, run the step from scratch
-        if i == 0:
+        if parentIndex is None:
             return "simulate", None
 
-        previousSimName = simulations[i-1]["stepName"]
-        previousSimDir = p.join(outDir, previousSimName) if i > 0 else False
+        previousSimName = simulations[parentIndex]["stepName"]
+        previousSimDir = p.join(outDir, previousSimName)
         saveXml = p.join(previousSimDir, f"{previousSimName}.xml") if previousSimDir else False
         return "simulate", saveXml
     
@@ -207,9 +431,35 @@ def skip_resume_or_simulate(simDir: str, simulations: list, i: int, outDir: str)
             return "resume", saveChk
         else:
             # rmtree(simDir)
-            previousSimName = simulations[i-1]["stepName"]
-            previousSimDir = p.join(outDir, previousSimName) if i > 0 else False
+            previousSimName = simulations[parentIndex]["stepName"] if parentIndex is not None else None
+            previousSimDir = p.join(outDir, previousSimName) if parentIndex is not None else False
             saveXml = p.join(previousSimDir, f"{previousSimName}.xml") if previousSimDir else False
             return "simulate", saveXml
+###########################################################################################
+def skip_resume_or_simulate_from_ledger(simDir: str, simulations: list, i: int,
+                                          stepRecords: Dict[str, Dict]) -> Optional[tuple]:
+    """
+    Decides whether to skip or start a step using the run ledger
+    Steps that were interrupted, or that the ledger has no record of, are left to the directory checks
 
+    Args:
+        simDir (str): The path to the simulation directory.
+        simulations (list): List of simulation information dictionaries.
+        i (int): Index of the current simulation in the list.
+        stepRecords (dict): Ledger records for the steps of this system, keyed by stepName
 
+    Returns:
+        tuple: (simulate or skip) and the save file, or None if the ledger can't decide
+    """
+    thisRecord: Optional[Dict] = stepRecords.get(simulations[i]["stepName"], None)
+    if thisRecord is not None:
+        if thisRecord["state"] == drLedger.DONE and thisRecord["saveFile"] is not None and p.isfile(thisRecord["saveFile"]):
+            return "skip", thisRecord["saveFile"]
+        return None
+
+    ## a step that has never been started follows on from the saveFile of the previous step
+    parentIndex: Optional[int] = get_parent_index(simulations, i)
+    previousRecord: Optional[Dict] = stepRecords.get(simulations[parentIndex]["stepName"], None) if parentIndex is not None else None
+    if previousRecord is not None and previousRecord["state"] == drLedger.DONE and not p.isdir(simDir):
+        return "simulate", previousRecord["saveFile"]
+    return None
@@ -4,13 +4,13 @@ from os import path as p
 import subprocess
 from subprocess import run
 import string
-from shutil import copy
+from shutil import copy, rmtree
 import logging
 import pandas as pd
 import numpy as np
 
 ## drMD MODULES
-from UtilitiesCloset import drFixer, drSplash, drListInitiator
+from UtilitiesCloset import drFixer, drSplash, drListInitiator, drLedger, drGovernor
 from ExaminationRoom import drLogger
 
 ## PDB // DATAFRAME UTILS
@@ -65,17 +65,41 @@ def prep_protocol(config: dict) -> Tuple[str, str, str]:
 
     set_up_logging(outDir, protName)
 
+    ledgerFile: FilePath = drLedger.get_ledger_file_for_run(config)
+    prepHash: str = drLedger.hash_prep_settings(config)
+    ## a system prepared with different prep settings is prepared again in a clean prep directory,
+    ## the new prmtop and inpcrd files then change the hash of every step, so they are run again too
+    systemRecord: Optional[dict] = drLedger.get_system(ledgerFile, protName)
+    if systemRecord is not None and systemRecord["prepHash"] not in [None, prepHash]:
+        drLogger.log_info(f"Prep settings for {protName} have changed since it was prepared, preparing it again", True)
+        set_aside_outdated_prep(prepDir)
+        drLedger.update_system(ledgerFile, protName, prepState = drLedger.PENDING, prepHash = None)
 
     skipPrep, prepFiles = choose_to_skip_prep(config=config,
                                                prepDir=prepDir,
                                                  protName=protName)
     if skipPrep:
         drLogger.log_info(f"Prep steps already complete for {protName}: Skipping ...",True)
+        solvatedPdb, inputCoords, amberParams = prepFiles
+        drLedger.update_system(ledgerFile, protName,
+                                prepState = drLedger.DONE,
+                                  prepHash = prepHash,
+                                    solvatedPdb = solvatedPdb,
+                                      inputCoords = inputCoords,
+                                        amberParams = amberParams)
         return prepFiles
 
+    ## recorded now, so that files left by an interrupted prep are never mistaken for prep with other settings
+    drLedger.update_system(ledgerFile, protName, prepState = drLedger.RUNNING, prepHash = prepHash)
+
 
     ######### MAIN PREP PROTOCOL #########
-    if "ligandInfo" in config:
+    ## mutants built by drMutator are already protonated and solvated
+    if "mutantInfo" in config:
+        solvatedPdb, inputCoords, amberParams = mutant_prep_protocol(config=config,
+                                                                      protName=protName,
+                                                                        prepDir=prepDir)
+    elif "ligandInfo" in config:
         solvatedPdb, inputCoords, amberParams = ligand_prep_protocol(config=config,
                                                                       protName=protName,
                                                                         prepDir=prepDir)
@@ -91,9 +115,25 @@ def prep_protocol(config: dict) -> Tuple[str, str, str]:
     
     drLogger.log_info(f"Prep steps complete for {protName}!",True)
     drLogger.close_logging()
+    drLedger.update_system(ledgerFile, protName,
+                            prepState = drLedger.DONE,
+                              prepHash = prepHash,
+                                solvatedPdb = solvatedPdb,
+                                  inputCoords = inputCoords,
+                                    amberParams = amberParams)
 
     return solvatedPdb, inputCoords, amberParams
 #####################################################################################
+def set_aside_outdated_prep(prepDir: DirectoryPath) -> None:
+    """
+    Moves an outdated prep directory to 00_prep_outdated, replacing any older outdated prep, and makes a new one
+    """
+    outdatedDir: DirectoryPath = f"{prepDir}_outdated"
+    if p.isdir(outdatedDir):
+        rmtree(outdatedDir)
+    os.rename(prepDir, outdatedDir)
+    os.makedirs(prepDir, exist_ok=True)
+#####################################################################################
 def no_ligand_prep_protocol(config: dict, protName: str, prepDir: DirectoryPath) -> Tuple[FilePath, FilePath, FilePath]:
     ## SPLIT INPUT PDB INTO PROT AND IONS IF PRESENT
     inputPdb: FilePath = config["pathInfo"]["inputPdb"]
@@ -165,6 +205,24 @@ def ligand_prep_protocol(config: dict, protName: str, prepDir: DirectoryPath) ->
         return niceChainsPdb, inputCoords, amberParams
 
 #####################################################################################
+def mutant_prep_protocol(config: dict, protName: str, prepDir: DirectoryPath) -> Tuple[FilePath, FilePath, FilePath]:
+    """
+    Re-parameterises a mutant that drMutator has built from an equilibrated wild type
+    The mutant keeps the solvent and box of the wild type, so it is not protonated or solvated again
+    """
+    ## the same directory that choose_to_skip_prep looks in
+    completePrepDir: DirectoryPath = p.join(prepDir, "WHOLE" if "ligandInfo" in config else "PROT")
+    os.makedirs(completePrepDir, exist_ok=True)
+    mutantPdb: FilePath = config["pathInfo"]["inputPdb"]
+    outName: str = config["pathInfo"]["outputName"]
+    drLogger.log_info(f"Creating parameters for mutant {protName} in the box of {config['mutantInfo']['wildType']}...")
+    inputCoords, amberParams, solvatedPdb = make_mutant_amber_params(outDir = completePrepDir,
+                                                                      pdbFile = mutantPdb,
+                                                                        outName = outName,
+                                                                          mutantInfo = config["mutantInfo"])
+    solvatedPdb = drFixer.reset_chains_residues(mutantPdb, solvatedPdb, config)
+    return solvatedPdb, inputCoords, amberParams
+#####################################################################################
 def get_non_cannonical_amino_acid_data(protPdb: FilePath, config: dict) -> dict[dict]:
     """
     Looks for non-canonical amino acids in the protein PDB file
@@ -209,6 +267,18 @@ def choose_to_skip_prep(config: dict, prepDir: DirectoryPath, protName: str) ->
     Returns:
         Tuple[FilePath, FilePath, FilePath]: A tuple containing the paths to the merged PDB file, input coordinates file, and Amber parameter files.
     """
+    ## look in the ledger first, this avoids listing the prep directory
+    systemRecord: Optional[dict] = drLedger.get_system(drLedger.get_ledger_file_for_run(config), protName)
+    ## prep files made with different prep settings are never used
+    if systemRecord is not None and systemRecord["prepHash"] not in [None, drLedger.hash_prep_settings(config)]:
+        return False, None
+    if systemRecord is not None and systemRecord["prepState"] == drLedger.DONE:
+        prepFiles: Tuple[FilePath, FilePath, FilePath] = (systemRecord["solvatedPdb"],
+                                                           systemRecord["inputCoords"],
+                                                             systemRecord["amberParams"])
+        if all([prepFile is not None and p.isfile(prepFile) for prepFile in prepFiles]):
+            return True, prepFiles
+
     ## init some false booleans for check later
     amberParams = False
     inputCoords = False
@@ -449,7 +519,8 @@ def ligand_mol2(
         )
         # Run antechamber and log the command
         antechamberOut = p.join(inputDir, "sqm.out")
-        run_with_log(antechamberCommand, "Ligand charge calculation with antechamber", ligMol2, antechamberOut)
+        ## antechamber runs sqm for its AM1-BCC charges, so it is limited by the sqm pool
+        run_with_log(antechamberCommand, "Ligand charge calculation with antechamber", ligMol2, antechamberOut, resourcePool="sqm")
         # Copy to ligParamDir for future use
         copy(ligMol2, p.join(ligandParamDir, f"{ligandName}.mol2"))
     
@@ -895,6 +966,67 @@ def make_amber_params(
     solvatedPdb: FilePath = p.join(outDir, solvatedPdb)
     return inputCoords, amberParams, solvatedPdb
 
+#####################################################################################
+def make_mutant_amber_params(outDir: DirectoryPath,
+                              pdbFile: FilePath,
+                                outName: str,
+                                  mutantInfo: Dict) -> Tuple[FilePath, FilePath, FilePath]:
+    """
+    Makes Amber parameter files for a solvated mutant with TLEAP
+    Force fields, ligand and non-canonical amino acid parameters and disulphide bonds are taken from the wild type TLEAP input,
+    tleap builds the missing side chain atoms of mutated residues, and replaces waters with counter-ions if the charge has changed
+
+    Args:
+        outDir (DirectoryPath): The output directory.
+        pdbFile (FilePath): The mutant PDB file, including solvent
+        outName (str): The name of the mutant
+        mutantInfo (dict): mutantInfo from the per-protein config, with the wild type box and TLEAP input
+
+    Returns:
+        Tuple[FilePath, FilePath, FilePath]: The paths to the input coordinate file, the Amber parameter file and a pdb file
+    """
+    drLogger.log_info(f"Preparing parameters for mutant: {outName}...",True)
+    os.chdir(outDir)
+    with open(mutantInfo["wildTypeTleapInput"], "r") as f:
+        wildTypeTleapLines: List[str] = f.readlines()
+    ## everything before the wild type structure is loaded sets up parameters
+    loadPdbIndex: int = [line.startswith("mol = loadpdb") for line in wildTypeTleapLines].index(True)
+    boxLengths: List[float] = mutantInfo["box"][:3]
+
+    tleapInput: FilePath = p.join(outDir, "TLEAP.in")
+    with open(tleapInput, "w") as f:
+        f.writelines(wildTypeTleapLines[:loadPdbIndex])
+        f.write(f"mol = loadpdb {pdbFile}\n")
+        ## residues are numbered in the same order as in the wild type, so its disulphide bonds can be reused
+        f.writelines([line for line in wildTypeTleapLines if line.startswith("bond mol.")])
+        f.write(f"set mol box {{{boxLengths[0]:.3f} {boxLengths[1]:.3f} {boxLengths[2]:.3f}}}\n")
+        f.write("addIonsRand mol Na+ 0\n")
+        f.write("addIonsRand mol Cl- 0\n")
+        solvatedPdb: str = f"{outName}_solvated.pdb"
+        f.write(f"savepdb mol {solvatedPdb}\n")
+        amberParams: FilePath = p.join(outDir, f"{outName}.prmtop")
+        inputCoords: FilePath = p.join(outDir, f"{outName}.inpcrd")
+        f.write(f"saveamberparm mol {amberParams} {inputCoords}\n")
+        f.write("quit\n")
+
+    tleapOutput: FilePath = p.join(outDir, "TLEAP.out")
+    tleapCommand: str = f"tleap -f {tleapInput} > {tleapOutput}"
+    run_with_log(tleapCommand, "Mutant Parameterisation with TLEAP", amberParams, p.join(outDir, "leap.log"))
+    ## tleap only writes box lengths, the angles of a non-rectangular box are put back into the coordinates file
+    if any([abs(angle - 90) > 0.01 for angle in mutantInfo["box"][3:]]):
+        set_inpcrd_box(inputCoords, mutantInfo["box"])
+    return inputCoords, amberParams, p.join(outDir, solvatedPdb)
+#####################################################################################
+def set_inpcrd_box(inputCoords: FilePath, box: List[float]) -> None:
+    """
+    Overwrites the box line (the last line) of an Amber coordinates file with box lengths and angles
+    """
+    with open(inputCoords, "r") as f:
+        inpcrdLines: List[str] = f.read().rstrip("\n").split("\n")
+    inpcrdLines[-1] = "".join([f"{boxValue:12.7f}" for boxValue in box])
+    with open(inputCoords, "w") as f:
+        f.write("\n".join(inpcrdLines) + "\n")
+#####################################################################################
 def make_amber_renumbered_pdb(inPdb, outPdb):
     inDf = pdbUtils.pdb2df(inPdb)
 
@@ -948,14 +1080,17 @@ def run_with_log(
     command: str,
     stepName: str,
     expectedOutput: Optional[str] = None,
-    debugFileToCheck: Optional[str] = None
+    debugFileToCheck: Optional[str] = None,
+    resourcePool: Optional[str] = None
 ) -> None:
     """
     Execute a command and log its output.
+    The command holds one CPU token from drGovernor while it runs
 
     Args:
         command (str): The command to execute.
         expectedOutput (Optional[str], optional): The path to the expected output file. Defaults to None.
+        resourcePool (Optional[str], optional): The governor pool to run in. Defaults to the name of the program.
 
     Returns:
         None
@@ -966,16 +1101,19 @@ def run_with_log(
     ## split command into list
     if isinstance(command, str):
         command = command.split()
+    if resourcePool is None:
+        resourcePool = p.basename(command[0])
 
     try: 
         # Execute the command and capture its output
-        result: subprocess.CompletedProcess[str] = subprocess.run(
-            command,
-            capture_output=True,
-            check=True,
-            text=True, 
-            env = os.environ
-        )
+        with drGovernor.hold_resources(stepName, cpus=1, pool=resourcePool):
+            result: subprocess.CompletedProcess[str] = subprocess.run(
+                command,
+                capture_output=True,
+                check=True,
+                text=True, 
+                env = os.environ
+            )
     except Exception as errorMessage:
         drSplash.print_prep_failed(errorMessage, stepName, debugFileToCheck)
 
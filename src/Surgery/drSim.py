@@ -3,26 +3,29 @@ import os
 from os import path as p
 import numpy as np
 import sys
+import copy
+import time
 
 ## OPENMM LIBRARIES
 import openmm.app as app
 import openmm as openmm
 import  openmm.unit  as unit
-## MDTRAJ LIBRARIES // DISABLE WARNINGS
-import mdtraj 
+## MDTRAJ LIBRARIES ARE IMPORTED IN init_reporters, ENERGY MINIMISATIONS DON'T NEED THEM
 import warnings
-from mdtraj.utils.validation import TypeCastPerformanceWarning
-warnings.filterwarnings("ignore", category=TypeCastPerformanceWarning)
 
 ## drMD LIBRARIES
 from Surgery import drRestraints, drFirstAid
 from ExaminationRoom import drLogger, drCheckup
-from UtilitiesCloset import drFixer, drSelector
+from UtilitiesCloset import drFixer, drSelector, drThreadAllocator, drWallClock
 
 ## CLEAN CODE
-from typing import Optional, Dict, List, Tuple, Union, Any
+from typing import Optional, Dict, List, Tuple, Union, Any, Callable
 from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
 
+## steps are run in chunks of about this many seconds, so that stops and thread changes are acted on quickly
+CHUNK_SECONDS: float = 5.0
+## CPU threads each step finished on, keyed by step directory, see run_steps and pop_step_threads
+STEP_THREADS: Dict[DirectoryPath, int] = {}
 ###########################################################################################
 def initialise_simulation(prmtop: app.AmberPrmtopFile,
                            inpcrd: app.AmberInpcrdFile,
@@ -94,9 +97,12 @@ def initialise_simulation(prmtop: app.AmberPrmtopFile,
         integrator: openmm.Integrator = openmm.LangevinMiddleIntegrator(initailSimulationTemp,
                                                                          1/unit.picosecond,
                                                                            sim["timestep"])
+    ## replicas use their own seed for the random forces of the thermostat
+    if "replicaSeed" in sim:
+        integrator.setRandomNumberSeed(sim["replicaSeed"])
 
 
-    simulation: app.simulation.Simulation = app.simulation.Simulation(prmtop.topology, system, integrator, )
+    simulation: app.simulation.Simulation = create_simulation(prmtop.topology, system, integrator, hardwareInfo)
     
 
     return simulation , integrator
@@ -207,6 +213,9 @@ def init_reporters(simDir: str,
     # convert to numpy array
     dcdAtomSelection = np.array(dcdAtomSelection)
     ## create a mdtraj trajectory reporter
+    import mdtraj
+    from mdtraj.utils.validation import TypeCastPerformanceWarning
+    warnings.filterwarnings("ignore", category=TypeCastPerformanceWarning)
     dcdTrajectoryReporter: mdtraj.reporters.DCDReporter = mdtraj.reporters.DCDReporter(dcdFile,
                                                               reportInterval,
                                                               dcdAtomSelection)
@@ -254,12 +263,100 @@ def load_simulation_state(simulation: app.Simulation, saveFile: FilePath) -> app
         simulation.loadState(saveFile)
 
     ## reset time and step count of simulation to zero
-    simulation.context.setTime(0.0)
-    simulation.context.setStepCount(0)
+    ## checkpoints are only loaded to resume a step, so they keep their step count
+    if saveFileExt == ".xml":
+        simulation.context.setTime(0.0)
+        simulation.context.setStepCount(0)
 
     # Return the modified simulation object
     return simulation
 ###########################################################################################
+def set_up_replica(simulation: app.Simulation, sim: Dict, saveFile: FilePath, simDir: DirectoryPath) -> None:
+    """
+    Records the seed of a replica step in replica_seed.txt
+    The first step of each replica draws fresh velocities from its seed at its starting temperature,
+    so that replicas starting from the same shared step follow different trajectories.
+    Steps resumed from a checkpoint keep the velocities stored in the checkpoint
+
+    Args:
+        simulation (app.Simulation): the simulation, after its starting state has been loaded
+        sim (Dict): the step, see drConfigTriage.expand_replicas
+        saveFile (FilePath): the file the starting state was loaded from
+        simDir (DirectoryPath): the directory of the step
+    """
+    if "replicaSeed" not in sim:
+        return
+    with open(p.join(simDir, "replica_seed.txt"), "w") as f:
+        f.write(f"{sim['replicaSeed']}\n")
+    if not sim.get("replicaStart", False) or p.splitext(saveFile)[1] != ".xml":
+        return
+    startTemp = sim["temperature"] if "temperature" in sim else sim["temperatureRange"][0]
+    simulation.context.setVelocitiesToTemperature(startTemp, sim["replicaSeed"])
+    drLogger.log_info(f"Starting replica {sim['replica']} ({sim['stepName']}) with random seed {sim['replicaSeed']}", True)
+###########################################################################################
+def get_branch_threads(hardwareInfo: Dict) -> Optional[int]:
+    """
+    With parallelBranches above 1 on the CPU platform, branches run as threads of one system process,
+    so the CPU threads of the system are shared between them rather than each branch using all of them
+
+    Returns:
+        branchThreads (Optional[int]): CPU threads for each branch, or None if branches are not run at the same time
+    """
+    parallelBranches: int = hardwareInfo.get("parallelBranches", 1)
+    if parallelBranches == 1 or hardwareInfo["platform"] != "CPU":
+        return None
+    systemThreads: int = int(os.environ.get("OPENMM_CPU_THREADS", hardwareInfo["subprocessCpus"]))
+    return max(1, systemThreads // parallelBranches)
+###########################################################################################
+def get_simulation_cpus(hardwareInfo: Dict) -> int:
+    """
+    Returns the number of CPU threads a simulation will use, one if it runs on a GPU
+    """
+    if hardwareInfo["platform"] != "CPU":
+        return 1
+    branchThreads: Optional[int] = get_branch_threads(hardwareInfo)
+    if branchThreads is not None:
+        return branchThreads
+    return int(os.environ.get("OPENMM_CPU_THREADS", hardwareInfo["subprocessCpus"]))
+###########################################################################################
+def get_context_threads(simulation: app.Simulation) -> Optional[int]:
+    """
+    Returns the number of threads a simulation's context runs on, None if it is not on the CPU platform
+    This is the real thread count, after branch shares, pinCpus and elasticThreads have been applied
+    """
+    contextPlatform: openmm.Platform = simulation.context.getPlatform()
+    if contextPlatform.getName() != "CPU":
+        return None
+    return int(contextPlatform.getPropertyValue(simulation.context, "Threads"))
+###########################################################################################
+def pop_step_threads(simDir: DirectoryPath, hardwareInfo: Dict) -> int:
+    """
+    Returns the CPU threads a step finished on, as recorded by run_steps
+    Steps that did not run on the CPU platform (or never reached run_steps) fall back to get_simulation_cpus
+    """
+    stepThreads: Optional[int] = STEP_THREADS.pop(simDir, None)
+    if stepThreads is not None:
+        return stepThreads
+    return get_simulation_cpus(hardwareInfo)
+###########################################################################################
+def create_simulation(topology: app.Topology,
+                       system: openmm.System,
+                         integrator: openmm.Integrator,
+                           hardwareInfo: Dict,
+                             platform: Optional[openmm.Platform] = None) -> app.Simulation:
+    """
+    Makes a Simulation, on platform if one is given
+    The CPU platform reads OPENMM_CPU_THREADS once, when it is loaded,
+    so branches that share the system's threads have their Threads property set explicitly
+    """
+    branchThreads: Optional[int] = get_branch_threads(hardwareInfo)
+    if branchThreads is not None:
+        return app.Simulation(topology, system, integrator,
+                               openmm.Platform.getPlatformByName("CPU"), {"Threads": str(branchThreads)})
+    if platform is None:
+        return app.Simulation(topology, system, integrator)
+    return app.Simulation(topology, system, integrator, platform)
+###########################################################################################
 @drLogger.monitor_progress_decorator()
 # @drFirstAid.firstAid_handler()
 @drCheckup.check_up_handler()
@@ -300,8 +397,10 @@ def run_molecular_dynamics(prmtop: app.AmberPrmtopFile,
     # set up intergrator and system
     # load state from previous simulation (or continue from checkpoint)
     simulation: app.Simulation = load_simulation_state(simulation, saveFile)
+    set_up_replica(simulation, sim, saveFile, simDir)
     # set up reporters
-    totalSteps: int = simulation.currentStep + sim["nSteps"]
+    ## a resumed step keeps the step count of its checkpoint, see step_simulation
+    totalSteps: int = max(sim["nSteps"], simulation.currentStep)
     reportInterval: int = sim["logInterval"]
 
     simulation: app.Simulation = init_reporters(simDir=simDir,
@@ -312,7 +411,7 @@ def run_molecular_dynamics(prmtop: app.AmberPrmtopFile,
                                 refPdb=refPdb
                                 )
     # run NVT / NPT simulation
-    simulation: app.Simulation = step_simulation(simulation, integrator, sim)
+    simulation: app.Simulation = step_simulation(simulation, integrator, sim, config, simDir)
 
     # find name to call outFiles
     protName: str = p.basename(p.dirname(simDir))
@@ -333,25 +432,162 @@ def run_molecular_dynamics(prmtop: app.AmberPrmtopFile,
 
 ##########################################################################################
 
-def step_simulation(simulation: app.Simulation, integrator: openmm.Integrator, sim: Dict) ->  app.Simulation:
+def step_simulation(simulation: app.Simulation, integrator: openmm.Integrator, sim: Dict, config: Dict, simDir: DirectoryPath) ->  app.Simulation:
+    ## a resumed step only runs the steps that were not finished before it stopped
+    completedSteps: int = simulation.currentStep
     ## for simulations with constant temperature
     if "temperature" in sim:
         try:
-            simulation.step(sim["nSteps"])
+            simulation, integrator = run_steps(simulation, integrator, max(0, sim["nSteps"] - completedSteps), sim, config, simDir)
             return simulation
         except Exception as e:
             raise e
     ## for simulations with stepped temperature
-    nTempSteps = len(sim["temperatureRange"])
-    nStepsPerTempStep = round(sim["nSteps"] / nTempSteps)
-
     try:
-        for temperature in sim["temperatureRange"]:
+        for temperature, nRungSteps in get_temperature_schedule(sim["nSteps"], sim["temperatureRange"], completedSteps):
             integrator.setTemperature(temperature)
-            simulation.step(nStepsPerTempStep)
+            simulation, integrator = run_steps(simulation, integrator, nRungSteps, sim, config, simDir)
         return simulation
     except Exception as e:
         raise e
+###########################################################################################
+def get_temperature_schedule(nSteps: int, temperatureRange: List, completedSteps: int = 0) -> List[Tuple[float, int]]:
+    """
+    Splits a stepped temperature simulation into equal rungs, one per temperature
+    Rungs that were finished before a resumed step stopped are left out,
+    and the rung it stopped in only runs its remaining steps
+
+    Args:
+        nSteps (int): total number of steps in the simulation
+        temperatureRange (List): the temperature of each rung
+        completedSteps (int): steps already run, the step count of the checkpoint being resumed from
+
+    Returns:
+        temperatureSchedule (List[Tuple[float, int]]): the temperature and number of steps of each rung left to run
+    """
+    nStepsPerTempStep: int = round(nSteps / len(temperatureRange))
+    temperatureSchedule: List[Tuple[float, int]] = []
+    for rungIndex, temperature in enumerate(temperatureRange):
+        nRungSteps: int = (rungIndex + 1) * nStepsPerTempStep - max(completedSteps, rungIndex * nStepsPerTempStep)
+        if nRungSteps > 0:
+            temperatureSchedule.append((temperature, nRungSteps))
+    return temperatureSchedule
+###########################################################################################
+def run_steps(simulation: app.Simulation,
+               integrator: openmm.Integrator,
+                 nSteps: int,
+                   sim: Dict,
+                     config: Dict,
+                       simDir: DirectoryPath,
+                         stepFunction: Optional[Callable[[app.Simulation, int], None]] = None) -> Tuple[app.Simulation, openmm.Integrator]:
+    """
+    Runs nSteps of a simulation in chunks of a few seconds
+    Before each chunk, the simulation is checkpointed and stopped if drMD has been asked to stop
+    (SIGTERM or SIGINT) or if the chunk is not predicted to finish inside the wallTimeBudget
+    With elasticThreads, the simulation is moved to a context with more threads between chunks
+    if other systems in the batch have finished and freed up CPU cores
+
+    Args:
+        simulation (app.Simulation): the simulation to run
+        integrator (openmm.Integrator): the integrator of the simulation
+        nSteps (int): number of steps to run
+        sim (Dict): the simulation step being run
+        config (Dict): per-system config dictionary
+        simDir (DirectoryPath): output directory of the step
+        stepFunction (Callable, optional): runs a chunk of steps, eg. Metadynamics.step, simulation.step if not given
+
+    Returns:
+        simulation (app.Simulation): the simulation, which may now have a new context
+        integrator (openmm.Integrator): the integrator of the returned simulation
+    """
+    elasticThreads: bool = config["hardwareInfo"].get("elasticThreads", False) and simulation.context.getPlatform().getName() == "CPU"
+    currentThreads: Optional[int] = get_context_threads(simulation)
+    if currentThreads is not None:
+        STEP_THREADS[simDir] = currentThreads
+    chunkSize: int = max(1, sim["logInterval"])
+    stepsPerSecond: Optional[float] = None
+    stepsRemaining: int = nSteps
+    while stepsRemaining > 0:
+        nChunkSteps: int = min(chunkSize, stepsRemaining)
+        ## stop with a checkpoint if asked to, or if the next chunk might not finish inside wallTimeBudget
+        predictedSeconds: float = nChunkSteps / stepsPerSecond if stepsPerSecond else 0
+        if not drWallClock.has_time_for(config["hardwareInfo"], predictedSeconds):
+            stop_with_checkpoint(simulation, simDir)
+        chunkStart: float = time.time()
+        if stepFunction is None:
+            simulation.step(nChunkSteps)
+        else:
+            stepFunction(simulation, nChunkSteps)
+        stepsPerSecond = nChunkSteps / max(time.time() - chunkStart, 1e-6)
+        stepsRemaining -= nChunkSteps
+        if stepsRemaining == 0:
+            break
+        ## keep chunks short, so that a stop is acted on within a few seconds
+        chunkSize = max(1, int(stepsPerSecond * CHUNK_SECONDS))
+        if not elasticThreads:
+            continue
+        ## threads are only ever added, a new context is not worth making to give cores back
+        allocatedThreads: Optional[int] = drThreadAllocator.read_thread_allocation(config)
+        ## the allocation is for the whole system, which is shared between its branches
+        if allocatedThreads is not None and get_branch_threads(config["hardwareInfo"]) is not None:
+            allocatedThreads = max(1, allocatedThreads // config["hardwareInfo"]["parallelBranches"])
+        if allocatedThreads is not None and allocatedThreads > currentThreads:
+            drLogger.log_info(f"Increasing CPU threads for {config['proteinInfo']['proteinName']} from {currentThreads} to {allocatedThreads}", True)
+            ## pinned simulations must widen their core set before the new thread pool is started
+            allocatedCpus: Optional[List[int]] = drThreadAllocator.read_cpu_allocation(config)
+            if allocatedCpus is not None:
+                drThreadAllocator.pin_to_cpus(allocatedCpus)
+            simulation, integrator = move_to_new_context(simulation, integrator, allocatedThreads)
+            currentThreads = allocatedThreads
+            STEP_THREADS[simDir] = currentThreads
+    return simulation, integrator
+###########################################################################################
+def stop_with_checkpoint(simulation: app.Simulation, simDir: DirectoryPath) -> None:
+    """
+    Writes a checkpoint, closes the reporters so that their files are complete and raises WallTimeExceeded
+    (or StopRequested, if drMD received SIGTERM or SIGINT)
+    The step is carried on from this checkpoint by the resume path in drOperator.skip_resume_or_simulate
+    A system stopped on its own (see drWallClock.stop_system) has been taken over by another worker,
+    which owns its checkpoints from then on, so no checkpoint is written
+    """
+    if drWallClock.SYSTEM_STOP_REASON is None:
+        simulation.saveCheckpoint(p.join(simDir, "checkpoint.chk"))
+    for reporter in simulation.reporters:
+        if hasattr(reporter, "close"):
+            reporter.close()
+    simulation.reporters = []
+    raise drWallClock.make_stop_error(f"at step {simulation.currentStep} of {p.basename(simDir)}")
+###########################################################################################
+def move_to_new_context(simulation: app.Simulation,
+                         integrator: openmm.Integrator,
+                           threads: int) -> Tuple[app.Simulation, openmm.Integrator]:
+    """
+    Copies a simulation into a new CPU context with a different number of threads
+    The CPU platform only reads its Threads property when a context is made
+    Positions, velocities, box vectors, parameters and step count are carried over,
+    and the existing reporters are reused so that output files carry on where they left off
+
+    Args:
+        simulation (app.Simulation): the running simulation
+        integrator (openmm.Integrator): the integrator of the running simulation
+        threads (int): number of threads for the new context
+
+    Returns:
+        newSimulation (app.Simulation): the simulation in its new context
+        newIntegrator (openmm.Integrator): the integrator of the new simulation
+    """
+    state: openmm.State = simulation.context.getState(getPositions=True, getVelocities=True,
+                                                        getParameters=True, getIntegratorParameters=True)
+    currentStep: int = simulation.currentStep
+    ## an integrator can only belong to one context
+    newIntegrator: openmm.Integrator = copy.deepcopy(integrator)
+    cpuPlatform: openmm.Platform = openmm.Platform.getPlatformByName("CPU")
+    newSimulation: app.Simulation = app.Simulation(simulation.topology, simulation.system, newIntegrator,
+                                                    cpuPlatform, {"Threads": str(threads)})
+    newSimulation.context.setState(state)
+    newSimulation.currentStep = currentStep
+    newSimulation.reporters = simulation.reporters
+    return newSimulation, newIntegrator
 
 ###########################################################################################
 def run_energy_minimisation(prmtop: app.AmberPrmtopFile,
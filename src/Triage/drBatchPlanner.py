@@ -0,0 +1,386 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import math
+import time
+import heapq
+import multiprocessing as mp
+import pandas as pd
+
+## drMD LIBRARIES
+from ExaminationRoom import drLogger
+from Triage import drConfigTriage
+
+## CLEAN CODE
+from typing import Dict, List, Optional, Tuple
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## number of MD steps an unbounded (maxIterations = -1) energy minimisation is assumed to cost
+UNBOUNDED_EM_STEP_EQUIVALENT: int = 5000
+
+## throughput model used before any steps have been measured on this machine
+## singleThreadRate is in input-PDB atoms x steps per second on one CPU core
+## halfParallelAtoms is the size at which half of the work in a step is spread over threads,
+## so small peptides gain little from extra threads and large complexes gain a lot
+DEFAULT_THROUGHPUT_MODEL: Dict[str, float] = {"singleThreadRate": 3.0e5,
+                                              "halfParallelAtoms": 1000.0}
+## columns of 00_drMD_logs/throughput_measurements.csv
+THROUGHPUT_COLUMNS: List[str] = ["platform", "pdbName", "stepName", "nAtoms", "threads", "stepsPerSecond"]
+#####################################################################################
+def get_pdb_files(batchConfig: Dict) -> List[FilePath]:
+    """
+    Lists the PDB files in the input directory of a batch
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+
+    Returns:
+        pdbFiles (List[FilePath]): Paths to all PDB files in inputDir
+    """
+    pdbDir: DirectoryPath = batchConfig["pathInfo"]["inputDir"]
+    pdbFiles: List[FilePath] = sorted([p.join(pdbDir, pdbFile) for pdbFile in os.listdir(pdbDir)
+                                        if p.splitext(pdbFile)[1] == ".pdb"])
+    return pdbFiles
+#####################################################################################
+def plan_batch_order(batchConfig: Dict, pdbFiles: List[FilePath] = None) -> List[FilePath]:
+    """
+    Estimates the cost of each system in a batch and orders them
+    most expensive first (longest processing time first)
+    This stops the largest system from starting last and setting the makespan of the batch
+    Cost estimates and the chosen order are written to 00_drMD_logs/batch_cost_estimates.csv
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+        pdbFiles (List[FilePath], optional): PDB files to order. Defaults to all PDB files in inputDir
+
+    Returns:
+        orderedPdbFiles (List[FilePath]): PDB files, most expensive first
+    """
+    if pdbFiles is None:
+        pdbFiles = get_pdb_files(batchConfig)
+    if len(pdbFiles) == 0:
+        return []
+
+    costDf: pd.DataFrame = estimate_system_costs(pdbFiles, batchConfig)
+    ## sort by cost, ties broken by name so that the order is reproducible
+    costDf = costDf.sort_values(by=["estimatedCost", "pdbName"], ascending=[False, True]).reset_index(drop=True)
+    costDf["queuePosition"] = costDf.index + 1
+
+    ## write estimates to the log directory so they can be checked against real timings
+    logDir: DirectoryPath = p.join(batchConfig["pathInfo"]["outputDir"], "00_drMD_logs")
+    os.makedirs(logDir, exist_ok=True)
+    costDf.to_csv(p.join(logDir, "batch_cost_estimates.csv"), index=False)
+
+    return costDf["pdbFile"].tolist()
+#####################################################################################
+def estimate_system_costs(pdbFiles: List[FilePath], batchConfig: Dict) -> pd.DataFrame:
+    """
+    Estimates the relative cost of simulating each system in a batch
+    Cost is modelled as the number of atoms in the input PDB multiplied
+    by the total number of integration steps in simulationInfo
+
+    Args:
+        pdbFiles (List[FilePath]): PDB files to estimate costs for
+        batchConfig (dict): Batch configuration dictionary.
+
+    Returns:
+        costDf (pd.DataFrame): one row per system with atom counts, step counts and estimated costs
+    """
+    nSteps: int = count_protocol_steps(batchConfig["simulationInfo"])
+    costData: List[Dict] = []
+    for pdbFile in pdbFiles:
+        nAtoms: int = count_atoms(pdbFile)
+        costData.append({"pdbName": p.splitext(p.basename(pdbFile))[0],
+                         "pdbFile": pdbFile,
+                         "nAtoms": nAtoms,
+                         "nSteps": nSteps,
+                         "estimatedCost": nAtoms * nSteps})
+    return pd.DataFrame(costData)
+#####################################################################################
+def count_atoms(pdbFile: FilePath) -> int:
+    """
+    Counts ATOM and HETATM records in a PDB file without parsing it into a DataFrame
+
+    Args:
+        pdbFile (FilePath): path to a PDB file
+
+    Returns:
+        nAtoms (int): number of atoms in the PDB file
+    """
+    nAtoms: int = 0
+    with open(pdbFile, "r") as f:
+        for line in f:
+            if line.startswith(("ATOM", "HETATM")):
+                nAtoms += 1
+    return nAtoms
+#####################################################################################
+def count_protocol_steps(simulationInfo: List[Dict]) -> int:
+    """
+    Sums the number of integration steps over every step in simulationInfo
+    Energy minimisations are counted as maxIterations steps
+
+    Args:
+        simulationInfo (List[Dict]): simulationInfo entry of a batch config
+
+    Returns:
+        nSteps (int): total number of integration steps in the protocol
+    """
+    nSteps: int = 0
+    ## each replica of a step is counted, see drConfigTriage.expand_replicas
+    for sim in drConfigTriage.expand_replicas(simulationInfo, ""):
+        if sim.get("simulationType", "NPT").upper() == "EM":
+            maxIterations: int = sim.get("maxIterations", -1)
+            nSteps += UNBOUNDED_EM_STEP_EQUIVALENT if maxIterations == -1 else maxIterations
+            continue
+        duration: float = convert_time_to_femtoseconds(sim["duration"])
+        timestep: float = convert_time_to_femtoseconds(sim.get("timestep", "2 fs"))
+        nSteps += int(duration / timestep)
+    return nSteps
+#####################################################################################
+def convert_time_to_femtoseconds(timeInput: str) -> float:
+    """
+    Converts a drMD time string (eg. "10 ns") into femtoseconds
+
+    Args:
+        timeInput (str): time string in the format "10 ns"
+
+    Returns:
+        femtoseconds (float): the time in femtoseconds
+    """
+    timescale: Dict[str, float] = {"fs": 1,
+                                   "ps": 1e3,
+                                   "ns": 1e6,
+                                   "ms": 1e12}
+    timeData: List[str] = timeInput.split()
+    return float(timeData[0]) * timescale[timeData[1]]
+#####################################################################################
+def plan_hardware(batchConfig: Dict) -> Dict:
+    """
+    Resolves parallelCPU and subprocessCpus when they are set to "auto"
+    The split with the shortest estimated makespan is chosen, using the atom counts of the
+    input PDB files, the length of the protocol and a throughput model of this machine
+    A predicted ETA for each system is written to 00_drMD_logs/batch_eta_estimates.csv
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+
+    Returns:
+        batchConfig (dict): Batch configuration dictionary with integer CPU settings
+    """
+    hardwareInfo: Dict = batchConfig["hardwareInfo"]
+    logDir: DirectoryPath = p.join(batchConfig["pathInfo"]["outputDir"], "00_drMD_logs")
+    os.makedirs(logDir, exist_ok=True)
+
+    isAuto: bool = "auto" in [hardwareInfo["parallelCPU"], hardwareInfo["subprocessCpus"]]
+    ## the throughput model only describes the CPU platform
+    if hardwareInfo["platform"] != "CPU":
+        if isAuto:
+            drLogger.log_info(f"Automatic CPU allocation is only available on the CPU platform, setting \"auto\" CPU options to 1", True)
+            if hardwareInfo["parallelCPU"] == "auto":
+                hardwareInfo["parallelCPU"] = 1
+            if hardwareInfo["subprocessCpus"] == "auto":
+                hardwareInfo["subprocessCpus"] = 1
+        return batchConfig
+
+    pdbFiles: List[FilePath] = get_pdb_files(batchConfig)
+    if len(pdbFiles) == 0:
+        if isAuto:
+            hardwareInfo["parallelCPU"] = 1 if hardwareInfo["parallelCPU"] == "auto" else hardwareInfo["parallelCPU"]
+            hardwareInfo["subprocessCpus"] = 1 if hardwareInfo["subprocessCpus"] == "auto" else hardwareInfo["subprocessCpus"]
+        return batchConfig
+
+    costDf: pd.DataFrame = estimate_system_costs(pdbFiles, batchConfig)
+    throughputModel: Dict[str, float] = load_throughput_model(logDir)
+
+    if isAuto:
+        availableCpus: int = max(1, mp.cpu_count() - hardwareInfo.get("parallelPrep", 0))
+        parallelCPU, subprocessCpus = choose_cpu_split(costDf, throughputModel, availableCpus,
+                                                        hardwareInfo["parallelCPU"], hardwareInfo["subprocessCpus"])
+        hardwareInfo["parallelCPU"] = parallelCPU
+        hardwareInfo["subprocessCpus"] = subprocessCpus
+        drLogger.log_info(f"Automatic CPU allocation: {parallelCPU} simulations at a time with {subprocessCpus} threads each", True)
+
+    etaDf: pd.DataFrame = predict_batch_schedule(costDf, throughputModel,
+                                                  hardwareInfo["parallelCPU"], hardwareInfo["subprocessCpus"])
+    etaDf.to_csv(p.join(logDir, "batch_eta_estimates.csv"), index=False)
+    return batchConfig
+#####################################################################################
+def choose_cpu_split(costDf: pd.DataFrame,
+                      throughputModel: Dict[str, float],
+                        availableCpus: int,
+                          parallelCPU: object = "auto",
+                            subprocessCpus: object = "auto") -> Tuple[int, int]:
+    """
+    Finds the number of concurrent simulations and threads per simulation
+    that gives the shortest estimated makespan
+    If one of parallelCPU or subprocessCpus is an int, only the other is chosen
+
+    Args:
+        costDf (pd.DataFrame): output of estimate_system_costs
+        throughputModel (Dict[str, float]): output of load_throughput_model
+        availableCpus (int): CPU cores available for simulations
+        parallelCPU (int | "auto"): concurrent simulations
+        subprocessCpus (int | "auto"): threads per simulation
+
+    Returns:
+        parallelCPU (int): chosen number of concurrent simulations
+        subprocessCpus (int): chosen number of threads per simulation
+    """
+    ## if either value is fixed, the other uses the remaining cores
+    ## more threads and more slots never increase the modelled makespan
+    if parallelCPU != "auto":
+        return parallelCPU, max(1, availableCpus // parallelCPU)
+    if subprocessCpus != "auto":
+        return max(1, availableCpus // subprocessCpus), subprocessCpus
+
+    ## there is no point in having more slots than systems
+    bestSplit: Tuple[int, int] = (1, availableCpus)
+    bestMakespan: float = math.inf
+    for nSlots in range(1, min(len(costDf), availableCpus) + 1):
+        nThreads: int = availableCpus // nSlots
+        makespan: float = predict_batch_schedule(costDf, throughputModel, nSlots, nThreads)["predictedFinish"].max()
+        ## only switch for a clear improvement, so ties keep fewer, larger slots
+        if makespan < bestMakespan * 0.99:
+            bestSplit, bestMakespan = (nSlots, nThreads), makespan
+    return bestSplit
+#####################################################################################
+def predict_batch_schedule(costDf: pd.DataFrame,
+                            throughputModel: Dict[str, float],
+                              parallelCPU: int,
+                                subprocessCpus: int) -> pd.DataFrame:
+    """
+    Simulates a batch being run largest system first, each system starting
+    in whichever slot becomes free first, to predict runtimes and finish times
+
+    Args:
+        costDf (pd.DataFrame): output of estimate_system_costs
+        throughputModel (Dict[str, float]): output of load_throughput_model
+        parallelCPU (int): concurrent simulations
+        subprocessCpus (int): threads per simulation
+
+    Returns:
+        etaDf (pd.DataFrame): one row per system with its slot, predicted start, runtime and finish (in seconds)
+    """
+    batchStart: float = time.time()
+    slots: List[Tuple[float, int]] = [(0.0, slotIndex) for slotIndex in range(1, parallelCPU + 1)]
+    heapq.heapify(slots)
+    etaData: List[Dict] = []
+    orderedDf: pd.DataFrame = costDf.sort_values(by=["estimatedCost", "pdbName"], ascending=[False, True])
+    for _, row in orderedDf.iterrows():
+        stepsPerSecond: float = predict_steps_per_second(row["nAtoms"], subprocessCpus, throughputModel)
+        runtime: float = row["nSteps"] / stepsPerSecond
+        startTime, slotIndex = heapq.heappop(slots)
+        heapq.heappush(slots, (startTime + runtime, slotIndex))
+        etaData.append({"pdbName": row["pdbName"],
+                        "nAtoms": row["nAtoms"],
+                        "nSteps": row["nSteps"],
+                        "slot": slotIndex,
+                        "threads": subprocessCpus,
+                        "predictedStart": round(startTime),
+                        "predictedRuntime": round(runtime),
+                        "predictedFinish": round(startTime + runtime),
+                        "eta": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(batchStart + startTime + runtime))})
+    return pd.DataFrame(etaData)
+#####################################################################################
+def predict_steps_per_second(nAtoms: int, threads: int, throughputModel: Dict[str, float]) -> float:
+    """
+    Predicts integration steps per second for a system using Amdahl's law
+    The parallel fraction of a step grows with the size of the system
+
+    Args:
+        nAtoms (int): number of atoms in the input PDB file
+        threads (int): number of CPU threads given to the simulation
+        throughputModel (Dict[str, float]): output of load_throughput_model
+
+    Returns:
+        stepsPerSecond (float): predicted integration steps per second
+    """
+    nAtoms = max(1, nAtoms)
+    parallelFraction: float = nAtoms / (nAtoms + throughputModel["halfParallelAtoms"])
+    speedup: float = 1 / ((1 - parallelFraction) + parallelFraction / threads)
+    return throughputModel["singleThreadRate"] * speedup / nAtoms
+#####################################################################################
+def load_throughput_model(logDir: DirectoryPath) -> Dict[str, float]:
+    """
+    Fits the throughput model to steps measured on the CPU platform in previous runs
+    of this batch, falling back to DEFAULT_THROUGHPUT_MODEL when there are none
+    singleThreadRate is fitted in log space for a range of halfParallelAtoms values,
+    and the pair with the smallest error is kept
+
+    Args:
+        logDir (DirectoryPath): the 00_drMD_logs directory of the batch
+
+    Returns:
+        throughputModel (Dict[str, float]): singleThreadRate and halfParallelAtoms
+    """
+    measurementsCsv: FilePath = p.join(logDir, "throughput_measurements.csv")
+    if not p.isfile(measurementsCsv):
+        return dict(DEFAULT_THROUGHPUT_MODEL)
+    try:
+        measurementsDf: pd.DataFrame = pd.read_csv(measurementsCsv, names=THROUGHPUT_COLUMNS)
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        return dict(DEFAULT_THROUGHPUT_MODEL)
+    measurementsDf = measurementsDf[(measurementsDf["platform"] == "CPU") & (measurementsDf["stepsPerSecond"] > 0)]
+    if len(measurementsDf) == 0:
+        return dict(DEFAULT_THROUGHPUT_MODEL)
+
+    ## halfParallelAtoms can only be fitted if steps were run with different thread counts,
+    ## the default is tried first so that it is kept when the data can't tell the values apart
+    bestModel: Dict[str, float] = dict(DEFAULT_THROUGHPUT_MODEL)
+    bestError: float = math.inf
+    candidateHalfAtoms: List[float] = [DEFAULT_THROUGHPUT_MODEL["halfParallelAtoms"]] + [10 ** (exponent / 4) for exponent in range(8, 21)]
+    for halfParallelAtoms in candidateHalfAtoms:
+        logRates: List[float] = []
+        logSpeedups: List[float] = []
+        for _, row in measurementsDf.iterrows():
+            unitModel: Dict[str, float] = {"singleThreadRate": 1.0, "halfParallelAtoms": halfParallelAtoms}
+            logSpeedups.append(math.log(predict_steps_per_second(row["nAtoms"], row["threads"], unitModel) * max(1, row["nAtoms"])))
+            logRates.append(math.log(row["stepsPerSecond"] * max(1, row["nAtoms"])))
+        logSingleThreadRate: float = sum([rate - speedup for rate, speedup in zip(logRates, logSpeedups)]) / len(logRates)
+        error: float = sum([(rate - speedup - logSingleThreadRate) ** 2 for rate, speedup in zip(logRates, logSpeedups)])
+        if error < bestError - 1e-9:
+            bestError = error
+            bestModel = {"singleThreadRate": math.exp(logSingleThreadRate), "halfParallelAtoms": halfParallelAtoms}
+    return bestModel
+#####################################################################################
+def record_step_throughput(config: Dict, sim: Dict, simDir: DirectoryPath, threads: int) -> None:
+    """
+    Appends the measured speed of a finished MD step to 00_drMD_logs/throughput_measurements.csv
+    These measurements calibrate the throughput model used by plan_hardware
+    Lines are appended without a header, so several simulations can write to the file at once
+
+    Args:
+        config (dict): per-system config dictionary
+        sim (dict): the simulation step that has just finished
+        simDir (DirectoryPath): output directory of the step
+        threads (int): CPU threads the step ran on, which elasticThreads, pinCpus and branches can make
+                        different from subprocessCpus, see drSim.pop_step_threads
+    """
+    if sim.get("simulationType", "NPT").upper() == "EM":
+        return
+    ## the progress report may already have been moved by a checkup
+    progressCsv: FilePath = p.join(simDir, "progress_report.csv")
+    if not p.isfile(progressCsv):
+        progressCsv = p.join(simDir, "00_reporters_and_plots", "progress_report.csv")
+    try:
+        progressDf: pd.DataFrame = pd.read_csv(progressCsv)
+        speedNsPerDay: float = float(progressDf["Speed (ns/day)"].mean())
+    except (FileNotFoundError, KeyError, ValueError, pd.errors.EmptyDataError):
+        return
+    if not speedNsPerDay > 0:
+        return
+
+    timestep: float = convert_time_to_femtoseconds(sim.get("timestep", "2 fs"))
+    stepsPerSecond: float = speedNsPerDay * 1e6 / timestep / 86400
+    inputPdb: FilePath = config["pathInfo"]["inputPdb"]
+    measurement: List[str] = [config["hardwareInfo"]["platform"],
+                              p.splitext(p.basename(inputPdb))[0],
+                              sim["stepName"],
+                              str(count_atoms(inputPdb)),
+                              str(threads),
+                              f"{stepsPerSecond:.4f}"]
+    logDir: DirectoryPath = p.join(p.dirname(config["pathInfo"]["outputDir"]), "00_drMD_logs")
+    os.makedirs(logDir, exist_ok=True)
+    with open(p.join(logDir, "throughput_measurements.csv"), "a") as f:
+        f.write(",".join(measurement) + "\n")
+#####################################################################################
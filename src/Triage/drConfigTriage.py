@@ -1,15 +1,18 @@
 ## BASIC PYTHON LIBRARIES
 import argpass
+from argparse import Namespace
 import yaml
 import os
 from os import path as p
 from pathlib import Path
+import copy
+import hashlib
 ## PARALLELISATION LIBRARIES
 import multiprocessing as mp
 
 ## drMD LIBRARIES
 from ExaminationRoom import drLogger
-from UtilitiesCloset import drSplash
+from UtilitiesCloset import drSplash, drMemoryModel, drWallClock, drListInitiator
 
 ## PDB // DATAFRAME UTILS
 from pdbUtils import pdbUtils
@@ -57,11 +60,15 @@ def validate_config(config: dict) -> FilePath:
     config, configDisorders["simulationInfo"], simulationInfoOk = check_simulationInfo(config)
 
     configDisorders["aftercareInfo"], aftercareInfoOk  = check_aftercareInfo(config)
+
+    config, configDisorders["screeningInfo"], screeningInfoOk = check_screeningInfo(config)
+
+    config, configDisorders["mutantInfo"], mutantInfoOk = check_mutantInfo(config)
   
     configDisorders["ligandInfo"], ligandInfoOk  = check_ligandInfo(config)
                 
 
-    allInfoOk = miscInfoOk * pathInfoOk * hardwareInfoOk * simulationInfoOk * aftercareInfoOk * ligandInfoOk
+    allInfoOk = miscInfoOk * pathInfoOk * hardwareInfoOk * simulationInfoOk * aftercareInfoOk * screeningInfoOk * mutantInfoOk * ligandInfoOk
 
     ## TODO: write configDisorders to file in all cases
     if allInfoOk:
@@ -80,12 +87,26 @@ def init_config_defaults(topDir: DirectoryPath) -> dict:
         "hardwareInfo": {
             "parallelCPU": 1,
             "platform": "CPU",
-            "subprocessCpus": 1
+            "subprocessCpus": 1,
+            "claimTimeout": 600,
+            "parallelPrep": 0,
+            "checkupCpus": 1,
+            "elasticThreads": False,
+            "pinCpus": False,
+            "governorCpus": 0,
+            "toolLimits": {},
+            "memoryLimit": None,
+            "wallTimeBudget": None,
+            "parallelBranches": 1,
+            "memoStoreDir": None,
+            "memoStoreSize": "50 GB"
         },
 
         "miscInfo": {   
             "pH": 7,
             "firstAidMaxRetries": 10,
+            "workerCrashRetries": 2,
+            "stallTolerance": 0,
             "boxGeometry": "cubic",
             "boxSize": 10,
             "writeMyMethodsSection": True,
@@ -173,7 +194,7 @@ def check_hardwareInfo(config: dict, configDefaults: dict) -> Tuple[dict, dict,
     hardwareInfo = config.get("hardwareInfo", None)
     if hardwareInfo is None:
         config["hardwareInfo"] = configDefaults["hardwareInfo"]
-        for argName in ["parallelCPU", "platform", "subprocessCpus"]:
+        for argName in ["parallelCPU", "platform", "subprocessCpus", "claimTimeout", "parallelPrep", "checkupCpus", "elasticThreads", "pinCpus", "governorCpus", "toolLimits", "memoryLimit", "wallTimeBudget", "parallelBranches", "memoStoreDir", "memoStoreSize"]:
             config["hardwareInfo"][argName] = configDefaults["hardwareInfo"][argName]
             hardwareInfoDisorders[argName] = "Automatic Default Used!"
         return config, hardwareInfoDisorders, True
@@ -184,9 +205,12 @@ def check_hardwareInfo(config: dict, configDefaults: dict) -> Tuple[dict, dict,
         ## use a default value
         config["hardwareInfo"]["parallelCPU"] = configDefaults["hardwareInfo"]["parallelCPU"]
         hardwareInfoDisorders["parallelCPU"] = "Automatic Default Used!"
+    elif parallelCPU == "auto":
+        ## chosen by drBatchPlanner.plan_hardware once the batch has been read
+        hardwareInfoDisorders["parallelCPU"] = None
     else:
         if not isinstance(parallelCPU, int):
-            hardwareInfoDisorders["parallelCPU"] = "parallelCPU is not an int"
+            hardwareInfoDisorders["parallelCPU"] = "parallelCPU is not an int or \"auto\""
             haredwareInfoOk = False
         else:
             if parallelCPU < 1:
@@ -202,9 +226,12 @@ def check_hardwareInfo(config: dict, configDefaults: dict) -> Tuple[dict, dict,
         # use a default value
         config["hardwareInfo"]["subprocessCpus"] = configDefaults["hardwareInfo"]["subprocessCpus"]
         hardwareInfoDisorders["subprocessCpus"] = "Automatic Default Used!"
+    elif subprocessCpus == "auto":
+        ## chosen by drBatchPlanner.plan_hardware once the batch has been read
+        hardwareInfoDisorders["subprocessCpus"] = None
     else:
         if not isinstance(subprocessCpus, int):
-            hardwareInfoDisorders["subprocessCpus"] = "subprocessCpus is not an int"
+            hardwareInfoDisorders["subprocessCpus"] = "subprocessCpus is not an int or \"auto\""
             haredwareInfoOk = False
         else:
             if subprocessCpus < 1:
@@ -213,11 +240,28 @@ def check_hardwareInfo(config: dict, configDefaults: dict) -> Tuple[dict, dict,
             else:
                 hardwareInfoDisorders["subprocessCpus"] = None
 
+    ## validate parallelPrep
+    parallelPrep = hardwareInfo.get("parallelPrep", None)
+    if parallelPrep is None:
+        ## use a default value
+        config["hardwareInfo"]["parallelPrep"] = configDefaults["hardwareInfo"]["parallelPrep"]
+        hardwareInfoDisorders["parallelPrep"] = "Automatic Default Used!"
+        parallelPrep = 0
+    else:
+        if not isinstance(parallelPrep, int) or isinstance(parallelPrep, bool) or parallelPrep < 0:
+            hardwareInfoDisorders["parallelPrep"] = "parallelPrep must be zero or a positive integer"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["parallelPrep"] = None
+
     ## check to see if the number of CPU cores requested is less than the number of CPU cores available
-    if isinstance(parallelCPU,int) and isinstance(subprocessCpus,int):
+    ## values set to "auto" will use at least one CPU core each
+    minParallelCPU = 1 if parallelCPU == "auto" else parallelCPU
+    minSubprocessCpus = 1 if subprocessCpus == "auto" else subprocessCpus
+    if isinstance(minParallelCPU,int) and isinstance(minSubprocessCpus,int) and isinstance(parallelPrep, int):
         systemCpus = mp.cpu_count()
-        if parallelCPU * subprocessCpus > systemCpus:
-            hardwareInfoDisorders["totalCpuUseage"] = "Number for CPU cores requested exceeds number of CPU cores available, change the values of parallelCPU and subprocessCpus"
+        if minParallelCPU * minSubprocessCpus + parallelPrep > systemCpus:
+            hardwareInfoDisorders["totalCpuUseage"] = "Number for CPU cores requested exceeds number of CPU cores available, change the values of parallelCPU, subprocessCpus and parallelPrep"
             haredwareInfoOk = False
     ## validate platform
     platform = hardwareInfo.get("platform", None)
@@ -232,6 +276,157 @@ def check_hardwareInfo(config: dict, configDefaults: dict) -> Tuple[dict, dict,
         else:
             hardwareInfoDisorders["platform"] = None
 
+    ## validate claimTimeout
+    claimTimeout = hardwareInfo.get("claimTimeout", None)
+    if claimTimeout is None:
+        ## use a default value
+        config["hardwareInfo"]["claimTimeout"] = configDefaults["hardwareInfo"]["claimTimeout"]
+        hardwareInfoDisorders["claimTimeout"] = "Automatic Default Used!"
+    else:
+        if not isinstance(claimTimeout, int) or claimTimeout < 1:
+            hardwareInfoDisorders["claimTimeout"] = "claimTimeout must be a positive integer number of seconds"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["claimTimeout"] = None
+
+    ## validate checkupCpus
+    checkupCpus = hardwareInfo.get("checkupCpus", None)
+    if checkupCpus is None:
+        ## use a default value
+        config["hardwareInfo"]["checkupCpus"] = configDefaults["hardwareInfo"]["checkupCpus"]
+        hardwareInfoDisorders["checkupCpus"] = "Automatic Default Used!"
+    else:
+        if not isinstance(checkupCpus, int) or isinstance(checkupCpus, bool) or checkupCpus < 0:
+            hardwareInfoDisorders["checkupCpus"] = "checkupCpus must be zero or a positive integer"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["checkupCpus"] = None
+
+    ## validate elasticThreads
+    elasticThreads = hardwareInfo.get("elasticThreads", None)
+    if elasticThreads is None:
+        ## use a default value
+        config["hardwareInfo"]["elasticThreads"] = configDefaults["hardwareInfo"]["elasticThreads"]
+        hardwareInfoDisorders["elasticThreads"] = "Automatic Default Used!"
+    else:
+        if not isinstance(elasticThreads, bool):
+            hardwareInfoDisorders["elasticThreads"] = "elasticThreads must be either True or False"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["elasticThreads"] = None
+
+    ## validate pinCpus
+    pinCpus = hardwareInfo.get("pinCpus", None)
+    if pinCpus is None:
+        ## use a default value
+        config["hardwareInfo"]["pinCpus"] = configDefaults["hardwareInfo"]["pinCpus"]
+        hardwareInfoDisorders["pinCpus"] = "Automatic Default Used!"
+    else:
+        if not isinstance(pinCpus, bool):
+            hardwareInfoDisorders["pinCpus"] = "pinCpus must be either True or False"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["pinCpus"] = None
+
+    ## validate governorCpus
+    governorCpus = hardwareInfo.get("governorCpus", None)
+    if governorCpus is None:
+        ## use a default value
+        config["hardwareInfo"]["governorCpus"] = configDefaults["hardwareInfo"]["governorCpus"]
+        hardwareInfoDisorders["governorCpus"] = "Automatic Default Used!"
+    else:
+        if not isinstance(governorCpus, int) or isinstance(governorCpus, bool) or governorCpus < 0:
+            hardwareInfoDisorders["governorCpus"] = "governorCpus must be zero or a positive integer"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["governorCpus"] = None
+
+    ## validate toolLimits
+    toolLimits = hardwareInfo.get("toolLimits", None)
+    if toolLimits is None:
+        ## use a default value
+        config["hardwareInfo"]["toolLimits"] = configDefaults["hardwareInfo"]["toolLimits"]
+        hardwareInfoDisorders["toolLimits"] = "Automatic Default Used!"
+    else:
+        if not isinstance(toolLimits, dict):
+            hardwareInfoDisorders["toolLimits"] = "toolLimits must be a dictionary of tool names and positive integers"
+            haredwareInfoOk = False
+        elif not all([isinstance(limit, int) and not isinstance(limit, bool) and limit > 0 for limit in toolLimits.values()]):
+            hardwareInfoDisorders["toolLimits"] = "Each value in toolLimits must be a positive integer"
+            haredwareInfoOk = False
+        else:
+            hardwareInfoDisorders["toolLimits"] = None
+
+    ## validate memoryLimit
+    memoryLimit = hardwareInfo.get("memoryLimit", None)
+    if memoryLimit is None:
+        ## use a default value
+        config["hardwareInfo"]["memoryLimit"] = configDefaults["hardwareInfo"]["memoryLimit"]
+        hardwareInfoDisorders["memoryLimit"] = "Automatic Default Used!"
+    else:
+        try:
+            if drMemoryModel.parse_memory(memoryLimit) <= 0:
+                raise ValueError
+            hardwareInfoDisorders["memoryLimit"] = None
+        except ValueError:
+            hardwareInfoDisorders["memoryLimit"] = "memoryLimit must be a positive amount of memory, eg. \"64 GB\""
+            haredwareInfoOk = False
+
+    ## validate wallTimeBudget
+    wallTimeBudget = hardwareInfo.get("wallTimeBudget", None)
+    if wallTimeBudget is None:
+        ## use a default value
+        config["hardwareInfo"]["wallTimeBudget"] = configDefaults["hardwareInfo"]["wallTimeBudget"]
+        hardwareInfoDisorders["wallTimeBudget"] = "Automatic Default Used!"
+    else:
+        try:
+            if drWallClock.parse_wall_time(wallTimeBudget) <= drWallClock.SAFETY_MARGIN:
+                raise ValueError
+            hardwareInfoDisorders["wallTimeBudget"] = None
+        except ValueError:
+            hardwareInfoDisorders["wallTimeBudget"] = f"wallTimeBudget must be a time longer than {drWallClock.SAFETY_MARGIN:.0f} s, eg. \"23:30:00\" or \"12 h\""
+            haredwareInfoOk = False
+
+    ## validate parallelBranches
+    parallelBranches = hardwareInfo.get("parallelBranches", None)
+    if parallelBranches is None:
+        ## use a default value
+        config["hardwareInfo"]["parallelBranches"] = configDefaults["hardwareInfo"]["parallelBranches"]
+        hardwareInfoDisorders["parallelBranches"] = "Automatic Default Used!"
+    elif not isinstance(parallelBranches, int) or isinstance(parallelBranches, bool) or parallelBranches < 1:
+        hardwareInfoDisorders["parallelBranches"] = "parallelBranches must be an int of 1 or more"
+        haredwareInfoOk = False
+    else:
+        hardwareInfoDisorders["parallelBranches"] = None
+
+    ## validate memoStoreDir
+    memoStoreDir = hardwareInfo.get("memoStoreDir", None)
+    if memoStoreDir is None:
+        ## use a default value
+        config["hardwareInfo"]["memoStoreDir"] = configDefaults["hardwareInfo"]["memoStoreDir"]
+        hardwareInfoDisorders["memoStoreDir"] = "Automatic Default Used!"
+    elif not isinstance(memoStoreDir, str):
+        hardwareInfoDisorders["memoStoreDir"] = "memoStoreDir must be a path to a directory"
+        haredwareInfoOk = False
+    else:
+        ## per-system configs are read from their own run directories, so the store path must be absolute
+        config["hardwareInfo"]["memoStoreDir"] = p.abspath(memoStoreDir)
+        hardwareInfoDisorders["memoStoreDir"] = None
+
+    ## validate memoStoreSize
+    memoStoreSize = hardwareInfo.get("memoStoreSize", None)
+    if memoStoreSize is None:
+        ## use a default value
+        config["hardwareInfo"]["memoStoreSize"] = configDefaults["hardwareInfo"]["memoStoreSize"]
+        hardwareInfoDisorders["memoStoreSize"] = "Automatic Default Used!"
+    else:
+        try:
+            if drMemoryModel.parse_memory(memoStoreSize) <= 0:
+                raise ValueError
+            hardwareInfoDisorders["memoStoreSize"] = None
+        except ValueError:
+            hardwareInfoDisorders["memoStoreSize"] = "memoStoreSize must be a positive amount of disk space, eg. \"50 GB\""
+            haredwareInfoOk = False
 
     return config, hardwareInfoDisorders, haredwareInfoOk
 
@@ -248,6 +443,8 @@ def check_miscInfo(config:dict, configDefaults:dict) -> Tuple[dict,dict,bool]:
         config["miscInfo"] = configDefaults["miscInfo"]
         for argName in ["pH",
                          "firstAidMaxRetries",
+                          "workerCrashRetries",
+                          "stallTolerance",
                            "boxGeometry",
                              "writeMyMethodsSection",
                                "skipPdbTriage",
@@ -290,6 +487,32 @@ def check_miscInfo(config:dict, configDefaults:dict) -> Tuple[dict,dict,bool]:
             else:
                 miscInfoDisorders["firstAidMaxRetries"] = None
 
+    ## validate workerCrashRetries
+    workerCrashRetries = miscInfo.get("workerCrashRetries", None)
+    if workerCrashRetries is None:
+        ## use a default value
+        config["miscInfo"]["workerCrashRetries"] = configDefaults["miscInfo"]["workerCrashRetries"]
+        miscInfoDisorders["workerCrashRetries"] = "No workerCrashRetries specified, using default of 2"
+    else:
+        if not isinstance(workerCrashRetries, int) or isinstance(workerCrashRetries, bool) or workerCrashRetries < 0:
+            miscInfoDisorders["workerCrashRetries"] = "workerCrashRetries must be an int greater than or equal to 0"
+            miscInfoOk = False
+        else:
+            miscInfoDisorders["workerCrashRetries"] = None
+
+    ## validate stallTolerance
+    stallTolerance = miscInfo.get("stallTolerance", None)
+    if stallTolerance is None:
+        ## use a default value
+        config["miscInfo"]["stallTolerance"] = configDefaults["miscInfo"]["stallTolerance"]
+        miscInfoDisorders["stallTolerance"] = "No stallTolerance specified, using default of 0 (stall detection off)"
+    else:
+        if not isinstance(stallTolerance, (int, float)) or isinstance(stallTolerance, bool) or stallTolerance < 0:
+            miscInfoDisorders["stallTolerance"] = "stallTolerance must be a number greater than or equal to 0"
+            miscInfoOk = False
+        else:
+            miscInfoDisorders["stallTolerance"] = None
+
     ## validate boxGeometry
     boxGeometry = miscInfo.get("boxGeometry", None)
     if boxGeometry is None:
@@ -387,6 +610,8 @@ def check_simulationInfo(config: dict) -> Tuple[dict, bool]:
     
 
     simulationInfoDisorders = {}
+    seenStepNames = []
+    replicatedStepNames = []
     for counter, simulation in enumerate(simulationInfo):
 
         disorders = {}
@@ -416,6 +641,36 @@ def check_simulationInfo(config: dict) -> Tuple[dict, bool]:
         if restraintsInfo:
             disorders, restraintInfoOk = check_restraintInfo(restraintsInfo, disorders)
             allStepsOk *= restraintInfoOk
+
+        ## startFrom must name an earlier step, so that steps can always be run in the order they are listed
+        startFrom = simulation.get("startFrom", None)
+        if startFrom is not None:
+            if startFrom not in seenStepNames:
+                disorders["startFrom"] = "startFrom must be the stepName of an earlier step"
+                allStepsOk = False
+            else:
+                disorders["startFrom"] = None
+        ## replicas can't be nested, a step that is already run once per replica can't fan out again
+        parentName = startFrom if startFrom is not None else (seenStepNames[-1] if len(seenStepNames) > 0 else None)
+        replicas = simulation.get("replicas", None)
+        if replicas is not None:
+            if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 1:
+                disorders["replicas"] = "replicas must be an int of at least 1"
+                allStepsOk = False
+            elif parentName is None:
+                disorders["replicas"] = "replicas can't be set on the first step, replicas start from a shared step"
+                allStepsOk = False
+            elif parentName in replicatedStepNames:
+                disorders["replicas"] = f"replicas can't be set on a step that starts from a replicated step ({parentName})"
+                allStepsOk = False
+            else:
+                disorders["replicas"] = None
+        if (isinstance(replicas, int) and replicas > 1) or parentName in replicatedStepNames:
+            replicatedStepNames.append(stepName)
+        if stepName in seenStepNames:
+            disorders["stepName"] = "stepName must be unique"
+            allStepsOk = False
+        seenStepNames.append(stepName)
         simulationInfoDisorders[stepName] = disorders
 
         simulationInfoOk *= allStepsOk
@@ -425,6 +680,48 @@ def check_simulationInfo(config: dict) -> Tuple[dict, bool]:
 
     return config, simulationInfoDisorders, simulationInfoOk
 
+#################################################################################################
+def expand_replicas(simulationInfo: List[Dict], protName: str) -> List[Dict]:
+    """
+    Replaces each step that has replicas (and every step that starts from it) with one copy per replica
+    Copies are named <stepName>_rep<N> and start from the shared step, or from the same replica of their parent
+    Each copy is given its own random seed, made from the system and step names so that it is the same every run
+
+    Args:
+        simulationInfo (List[Dict]): validated simulationInfo of a system
+        protName (str): name of the system, used to make the seeds
+
+    Returns:
+        expandedSimulationInfo (List[Dict]): simulationInfo with one entry per replica of each replicated step
+    """
+    expandedSimulationInfo: List[Dict] = []
+    ## number of replicas of each step, 1 for steps that are run once
+    replicaCounts: Dict[str, int] = {}
+    previousStepName = None
+    for sim in simulationInfo:
+        stepName: str = sim["stepName"]
+        parentName = sim.get("startFrom", previousStepName)
+        previousStepName = stepName
+        parentReplicas: int = replicaCounts.get(parentName, 1)
+        nReplicas: int = sim.get("replicas", parentReplicas)
+        replicaCounts[stepName] = nReplicas
+        sim = {key: value for key, value in sim.items() if key != "replicas"}
+        if nReplicas == 1:
+            expandedSimulationInfo.append(sim)
+            continue
+        for replica in range(1, nReplicas + 1):
+            replicaSim: Dict = copy.deepcopy(sim)
+            replicaSim["stepName"] = f"{stepName}_rep{replica}"
+            replicaSim["startFrom"] = f"{parentName}_rep{replica}" if parentReplicas > 1 else parentName
+            replicaSim["replica"] = replica
+            ## OpenMM treats a seed of 0 as "pick one at random"
+            seedText: str = f"{protName}/{replicaSim['stepName']}"
+            replicaSim["replicaSeed"] = int(hashlib.sha256(seedText.encode()).hexdigest(), 16) % (2 ** 31 - 1) + 1
+            ## only the first step of each replica draws new velocities, later steps carry on from it
+            replicaSim["replicaStart"] = parentReplicas == 1
+            expandedSimulationInfo.append(replicaSim)
+    return expandedSimulationInfo
+
 #################################################################################################
 def check_em_options(simulation: dict,disorders: dict) -> Tuple[dict, bool]:
     emOptionsOk = True
@@ -529,6 +826,11 @@ def check_aftercareInfo(config: dict) -> Tuple[dict,bool]:
         aftercareInfoDisorders["clusterInfo"], clusterInfoOk = check_clusterInfo(clusterInfo)
         aftercareInfoOk *= clusterInfoOk 
 
+    adaptiveSamplingInfo = aftercareInfo.get("adaptiveSamplingInfo", None)
+    if adaptiveSamplingInfo is not None:
+        aftercareInfoDisorders["adaptiveSamplingInfo"], adaptiveSamplingInfoOk = check_adaptiveSamplingInfo(adaptiveSamplingInfo, config["simulationInfo"])
+        aftercareInfoOk *= adaptiveSamplingInfoOk
+
 
     collateVitalsReports = aftercareInfo.get("collateVitalsReports", None)
     if collateVitalsReports is not None:
@@ -540,6 +842,196 @@ def check_aftercareInfo(config: dict) -> Tuple[dict,bool]:
 
 
 
+#####################################################################################
+def check_adaptiveSamplingInfo(adaptiveSamplingInfo: dict, simulationInfo: list) -> Tuple[dict, bool]:
+    """
+    Checks for adaptiveSamplingInfo in aftercareInfo
+    Applies defaults for nRounds, nSeeds, nClusters, duration and clusterBy
+    """
+    adaptiveSamplingInfoOk = True
+    adaptiveSamplingDisorders = {}
+    if not isinstance(adaptiveSamplingInfo, dict):
+        return "adaptiveSamplingInfo must be a dictionary", False
+
+    ## new simulations use the settings of the first step in stepNames, so they must be NVT or NPT steps
+    mdStepNames = [simulation.get("stepName", None) for simulation in simulationInfo
+                    if str(simulation.get("simulationType", "NPT")).upper() in ["NVT", "NPT"]]
+    stepNames = adaptiveSamplingInfo.get("stepNames", None)
+    if stepNames is None:
+        adaptiveSamplingDisorders["stepNames"] = "adaptiveSamplingInfo must have a 'stepNames' entry"
+        adaptiveSamplingInfoOk = False
+    elif not isinstance(stepNames, list) or len(stepNames) == 0:
+        adaptiveSamplingDisorders["stepNames"] = "adaptiveSamplingInfo['stepNames'] must be a list of at least one stepName"
+        adaptiveSamplingInfoOk = False
+    elif not all(stepName in mdStepNames for stepName in stepNames):
+        adaptiveSamplingDisorders["stepNames"] = "each entry in adaptiveSamplingInfo['stepNames'] must be the stepName of an NVT or NPT step in simulationInfo"
+        adaptiveSamplingInfoOk = False
+    else:
+        adaptiveSamplingDisorders["stepNames"] = None
+
+    ## check the counts, using defaults for any that are missing
+    for argName, defaultValue, minValue in [("nRounds", 3, 1), ("nSeeds", 4, 1), ("nClusters", 10, 2)]:
+        argValue = adaptiveSamplingInfo.get(argName, None)
+        if argValue is None:
+            adaptiveSamplingInfo[argName] = defaultValue
+            adaptiveSamplingDisorders[argName] = f"No {argName} specified in adaptiveSamplingInfo, using {defaultValue} as default"
+        elif not isinstance(argValue, int) or isinstance(argValue, bool) or argValue < minValue:
+            adaptiveSamplingDisorders[argName] = f"{argName} must be an int of at least {minValue}"
+            adaptiveSamplingInfoOk = False
+        else:
+            adaptiveSamplingDisorders[argName] = None
+
+    duration = adaptiveSamplingInfo.get("duration", None)
+    if duration is None:
+        adaptiveSamplingInfo["duration"] = "1 ns"
+        adaptiveSamplingDisorders["duration"] = "No duration specified in adaptiveSamplingInfo, using 1 ns as default"
+    else:
+        adaptiveSamplingDisorders["duration"] = check_time_input(duration, "duration", "adaptiveSamplingInfo")
+        if adaptiveSamplingDisorders["duration"] is not None:
+            adaptiveSamplingInfoOk = False
+
+    clusterBy = adaptiveSamplingInfo.get("clusterBy", None)
+    if clusterBy is None:
+        adaptiveSamplingInfo["clusterBy"] = [{"selection": {"keyword": "backbone"}}]
+        adaptiveSamplingDisorders["clusterBy"] = "No clusterBy specified in adaptiveSamplingInfo, clustering on the backbone"
+    elif not isinstance(clusterBy, list) or len(clusterBy) == 0 or not all(isinstance(clusterSelection, dict) for clusterSelection in clusterBy):
+        adaptiveSamplingDisorders["clusterBy"] = "clusterBy must be a list of selections"
+        adaptiveSamplingInfoOk = False
+    else:
+        adaptiveSamplingDisorders["clusterBy"] = None
+        for clusterSelection in clusterBy:
+            clusterSelectionDisorders = check_selection(clusterSelection)
+            if len(clusterSelectionDisorders) > 0:
+                adaptiveSamplingDisorders["clusterBy"] = clusterSelectionDisorders
+                adaptiveSamplingInfoOk = False
+
+    return adaptiveSamplingDisorders, adaptiveSamplingInfoOk
+#####################################################################################
+def check_screeningInfo(config: dict) -> Tuple[dict, dict, bool]:
+    """
+    Checks for screeningInfo in config
+    Each step in screeningInfo.stepNames ends a round of screening, so they must be MD steps in simulationInfo, in order
+    """
+    screeningInfoOk = True
+    screeningInfoDisorders = {}
+    screeningInfo = config.get("screeningInfo", None)
+    if screeningInfo is None:
+        return config, None, screeningInfoOk
+    if not isinstance(screeningInfo, dict):
+        return config, "screeningInfo must be a dictionary", False
+
+    ## only steps that write a trajectory can be scored
+    mdStepNames = [simulation.get("stepName", None) for simulation in config["simulationInfo"]
+                    if str(simulation.get("simulationType", "NPT")).upper() != "EM"]
+    stepNames = screeningInfo.get("stepNames", None)
+    if stepNames is None:
+        screeningInfoDisorders["stepNames"] = "screeningInfo must have a 'stepNames' entry"
+        screeningInfoOk = False
+    elif not isinstance(stepNames, list) or len(stepNames) == 0:
+        screeningInfoDisorders["stepNames"] = "screeningInfo['stepNames'] must be a list of at least one stepName"
+        screeningInfoOk = False
+    elif not all(stepName in mdStepNames for stepName in stepNames):
+        screeningInfoDisorders["stepNames"] = "each entry in screeningInfo['stepNames'] must be the stepName of an NVT, NPT or META step in simulationInfo"
+        screeningInfoOk = False
+    elif [mdStepNames.index(stepName) for stepName in stepNames] != sorted(set([mdStepNames.index(stepName) for stepName in stepNames])):
+        screeningInfoDisorders["stepNames"] = "screeningInfo['stepNames'] must be in the same order as simulationInfo, with no repeats"
+        screeningInfoOk = False
+    else:
+        screeningInfoDisorders["stepNames"] = None
+
+    keepFraction = screeningInfo.get("keepFraction", None)
+    if keepFraction is None:
+        screeningInfo["keepFraction"] = 0.5
+        screeningInfoDisorders["keepFraction"] = "No keepFraction specified in screeningInfo, using 0.5 as default"
+    elif not isinstance(keepFraction, (int, float)) or isinstance(keepFraction, bool) or not 0 < keepFraction < 1:
+        screeningInfoDisorders["keepFraction"] = "keepFraction must be a number between 0 and 1"
+        screeningInfoOk = False
+    else:
+        screeningInfoDisorders["keepFraction"] = None
+
+    config["screeningInfo"] = screeningInfo
+    return config, screeningInfoDisorders, screeningInfoOk
+#####################################################################################
+def check_mutantInfo(config: dict) -> Tuple[dict, dict, bool]:
+    """
+    Checks for mutantInfo in config
+    Mutants are built from the end of the fromStep of the wild type, so fromStep must be an NVT or NPT step
+    that is run once (not a replica), and each mutation must be written as CHAIN:RES_ID:RES_NAME
+    """
+    mutantInfoOk = True
+    mutantInfoDisorders = {}
+    mutantInfo = config.get("mutantInfo", None)
+    if mutantInfo is None:
+        return config, None, mutantInfoOk
+    if not isinstance(mutantInfo, dict):
+        return config, "mutantInfo must be a dictionary", False
+    if config.get("screeningInfo", None) is not None:
+        return config, "mutantInfo and screeningInfo can't be used in the same batch", False
+
+    wildType = mutantInfo.get("wildType", None)
+    if wildType is None:
+        mutantInfoDisorders["wildType"] = "mutantInfo must have a 'wildType' entry"
+        mutantInfoOk = False
+    elif not isinstance(wildType, str) or not p.isfile(p.join(config["pathInfo"]["inputDir"], f"{wildType}.pdb")):
+        mutantInfoDisorders["wildType"] = "wildType must be the name of a PDB file in inputDir, without the .pdb extension"
+        mutantInfoOk = False
+    else:
+        mutantInfoDisorders["wildType"] = None
+
+    ## steps that are replicas, or that start from a replica, have no single endpoint to build mutants from
+    replicatedStepNames = set()
+    previousStepName = None
+    for simulation in config["simulationInfo"]:
+        parentName = simulation.get("startFrom", previousStepName)
+        previousStepName = simulation.get("stepName", None)
+        if simulation.get("replicas", 1) != 1 or parentName in replicatedStepNames:
+            replicatedStepNames.add(previousStepName)
+    mdStepNames = [simulation.get("stepName", None) for simulation in config["simulationInfo"]
+                    if str(simulation.get("simulationType", "NPT")).upper() in ["NVT", "NPT"]]
+    fromStep = mutantInfo.get("fromStep", None)
+    if fromStep is None:
+        mutantInfoDisorders["fromStep"] = "mutantInfo must have a 'fromStep' entry"
+        mutantInfoOk = False
+    elif not fromStep in mdStepNames:
+        mutantInfoDisorders["fromStep"] = "fromStep must be the stepName of an NVT or NPT step in simulationInfo"
+        mutantInfoOk = False
+    elif fromStep in replicatedStepNames:
+        mutantInfoDisorders["fromStep"] = "fromStep can't have replicas, or start from a step with replicas"
+        mutantInfoOk = False
+    else:
+        mutantInfoDisorders["fromStep"] = None
+
+    mutations = mutantInfo.get("mutations", None)
+    aminoAcidNames = drListInitiator.get_amino_acid_residue_names()
+    if mutations is None:
+        mutantInfoDisorders["mutations"] = "mutantInfo must have a 'mutations' entry"
+        mutantInfoOk = False
+    elif not isinstance(mutations, list) or len(mutations) == 0:
+        mutantInfoDisorders["mutations"] = "mutations must be a list of at least one mutant"
+        mutantInfoOk = False
+    else:
+        mutantInfoDisorders["mutations"] = None
+        for mutant in mutations:
+            mutationParts = [mutation.split(":") for mutation in str(mutant).split("+")]
+            if not all([len(mutationPart) == 3 and mutationPart[1].lstrip("-").isdigit() and mutationPart[2] in aminoAcidNames
+                         for mutationPart in mutationParts]):
+                mutantInfoDisorders["mutations"] = f"{mutant} is not a valid mutant, write each mutation as CHAIN:RES_ID:RES_NAME (eg. A:45:ALA), joined by + for multiple mutations"
+                mutantInfoOk = False
+        if len(set([str(mutant) for mutant in mutations])) != len(mutations):
+            mutantInfoDisorders["mutations"] = "each mutant must only be listed once in mutations"
+            mutantInfoOk = False
+
+    relaxDuration = mutantInfo.get("relaxDuration", None)
+    if relaxDuration is None:
+        mutantInfo["relaxDuration"] = "100 ps"
+        mutantInfoDisorders["relaxDuration"] = "No relaxDuration specified in mutantInfo, using 100 ps as default"
+    else:
+        mutantInfoDisorders["relaxDuration"] = check_time_input(relaxDuration, "relaxDuration", "mutantInfo")
+        if mutantInfoDisorders["relaxDuration"] is not None:
+            mutantInfoOk = False
+
+    config["mutantInfo"] = mutantInfo
+    return config, mutantInfoDisorders, mutantInfoOk
 #####################################################################################
 def check_endPointInfo(endPointInfo: dict) -> Tuple[dict, bool]:
     """
@@ -1164,14 +1656,29 @@ def get_config_input_arg() -> FilePath:
     Returns:
     - configFile (FilePath)
     """
+    args = get_command_line_args()
+
+    configFile: FilePath = args.config
+
+    return configFile
+#####################################################################################
+def get_command_line_args() -> Namespace:
+    """
+    Sets up argpass to read command line arguments
+        --config    path to the batch config.yaml file
+        --worker    claim systems through lock files so that several drMD
+                    processes (on one or many nodes) can share one batch
+
+    Returns:
+    - args (Namespace)
+    """
     # create an argpass parser, read config file,
     parser = argpass.ArgumentParser()
     parser.add_argument(f"--config")
+    parser.add_argument(f"--worker", action="store_true")
     args = parser.parse_args()
 
-    configFile: FilePath = args.config
-
-    return configFile
+    return args
 #####################################################################################
 
 def read_input_yaml(configFile: FilePath) -> dict:
@@ -6,7 +6,7 @@ import yaml
 
 ## drMD LIBRARIES
 from Surgery import drPrep
-from UtilitiesCloset import drListInitiator
+from UtilitiesCloset import drListInitiator, drLedger
 from ExaminationRoom import drLogger
 
 ## PDB // DATAFRAME UTILS
@@ -48,8 +48,21 @@ def make_per_protein_config(
     runDir: DirectoryPath = p.join(outDir, protName)
     os.makedirs(runDir, exist_ok=True)
 
-    ## if config file has already been made, back it up, then make a new one
+    ## if the ledger shows that this config was written from the same batch config, reuse it
     configYaml: FilePath = p.join(yamlDir, f"{protName}_config.yaml")
+    ## mutant configs are written by drMutator when each mutant is built
+    if p.dirname(pdbFile) == p.join(outDir, "00_mutants") and p.isfile(configYaml):
+        update_hardwareInfo(configYaml, batchConfig)
+        return configYaml
+    ledgerFile: FilePath = drLedger.get_ledger_file(outDir)
+    configHash: str = drLedger.hash_batch_config(batchConfig)
+    systemRecord: Optional[dict] = drLedger.get_system(ledgerFile, protName)
+    if (systemRecord is not None and systemRecord["configHash"] == configHash
+         and systemRecord["configYaml"] == configYaml and p.isfile(configYaml)):
+        update_hardwareInfo(configYaml, batchConfig)
+        return configYaml
+
+    ## if config file has already been made, back it up, then make a new one
     if p.exists(configYaml):
         drLogger.log_info("WARNING: config file already exists, backing up existing config file", True)
         backupConfig: FilePath = p.join(yamlDir, f"{protName}_config.yaml.bak")
@@ -87,9 +100,30 @@ def make_per_protein_config(
     configYaml: FilePath = p.join(yamlDir, f"{protName}_config.yaml")
     with open(configYaml, "w") as f:
         yaml.dump(runConfig, f, default_flow_style=False)
+    drLedger.update_system(ledgerFile, protName,
+                            pdbFile = pdbFile,
+                              configYaml = configYaml,
+                                configHash = configHash)
 
     return configYaml
 ######################################################################################
+def update_hardwareInfo(configYaml: FilePath, batchConfig: dict) -> None:
+    """
+    hardwareInfo is not part of the config hash, so a reused config
+    may need its hardwareInfo bringing up to date with the batch config
+
+    Args:
+        configYaml (FilePath): path to an existing per-protein config
+        batchConfig (dict): Batch configuration dictionary
+    """
+    with open(configYaml, "r") as f:
+        runConfig: dict = yaml.safe_load(f)
+    if runConfig["hardwareInfo"] == batchConfig["hardwareInfo"]:
+        return
+    runConfig["hardwareInfo"] = batchConfig["hardwareInfo"]
+    with open(configYaml, "w") as f:
+        yaml.dump(runConfig, f, default_flow_style=False)
+######################################################################################
 def detect_protons(pdbDf: pd.DataFrame) -> bool:
 
     def ele_from_atom_name(atomName: str) -> str:
@@ -0,0 +1,274 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import socket
+import hashlib
+import time
+import threading
+from glob import glob
+from contextlib import contextmanager
+
+## drMD LIBRARIES
+from ExaminationRoom import drLogger
+from UtilitiesCloset import drWallClock
+
+## CLEAN CODE
+from typing import Iterator, List, Optional
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+#####################################################################################
+def get_claim_dir(outDir: DirectoryPath) -> DirectoryPath:
+    """
+    Returns (and creates) the directory used to hold task claims for a batch
+
+    Args:
+        outDir (DirectoryPath): the outputDir of the batch
+
+    Returns:
+        claimDir (DirectoryPath): the claim directory inside 00_drMD_logs
+    """
+    claimDir: DirectoryPath = p.join(outDir, "00_drMD_logs", "00_claims")
+    os.makedirs(claimDir, exist_ok=True)
+    return claimDir
+#####################################################################################
+def is_task_finished(claimDir: DirectoryPath, taskName: str, taskHash: Optional[str] = None) -> bool:
+    """
+    A task is finished once it has a done or a failed marker in the claim directory
+    If taskHash is given, only markers written with the same hash count, so that a task
+    is run again once whatever it was run with (eg. the batch config) has changed
+
+    Args:
+        claimDir (DirectoryPath): the claim directory
+        taskName (str): the name of the task
+        taskHash (str, optional): hash of whatever the task is run with
+
+    Returns:
+        finished (bool): whether the task has a matching marker
+    """
+    for marker in ["done", "failed"]:
+        markerFile: FilePath = p.join(claimDir, f"{taskName}.{marker}")
+        try:
+            with open(markerFile, "r") as f:
+                markerLines: List[str] = f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        if taskHash is None or (len(markerLines) > 1 and markerLines[1].strip() == taskHash):
+            return True
+    return False
+#####################################################################################
+def clear_task_markers(claimDir: DirectoryPath, taskNames: List[str]) -> None:
+    """
+    Removes the done and failed markers of tasks, so that they are claimed and run again
+    """
+    for taskName in taskNames:
+        for marker in ["done", "failed"]:
+            try:
+                os.remove(p.join(claimDir, f"{taskName}.{marker}"))
+            except FileNotFoundError:
+                pass
+#####################################################################################
+def claim_task(claimDir: DirectoryPath, taskName: str, claimTimeout: int, taskHash: Optional[str] = None) -> bool:
+    """
+    Atomically claims a task by creating a lock file with O_CREAT | O_EXCL
+    Only one process (on any node sharing claimDir) can create the lock file
+    If an existing claim has not been refreshed for claimTimeout seconds,
+    its owner is assumed to have crashed and the claim is taken over
+
+    Args:
+        claimDir (DirectoryPath): the claim directory
+        taskName (str): the name of the task (usually the name of the input PDB)
+        claimTimeout (int): seconds after which an unrefreshed claim expires
+        taskHash (str, optional): hash of whatever the task is run with, see is_task_finished
+
+    Returns:
+        claimed (bool): True if this process now owns the task
+    """
+    if is_task_finished(claimDir, taskName, taskHash):
+        return False
+
+    claimFile: FilePath = p.join(claimDir, f"{taskName}.claim")
+    owner: str = f"{socket.gethostname()} {os.getpid()} {time.time()}\n"
+    try:
+        fd: int = os.open(claimFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        expiredClaim: Optional[str] = read_expired_claim(claimFile, claimTimeout)
+        if expiredClaim is None:
+            return False
+        ## only one process may take over a given expired claim: whoever creates its takeover marker first
+        takeoverFile: FilePath = f"{claimFile}.takeover.{hashlib.sha1(expiredClaim.encode()).hexdigest()[:16]}"
+        try:
+            os.close(os.open(takeoverFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        ## move the expired claim out of the way, rename is atomic so no other process can see it half-removed
+        expiredClaimFile: FilePath = f"{claimFile}.expired.{socket.gethostname()}.{os.getpid()}"
+        try:
+            os.rename(claimFile, expiredClaimFile)
+        except FileNotFoundError:
+            ## released by its owner in the meantime
+            return claim_task(claimDir, taskName, claimTimeout, taskHash)
+        if read_claim(expiredClaimFile) != expiredClaim:
+            ## the claim was replaced by a live one before we moved it, so put that one back
+            try:
+                os.link(expiredClaimFile, claimFile)
+            except FileExistsError:
+                pass
+            os.remove(expiredClaimFile)
+            return False
+        os.remove(expiredClaimFile)
+        drLogger.log_info(f"Reclaiming expired claim for {taskName}", True)
+        return claim_task(claimDir, taskName, claimTimeout, taskHash)
+
+    with os.fdopen(fd, "w") as f:
+        f.write(owner)
+    ## a task may have finished between our first check and creating the claim
+    if is_task_finished(claimDir, taskName, taskHash):
+        os.remove(claimFile)
+        return False
+    return True
+#####################################################################################
+def read_claim(claimFile: FilePath) -> Optional[str]:
+    """
+    Returns the owner and last heartbeat of a claim file, or None if there is no claim
+    """
+    try:
+        with open(claimFile, "r") as f:
+            lastHeartbeat: float = os.fstat(f.fileno()).st_mtime
+            return f"{f.read().strip()} {lastHeartbeat}"
+    except FileNotFoundError:
+        return None
+#####################################################################################
+def read_claim_owner(claimFile: FilePath) -> Optional[str]:
+    """
+    Returns the owner written in a claim file, or None if there is no claim
+    """
+    try:
+        with open(claimFile, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+#####################################################################################
+def read_expired_claim(claimFile: FilePath, claimTimeout: int) -> Optional[str]:
+    """
+    Returns the claim (see read_claim) if it has not been refreshed for claimTimeout seconds, otherwise None
+    """
+    claim: Optional[str] = read_claim(claimFile)
+    if claim is None:
+        return None
+    lastHeartbeat: float = float(claim.split()[-1])
+    if time.time() - lastHeartbeat > claimTimeout:
+        return claim
+    return None
+#####################################################################################
+def release_task(claimDir: DirectoryPath, taskName: str, succeeded: bool, taskHash: Optional[str] = None) -> None:
+    """
+    Marks a claimed task as done or failed, then removes its claim
+
+    Args:
+        claimDir (DirectoryPath): the claim directory
+        taskName (str): the name of the task
+        succeeded (bool): whether the task finished successfully
+        taskHash (str, optional): hash of whatever the task was run with, see is_task_finished
+    """
+    marker: str = "done" if succeeded else "failed"
+    with open(p.join(claimDir, f"{taskName}.{marker}"), "w") as f:
+        f.write(f"{socket.gethostname()} {os.getpid()} {time.time()}\n")
+        if taskHash is not None:
+            f.write(f"{taskHash}\n")
+    claimFile: FilePath = p.join(claimDir, f"{taskName}.claim")
+    if p.isfile(claimFile):
+        os.remove(claimFile)
+    for takeoverFile in glob(f"{claimFile}.takeover.*"):
+        os.remove(takeoverFile)
+#####################################################################################
+def abandon_task(claimDir: DirectoryPath, taskName: str) -> None:
+    """
+    Removes the claim on a task without marking it as done or failed,
+    so that the next worker to look for work picks it up again
+    """
+    claimFile: FilePath = p.join(claimDir, f"{taskName}.claim")
+    if p.isfile(claimFile):
+        os.remove(claimFile)
+#####################################################################################
+@contextmanager
+def hold_claim(claimDir: DirectoryPath, taskName: str, claimTimeout: int) -> Iterator[None]:
+    """
+    Keeps a claim alive while a task is running by touching the claim file
+    from a background thread, four times per claimTimeout
+    If the claim is lost (eg. this process was held up for longer than claimTimeout and another
+    worker took the task over), the task is stopped through drWallClock.stop_system
+    and SystemStopped is raised, so that the same task is never run by two workers
+
+    Args:
+        claimDir (DirectoryPath): the claim directory
+        taskName (str): the name of the task
+        claimTimeout (int): seconds after which an unrefreshed claim expires
+    """
+    claimFile: FilePath = p.join(claimDir, f"{taskName}.claim")
+    owner: Optional[str] = read_claim_owner(claimFile)
+    stopHeartbeat = threading.Event()
+    claimLost = threading.Event()
+
+    def heartbeat():
+        while not stopHeartbeat.wait(claimTimeout / 4):
+            ## check the claim is still ours before touching it, so that another worker's claim is never kept alive
+            if read_claim_owner(claimFile) != owner:
+                drLogger.log_info(f"Lost the claim on {taskName} to another worker, stopping it here", True, True)
+                claimLost.set()
+                drWallClock.stop_system(f"lost the claim on {taskName}")
+                return
+            try:
+                os.utime(claimFile, None)
+            except FileNotFoundError:
+                pass
+
+    heartbeatThread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeatThread.start()
+    try:
+        yield
+    finally:
+        stopHeartbeat.set()
+        heartbeatThread.join()
+        drWallClock.clear_system_stop()
+    ## the task finished before it reached a point where it could be stopped
+    if claimLost.is_set():
+        raise drWallClock.SystemStopped(f"lost the claim on {taskName}, stopping after it had finished")
+#####################################################################################
+def iterate_claimed_tasks(pdbFiles: List[FilePath],
+                           claimDir: DirectoryPath,
+                             claimTimeout: int,
+                               pollInterval: Optional[int] = None,
+                                 taskHash: Optional[str] = None) -> Iterator[FilePath]:
+    """
+    Yields PDB files that this process has successfully claimed
+    Keeps polling until every task is either done or failed, so that
+    claims left behind by crashed workers are picked up once they expire
+
+    Args:
+        pdbFiles (List[FilePath]): the PDB files in the batch, in scheduling order
+        claimDir (DirectoryPath): the claim directory
+        claimTimeout (int): seconds after which an unrefreshed claim expires
+        pollInterval (int, optional): seconds to wait when nothing can be claimed
+        taskHash (str, optional): hash of whatever the tasks are run with, see is_task_finished
+
+    Yields:
+        pdbFile (FilePath): a PDB file claimed by this process
+    """
+    if pollInterval is None:
+        pollInterval = max(1, claimTimeout // 4)
+    while True:
+        remainingPdbFiles: List[FilePath] = [pdbFile for pdbFile in pdbFiles
+                                              if not is_task_finished(claimDir, get_task_name(pdbFile), taskHash)]
+        if len(remainingPdbFiles) == 0:
+            return
+        claimedAny: bool = False
+        for pdbFile in remainingPdbFiles:
+            if claim_task(claimDir, get_task_name(pdbFile), claimTimeout, taskHash):
+                claimedAny = True
+                yield pdbFile
+        if not claimedAny:
+            time.sleep(pollInterval)
+#####################################################################################
+def get_task_name(pdbFile: FilePath) -> str:
+    return p.splitext(p.basename(pdbFile))[0]
+#####################################################################################
@@ -0,0 +1,138 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import json
+import time
+import socket
+import fcntl
+from contextlib import contextmanager
+
+## drMD LIBRARIES
+from ExaminationRoom import drLogger
+from UtilitiesCloset import drMemoryModel
+
+## CLEAN CODE
+from typing import Dict, Iterator, Optional
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## set by set_up_governor in each process that runs prep or simulations
+GOVERNOR_FILE: Optional[FilePath] = None
+GOVERNOR_CPUS: int = 0
+TOOL_LIMITS: Dict[str, int] = {}
+MEMORY_LIMIT_MB: Optional[float] = None
+
+## seconds between attempts to acquire resources, and the wait after which a wait is logged
+POLL_INTERVAL: float = 0.5
+REPORT_WAIT_AFTER: float = 1.0
+#####################################################################################
+def set_up_governor(batchOutDir: DirectoryPath, hardwareInfo: Dict) -> None:
+    """
+    Points this process at the resource governor of its batch
+    Every drMD process on the same host shares one governor file, so core and memory use is limited across workers
+    If governorCpus is 0 and there is no memoryLimit, the governor is turned off and resources are never waited for
+
+    Args:
+        batchOutDir (DirectoryPath): the outputDir of the batch
+        hardwareInfo (dict): hardwareInfo of the batch or per-system config
+    """
+    global GOVERNOR_FILE, GOVERNOR_CPUS, TOOL_LIMITS, MEMORY_LIMIT_MB
+    GOVERNOR_CPUS = hardwareInfo.get("governorCpus", 0)
+    TOOL_LIMITS = hardwareInfo.get("toolLimits", {}) or {}
+    MEMORY_LIMIT_MB = drMemoryModel.parse_memory(hardwareInfo.get("memoryLimit", None))
+    if GOVERNOR_CPUS == 0 and MEMORY_LIMIT_MB is None:
+        GOVERNOR_FILE = None
+        return
+    governorDir: DirectoryPath = p.join(batchOutDir, "00_drMD_logs", "00_governor")
+    os.makedirs(governorDir, exist_ok=True)
+    GOVERNOR_FILE = p.join(governorDir, f"{socket.gethostname()}.json")
+#####################################################################################
+@contextmanager
+def hold_resources(label: str, cpus: int = 1, pool: Optional[str] = None, memoryMB: float = 0.0) -> Iterator[None]:
+    """
+    Holds CPU tokens, a slot in a tool pool (if that pool is limited) and a memory reservation while a task runs
+    Waits until the governor has enough free resources, and logs how long the wait took
+
+    Args:
+        label (str): description of the task, used in log messages
+        cpus (int): number of CPU tokens the task needs
+        pool (str, optional): name of the tool pool (eg. "sqm"), limited by toolLimits
+        memoryMB (float): predicted peak memory of the task, see drMemoryModel
+    """
+    if GOVERNOR_FILE is None:
+        yield
+        return
+    ## a task can never need more tokens than the governor has
+    cpus = max(1, min(cpus, GOVERNOR_CPUS)) if GOVERNOR_CPUS > 0 else 0
+    if MEMORY_LIMIT_MB is not None and memoryMB > MEMORY_LIMIT_MB:
+        drLogger.log_info(f"WARNING: {label} is predicted to need {memoryMB:.0f} MB, more than memoryLimit. It will run once nothing else is holding memory", True, True)
+    holderId: str = f"{os.getpid()}:{time.time()}"
+    waitStart: float = time.time()
+    while not try_acquire(holderId, cpus, pool, memoryMB):
+        time.sleep(POLL_INTERVAL)
+    waitTime: float = time.time() - waitStart
+    if waitTime > REPORT_WAIT_AFTER:
+        drLogger.log_info(f"Waited {waitTime:.1f} s for {cpus} CPU token(s) {'in pool ' + pool + ' ' if pool else ''}{f'and {memoryMB:.0f} MB of memory ' if memoryMB > 0 else ''}to run {label}", True)
+    try:
+        yield
+    finally:
+        release(holderId)
+#####################################################################################
+def try_acquire(holderId: str, cpus: int, pool: Optional[str], memoryMB: float = 0.0) -> bool:
+    """
+    Takes resources from the governor if enough are free, in a single locked read-modify-write
+    Holders whose processes have died are removed first, so a crash can't leak resources
+    A task that needs more memory than memoryLimit is let in when no other task holds memory,
+    so that it queues rather than blocking the batch forever
+    """
+    with locked_state() as state:
+        holders: Dict[str, Dict] = state["holders"]
+        for deadHolder in [holder for holder in holders if not is_process_alive(int(holder.split(":")[0]))]:
+            del holders[deadHolder]
+        usedCpus: int = sum([holder["cpus"] for holder in holders.values()])
+        if GOVERNOR_CPUS > 0 and usedCpus + cpus > GOVERNOR_CPUS:
+            return False
+        usedMemory: float = sum([holder.get("memoryMB", 0.0) for holder in holders.values()])
+        if MEMORY_LIMIT_MB is not None and usedMemory > 0 and usedMemory + memoryMB > MEMORY_LIMIT_MB:
+            return False
+        if pool is not None and pool in TOOL_LIMITS:
+            poolUsers: int = len([holder for holder in holders.values() if holder["pool"] == pool])
+            if poolUsers >= TOOL_LIMITS[pool]:
+                return False
+        holders[holderId] = {"cpus": cpus, "pool": pool, "memoryMB": memoryMB}
+        return True
+#####################################################################################
+def release(holderId: str) -> None:
+    """
+    Returns a holder's tokens to the governor
+    """
+    with locked_state() as state:
+        state["holders"].pop(holderId, None)
+#####################################################################################
+@contextmanager
+def locked_state() -> Iterator[Dict]:
+    """
+    Reads the governor state under an exclusive lock and writes it back afterwards
+    """
+    with open(f"{GOVERNOR_FILE}.lock", "a") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(GOVERNOR_FILE, "r") as f:
+                    state: Dict = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = {"holders": {}}
+            yield state
+            with open(GOVERNOR_FILE, "w") as f:
+                json.dump(state, f)
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+#####################################################################################
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+#####################################################################################
@@ -0,0 +1,361 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import sqlite3
+import time
+import json
+import hashlib
+
+## CLEAN CODE
+from typing import Dict, List, Optional
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## states recorded for systems, prep and steps
+PENDING: str = "pending"
+RUNNING: str = "running"
+DONE: str = "done"
+FAILED: str = "failed"
+## stopped with a checkpoint to stay inside wallTimeBudget, resumed when the batch is resubmitted
+PAUSED: str = "paused"
+
+## seconds to wait for another process to release its lock on the ledger
+LEDGER_TIMEOUT: int = 120
+## written in each step directory, the hash of the step config and everything upstream of it
+STEP_HASH_FILE: str = "drMD_step_hash.txt"
+## miscInfo keys that decide what prep makes of an input PDB file
+PREP_MISC_KEYS: List[str] = ["pH", "boxGeometry", "boxSize", "skipPdbTriage", "nonCanonicalResidueNames"]
+
+#####################################################################################
+def get_ledger_file(batchOutDir: DirectoryPath) -> FilePath:
+    """
+    Returns the path of the run ledger for a batch
+    The ledger lives in 00_drMD_logs, next to the per-system logs
+
+    Args:
+        batchOutDir (DirectoryPath): the outputDir of the batch config
+
+    Returns:
+        ledgerFile (FilePath): path to the SQLite ledger
+    """
+    logDir: DirectoryPath = p.join(batchOutDir, "00_drMD_logs")
+    os.makedirs(logDir, exist_ok=True)
+    return p.join(logDir, "drMD_ledger.db")
+#####################################################################################
+def get_ledger_file_for_run(runConfig: Dict) -> FilePath:
+    """
+    Per-system configs have their own run directory as outputDir,
+    the ledger is in the batch outputDir one level up
+    """
+    return get_ledger_file(p.dirname(runConfig["pathInfo"]["outputDir"]))
+#####################################################################################
+def connect(ledgerFile: FilePath) -> sqlite3.Connection:
+    """
+    Opens a connection to the ledger, creating its tables if they don't exist
+    The default rollback journal is used rather than WAL, as WAL does not work on network filesystems
+
+    Args:
+        ledgerFile (FilePath): path to the SQLite ledger
+
+    Returns:
+        connection (sqlite3.Connection): connection with rows returned as sqlite3.Row
+    """
+    connection: sqlite3.Connection = sqlite3.connect(ledgerFile, timeout=LEDGER_TIMEOUT)
+    connection.row_factory = sqlite3.Row
+    with connection:
+        connection.execute("""CREATE TABLE IF NOT EXISTS systems (
+                                systemName TEXT PRIMARY KEY,
+                                pdbFile TEXT,
+                                configYaml TEXT,
+                                configHash TEXT,
+                                state TEXT,
+                                attempts INTEGER DEFAULT 0,
+                                startTime REAL,
+                                endTime REAL,
+                                prepState TEXT,
+                                solvatedPdb TEXT,
+                                inputCoords TEXT,
+                                amberParams TEXT,
+                                prepHash TEXT)""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS steps (
+                                systemName TEXT,
+                                stepName TEXT,
+                                stepIndex INTEGER,
+                                state TEXT,
+                                attempts INTEGER DEFAULT 0,
+                                startTime REAL,
+                                endTime REAL,
+                                saveFile TEXT,
+                                retries INTEGER DEFAULT 0,
+                                restoredFrom TEXT,
+                                PRIMARY KEY (systemName, stepName))""")
+        ## ledgers written before prep settings were hashed have no prepHash column
+        systemColumns: List[str] = [row["name"] for row in connection.execute("PRAGMA table_info(systems)")]
+        if "prepHash" not in systemColumns:
+            try:
+                connection.execute("ALTER TABLE systems ADD COLUMN prepHash TEXT")
+            ## another process added it first
+            except sqlite3.OperationalError:
+                pass
+        ## or steps with no retries column (firstAid and stall restarts of a step),
+        ## or restoredFrom column (the memo store key of a step that was restored rather than run)
+        stepColumns: List[str] = [row["name"] for row in connection.execute("PRAGMA table_info(steps)")]
+        for columnName, columnType in [("retries", "INTEGER DEFAULT 0"), ("restoredFrom", "TEXT")]:
+            if columnName in stepColumns:
+                continue
+            try:
+                connection.execute(f"ALTER TABLE steps ADD COLUMN {columnName} {columnType}")
+            except sqlite3.OperationalError:
+                pass
+    return connection
+#####################################################################################
+def hash_batch_config(batchConfig: Dict) -> str:
+    """
+    Hashes a batch config, so that a rerun with a changed config is not mistaken for a finished one
+    hardwareInfo is left out, as it does not change the results of a simulation
+    """
+    protocolConfig: Dict = {key: value for key, value in batchConfig.items() if key != "hardwareInfo"}
+    configJson: str = json.dumps(protocolConfig, sort_keys=True, default=str)
+    return hashlib.sha256(configJson.encode()).hexdigest()
+#####################################################################################
+def hash_batch_task(batchConfig: Dict, systemNames: List[str]) -> str:
+    """
+    Hashes a batch config together with the systems a batch-wide task (pdbTriage, aftercare) covers,
+    so that the task is run again once systems have been added or have finished since it last ran
+    """
+    taskJson: str = json.dumps({"configHash": hash_batch_config(batchConfig), "systems": sorted(systemNames)})
+    return hashlib.sha256(taskJson.encode()).hexdigest()
+#####################################################################################
+def hash_file(fileName: FilePath) -> str:
+    fileHash = hashlib.sha256()
+    with open(fileName, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+#####################################################################################
+def hash_prep_settings(runConfig: Dict) -> str:
+    """
+    Hashes everything prep makes a system from: the input PDB file, the parameter files of
+    ligands and non-canonical residues in inputDir, and the prep settings of the config
+    proteinName is left out, so that the same system under another name has the same hash
+
+    Args:
+        runConfig (dict): per-system config
+
+    Returns:
+        prepHash (str): hash of the prep settings
+    """
+    inputDir: DirectoryPath = runConfig["pathInfo"]["inputDir"]
+    paramNames: List[str] = [ligand["ligandName"] for ligand in runConfig.get("ligandInfo", None) or []]
+    paramNames += runConfig["miscInfo"].get("nonCanonicalResidueNames", None) or []
+    paramFiles: Dict[str, str] = {}
+    for paramName in paramNames:
+        for extension in ["mol2", "frcmod", "lib"]:
+            paramFile: FilePath = p.join(inputDir, f"{paramName}.{extension}")
+            if p.isfile(paramFile):
+                paramFiles[p.basename(paramFile)] = hash_file(paramFile)
+    prepSettings: Dict = {"inputPdb": hash_file(runConfig["pathInfo"]["inputPdb"]),
+                          "paramFiles": paramFiles,
+                          "proteinInfo": {key: value for key, value in runConfig["proteinInfo"].items() if key != "proteinName"},
+                          "ligandInfo": runConfig.get("ligandInfo", None),
+                          "mutantInfo": runConfig.get("mutantInfo", None),
+                          "miscInfo": {key: runConfig["miscInfo"].get(key, None) for key in PREP_MISC_KEYS}}
+    return hashlib.sha256(json.dumps(prepSettings, sort_keys=True, default=str).encode()).hexdigest()
+#####################################################################################
+def hash_steps(runConfig: Dict, inputCoords: FilePath, amberParams: FilePath) -> List[str]:
+    """
+    Hashes each step of a per-system config, chained to the hash of the step it starts from
+    (its startFrom, or the step before it). The first step is chained to the prepared system,
+    so a step's hash changes if its own config, any upstream step or the prepared system changes
+
+    Args:
+        runConfig (dict): per-system config, before any steps have been processed
+        inputCoords (FilePath): prepared coordinates of the system
+        amberParams (FilePath): prepared parameters of the system
+
+    Returns:
+        stepHashes (List[str]): a hash for each step in simulationInfo
+    """
+    systemHash: str = hashlib.sha256(json.dumps({"inputCoords": hash_file(inputCoords),
+                                                  "amberParams": hash_file(amberParams),
+                                                    "trajectorySelections": runConfig["miscInfo"]["trajectorySelections"]},
+                                                  sort_keys=True, default=str).encode()).hexdigest()
+    stepHashes: List[str] = []
+    hashesByName: Dict[str, str] = {}
+    for sim in runConfig["simulationInfo"]:
+        if sim.get("startFrom", None) is not None:
+            upstreamHash: str = hashesByName[sim["startFrom"]]
+        else:
+            upstreamHash = stepHashes[-1] if len(stepHashes) > 0 else systemHash
+        stepJson: str = json.dumps({"upstream": upstreamHash, "step": sim}, sort_keys=True, default=str)
+        stepHash: str = hashlib.sha256(stepJson.encode()).hexdigest()
+        stepHashes.append(stepHash)
+        hashesByName[sim["stepName"]] = stepHash
+    return stepHashes
+#####################################################################################
+def read_step_hash(simDir: DirectoryPath) -> Optional[str]:
+    """
+    Returns the hash stored in a step directory, or None for steps run by an older drMD
+    """
+    stepHashFile: FilePath = p.join(simDir, STEP_HASH_FILE)
+    if not p.isfile(stepHashFile):
+        return None
+    with open(stepHashFile, "r") as f:
+        return f.read().strip()
+#####################################################################################
+def write_step_hash(simDir: DirectoryPath, stepHash: str) -> None:
+    os.makedirs(simDir, exist_ok=True)
+    with open(p.join(simDir, STEP_HASH_FILE), "w") as f:
+        f.write(f"{stepHash}\n")
+#####################################################################################
+def register_systems(ledgerFile: FilePath, pdbFiles: List[FilePath]) -> None:
+    """
+    Adds every system in a batch to the ledger as pending, in a single transaction
+    Systems that already have a record are left as they are
+
+    Args:
+        ledgerFile (FilePath): path to the SQLite ledger
+        pdbFiles (List[FilePath]): input PDB files of the batch
+    """
+    connection: sqlite3.Connection = connect(ledgerFile)
+    try:
+        with connection:
+            connection.executemany("INSERT OR IGNORE INTO systems (systemName, pdbFile, state) VALUES (?, ?, ?)",
+                                    [(p.splitext(p.basename(pdbFile))[0], pdbFile, PENDING) for pdbFile in pdbFiles])
+    finally:
+        connection.close()
+#####################################################################################
+def update_system(ledgerFile: FilePath, systemName: str, **fields) -> None:
+    """
+    Inserts or updates a row in the systems table
+    Setting state to running also increments the attempt count and records the start time,
+    setting it to done or failed records the end time
+
+    Args:
+        ledgerFile (FilePath): path to the SQLite ledger
+        systemName (str): name of the system (the input PDB name)
+        **fields: columns of the systems table to set
+    """
+    state: Optional[str] = fields.get("state", None)
+    if state == RUNNING:
+        fields["startTime"] = time.time()
+        fields["endTime"] = None
+    elif state in [DONE, FAILED]:
+        fields["endTime"] = time.time()
+    upsert_row(ledgerFile, "systems", {"systemName": systemName}, fields, countAttempt = state == RUNNING)
+#####################################################################################
+def update_step(ledgerFile: FilePath, systemName: str, stepName: str, **fields) -> None:
+    """
+    Inserts or updates a row in the steps table, see update_system
+
+    Args:
+        ledgerFile (FilePath): path to the SQLite ledger
+        systemName (str): name of the system
+        stepName (str): stepName from simulationInfo
+        **fields: columns of the steps table to set
+    """
+    state: Optional[str] = fields.get("state", None)
+    if state == RUNNING:
+        fields["startTime"] = time.time()
+        fields["endTime"] = None
+    elif state in [DONE, FAILED]:
+        fields["endTime"] = time.time()
+    upsert_row(ledgerFile, "steps", {"systemName": systemName, "stepName": stepName}, fields, countAttempt = state == RUNNING)
+#####################################################################################
+def upsert_row(ledgerFile: FilePath, tableName: str, keys: Dict, fields: Dict, countAttempt: bool) -> None:
+    """
+    Inserts a row if it doesn't exist, then updates the given fields in a single transaction
+    """
+    keyClause: str = " AND ".join([f"{keyName} = ?" for keyName in keys])
+    setColumns: List[str] = [f"{fieldName} = ?" for fieldName in fields]
+    if countAttempt:
+        setColumns.append("attempts = attempts + 1")
+    connection: sqlite3.Connection = connect(ledgerFile)
+    try:
+        with connection:
+            connection.execute(f"INSERT OR IGNORE INTO {tableName} ({', '.join(keys)}) VALUES ({', '.join('?' for _ in keys)})",
+                                tuple(keys.values()))
+            if len(setColumns) > 0:
+                connection.execute(f"UPDATE {tableName} SET {', '.join(setColumns)} WHERE {keyClause}",
+                                    tuple(fields.values()) + tuple(keys.values()))
+    finally:
+        connection.close()
+#####################################################################################
+def count_step_retry(ledgerFile: FilePath, systemName: str, stepName: str) -> int:
+    """
+    Counts a retry of a step, either a firstAid retry or a restart after the simulation stalled
+    Both are counted against the same firstAidMaxRetries budget, across system processes
+
+    Returns:
+        retries (int): retries of the step, including this one
+    """
+    upsert_row(ledgerFile, "steps", {"systemName": systemName, "stepName": stepName}, {}, countAttempt = False)
+    connection: sqlite3.Connection = connect(ledgerFile)
+    try:
+        with connection:
+            connection.execute("UPDATE steps SET retries = COALESCE(retries, 0) + 1 WHERE systemName = ? AND stepName = ?",
+                                (systemName, stepName))
+            retries: int = connection.execute("SELECT retries FROM steps WHERE systemName = ? AND stepName = ?",
+                                               (systemName, stepName)).fetchone()["retries"]
+    finally:
+        connection.close()
+    return retries
+#####################################################################################
+def get_step_retries(ledgerFile: FilePath, systemName: str, stepName: Optional[str] = None) -> int:
+    """
+    Returns the retries of a step, see count_step_retry
+    Without a stepName, the most retries of any step of the system are returned
+    """
+    stepRecords: Dict[str, Dict] = get_steps(ledgerFile, systemName)
+    retries: List[int] = [record["retries"] or 0 for name, record in stepRecords.items() if stepName is None or name == stepName]
+    return max(retries, default=0)
+#####################################################################################
+def get_system(ledgerFile: FilePath, systemName: str) -> Optional[Dict]:
+    """
+    Returns the ledger record of a system, or None if it has no record
+    """
+    if not p.isfile(ledgerFile):
+        return None
+    connection: sqlite3.Connection = connect(ledgerFile)
+    try:
+        row: Optional[sqlite3.Row] = connection.execute("SELECT * FROM systems WHERE systemName = ?",
+                                                          (systemName,)).fetchone()
+    finally:
+        connection.close()
+    return dict(row) if row is not None else None
+#####################################################################################
+def get_steps(ledgerFile: FilePath, systemName: str) -> Dict[str, Dict]:
+    """
+    Returns the ledger records of every step of a system, keyed by stepName
+    """
+    if not p.isfile(ledgerFile):
+        return {}
+    connection: sqlite3.Connection = connect(ledgerFile)
+    try:
+        rows: List[sqlite3.Row] = connection.execute("SELECT * FROM steps WHERE systemName = ?",
+                                                       (systemName,)).fetchall()
+    finally:
+        connection.close()
+    return {row["stepName"]: dict(row) for row in rows}
+#####################################################################################
+def get_finished_systems(ledgerFile: FilePath, configHash: str) -> List[str]:
+    """
+    Returns the names of systems that finished successfully with the current batch config
+    This is a single query, so deciding what to skip on restart does not touch any run directories
+
+    Args:
+        ledgerFile (FilePath): path to the SQLite ledger
+        configHash (str): hash of the current batch config
+
+    Returns:
+        finishedSystems (List[str]): names of finished systems
+    """
+    if not p.isfile(ledgerFile):
+        return []
+    connection: sqlite3.Connection = connect(ledgerFile)
+    try:
+        rows: List[sqlite3.Row] = connection.execute("SELECT systemName FROM systems WHERE state = ? AND configHash = ?",
+                                                       (DONE, configHash)).fetchall()
+    finally:
+        connection.close()
+    return [row["systemName"] for row in rows]
+#####################################################################################
@@ -88,4 +88,5 @@ def get_not_a_run_dir() -> set:
                  "00_drMD_logs",
                    "00_vitals_reports",
                      "01_ligand_parameters",
-                       "00_collated_pdbs"}
\ No newline at end of file
+                       "00_collated_pdbs",
+                         "00_mutants"}
\ No newline at end of file
@@ -0,0 +1,183 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import json
+import time
+import hashlib
+import fcntl
+from shutil import copy, copytree, rmtree, ignore_patterns
+from contextlib import contextmanager
+
+## drMD LIBRARIES
+from ExaminationRoom import drLogger
+from UtilitiesCloset import drLedger, drMemoryModel
+
+## CLEAN CODE
+from typing import Dict, Iterator, List, Optional, Tuple
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## files kept for each stored step
+STATE_FILE: str = "state.xml"
+ENDPOINT_FILE: str = "endpoint.pdb"
+INFO_FILE: str = "memo.json"
+## the rest of the step directory (trajectory, reports and plots) that later stages read
+STEP_FILES_DIR: str = "step_files"
+## files in a step directory that are not stored (checkpoints and firstAid working files),
+## the state and endpoint are stored under their own names
+UNSTORED_FILES: List[str] = ["*.chk", drLedger.STEP_HASH_FILE, "firstAid"]
+## step keys that name a step rather than change what it does
+NAMING_KEYS: List[str] = ["stepName", "startFrom"]
+#####################################################################################
+def get_memo_dir(runConfig: Dict) -> Optional[DirectoryPath]:
+    """
+    Returns the memo store directory, or None if hardwareInfo.memoStoreDir is not set
+    """
+    return runConfig["hardwareInfo"].get("memoStoreDir", None)
+#####################################################################################
+def hash_memo_keys(runConfig: Dict) -> List[str]:
+    """
+    Hashes each step of a per-system config for the memo store
+    Unlike drLedger.hash_steps, the chain starts from the prep settings (see drLedger.hash_prep_settings)
+    rather than the prepared files (prmtop files are timestamped), and stepNames are left out,
+    so that the same protocol prefix matches across batches and systems with different names
+
+    Args:
+        runConfig (dict): per-system config, before any steps have been processed
+
+    Returns:
+        memoKeys (List[str]): a key for each step in simulationInfo
+    """
+    systemKey: str = drLedger.hash_prep_settings(runConfig)
+
+    memoKeys: List[str] = []
+    keysByName: Dict[str, str] = {}
+    for sim in runConfig["simulationInfo"]:
+        if sim.get("startFrom", None) is not None:
+            upstreamKey: str = keysByName[sim["startFrom"]]
+        else:
+            upstreamKey = memoKeys[-1] if len(memoKeys) > 0 else systemKey
+        stepSettings: Dict = {key: value for key, value in sim.items() if key not in NAMING_KEYS}
+        stepJson: str = json.dumps({"upstream": upstreamKey, "step": stepSettings}, sort_keys=True, default=str)
+        memoKey: str = hashlib.sha256(stepJson.encode()).hexdigest()
+        memoKeys.append(memoKey)
+        keysByName[sim["stepName"]] = memoKey
+    return memoKeys
+#####################################################################################
+def restore_step(runConfig: Dict, memoKey: str, simDir: DirectoryPath) -> Optional[FilePath]:
+    """
+    Copies a stored step into a step directory, if the memo store has it
+    The trajectory and reports are restored along with the state, so that clustering, screening and
+    adaptive sampling can read the step as if it had been run here. Entries stored without them are not used
+    Reading a step marks it as recently used
+
+    Args:
+        runConfig (dict): per-system config
+        memoKey (str): key of the step, see hash_memo_keys
+        simDir (DirectoryPath): the step directory to restore into
+
+    Returns:
+        saveXml (Optional[FilePath]): the restored state XML file, or None if the step is not stored
+    """
+    memoDir: Optional[DirectoryPath] = get_memo_dir(runConfig)
+    if memoDir is None:
+        return None
+    entryDir: DirectoryPath = p.join(memoDir, memoKey)
+    stepName: str = p.basename(simDir)
+    protName: str = p.basename(p.dirname(simDir))
+    ## held while copying, so that the entry can't be evicted halfway through
+    with locked_store(memoDir):
+        if not p.isfile(p.join(entryDir, STATE_FILE)) or not p.isdir(p.join(entryDir, STEP_FILES_DIR)):
+            return None
+        os.makedirs(simDir, exist_ok=True)
+        copytree(p.join(entryDir, STEP_FILES_DIR), simDir, dirs_exist_ok=True)
+        saveXml: FilePath = p.join(simDir, f"{stepName}.xml")
+        copy(p.join(entryDir, STATE_FILE), saveXml)
+        if p.isfile(p.join(entryDir, ENDPOINT_FILE)):
+            copy(p.join(entryDir, ENDPOINT_FILE), p.join(simDir, f"{protName}.pdb"))
+        os.utime(entryDir)
+    return saveXml
+#####################################################################################
+def store_step(runConfig: Dict, memoKey: str, simDir: DirectoryPath, saveXml: FilePath) -> None:
+    """
+    Adds a finished step to the memo store, then evicts the least recently used steps
+    until the store is back under hardwareInfo.memoStoreSize
+    The final state and endpoint PDB are stored under names that don't depend on the system or step,
+    the rest of the step directory (trajectory, reports and plots) is stored as it is
+    The step's vitals checkup must have finished, see drCheckup.wait_for_checkup
+
+    Args:
+        runConfig (dict): per-system config
+        memoKey (str): key of the step, see hash_memo_keys
+        simDir (DirectoryPath): the finished step directory
+        saveXml (FilePath): the state XML file written by the step
+    """
+    memoDir: Optional[DirectoryPath] = get_memo_dir(runConfig)
+    if memoDir is None or saveXml is None or not p.isfile(saveXml):
+        return
+    os.makedirs(memoDir, exist_ok=True)
+    entryDir: DirectoryPath = p.join(memoDir, memoKey)
+    ## written to a temporary directory first, so that a half-written step is never restored
+    tmpDir: DirectoryPath = p.join(memoDir, f".tmp_{memoKey}_{os.getpid()}")
+    os.makedirs(tmpDir, exist_ok=True)
+    copy(saveXml, p.join(tmpDir, STATE_FILE))
+    endpointPdb: FilePath = p.join(simDir, f"{p.basename(p.dirname(simDir))}.pdb")
+    if p.isfile(endpointPdb):
+        copy(endpointPdb, p.join(tmpDir, ENDPOINT_FILE))
+    copytree(simDir, p.join(tmpDir, STEP_FILES_DIR),
+             ignore=ignore_patterns(*UNSTORED_FILES, p.basename(saveXml), p.basename(endpointPdb)))
+    with open(p.join(tmpDir, INFO_FILE), "w") as f:
+        json.dump({"system": p.basename(p.dirname(simDir)), "stepName": p.basename(simDir), "storedAt": time.time()}, f)
+
+    with locked_store(memoDir):
+        if p.isdir(entryDir):
+            rmtree(tmpDir, ignore_errors=True)
+        else:
+            os.rename(tmpDir, entryDir)
+        os.utime(entryDir)
+        evict_entries(memoDir, drMemoryModel.parse_memory(runConfig["hardwareInfo"].get("memoStoreSize", None)), keepKey=memoKey)
+#####################################################################################
+def evict_entries(memoDir: DirectoryPath, memoStoreSizeMB: Optional[float], keepKey: Optional[str] = None) -> None:
+    """
+    Deletes the least recently used entries until the store is no larger than memoStoreSizeMB
+    Must be called while holding the store lock
+    """
+    if memoStoreSizeMB is None:
+        return
+    entries: List[Tuple[float, float, DirectoryPath]] = []
+    for entryName in os.listdir(memoDir):
+        entryDir: DirectoryPath = p.join(memoDir, entryName)
+        if entryName.startswith(".") or not p.isdir(entryDir):
+            continue
+        entries.append((p.getmtime(entryDir), get_entry_size(entryDir), entryDir))
+    totalSizeMB: float = sum([entry[1] for entry in entries])
+    for _, entrySizeMB, entryDir in sorted(entries):
+        if totalSizeMB <= memoStoreSizeMB:
+            break
+        if p.basename(entryDir) == keepKey:
+            continue
+        rmtree(entryDir, ignore_errors=True)
+        totalSizeMB -= entrySizeMB
+        drLogger.log_info(f"Evicted {p.basename(entryDir)[:12]} from the memo store to keep it under memoStoreSize", True)
+#####################################################################################
+def get_entry_size(entryDir: DirectoryPath) -> float:
+    """
+    Returns the size of a stored step in MB, including its step files
+    """
+    entrySize: int = 0
+    for dirPath, _, fileNames in os.walk(entryDir):
+        entrySize += sum([p.getsize(p.join(dirPath, fileName)) for fileName in fileNames])
+    return entrySize / 1024 ** 2
+#####################################################################################
+@contextmanager
+def locked_store(memoDir: DirectoryPath) -> Iterator[None]:
+    """
+    Holds an exclusive lock on the memo store, which may be shared by batches on several hosts
+    """
+    os.makedirs(memoDir, exist_ok=True)
+    with open(p.join(memoDir, ".lock"), "a") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+#####################################################################################
@@ -0,0 +1,187 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import csv
+import resource
+import threading
+from contextlib import contextmanager
+
+## CLEAN CODE
+from typing import Dict, Iterator, List, Optional, Tuple
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+## peak memory (MB) is modelled as intercept + slope * size for each kind of task
+## for simulations, size is the number of atoms in the solvated system
+## for clustering, size is the MB needed for the trajectory and the N x N RMSD matrix
+DEFAULT_MEMORY_MODELS: Dict[str, Tuple[float, float]] = {"simulation": (400.0, 0.01),
+                                                          "clustering": (300.0, 1.5)}
+## predictions are padded so that small fitting errors don't let too much work in at once
+SAFETY_FACTOR: float = 1.1
+## columns of 00_drMD_logs/memory_measurements.csv
+MEMORY_COLUMNS: List[str] = ["kind", "label", "size", "peakMB"]
+## tasks being measured in this process, see measure_peak_memory
+ACTIVE_MEASUREMENTS: List[Dict] = []
+MEASUREMENT_LOCK: threading.Lock = threading.Lock()
+#####################################################################################
+def parse_memory(memoryInput: Optional[object]) -> Optional[float]:
+    """
+    Converts a memory string (eg. "64 GB") into MB
+    Plain numbers are taken to be in GB
+
+    Args:
+        memoryInput (str | int | float | None): the memory limit from hardwareInfo
+
+    Returns:
+        memoryMB (Optional[float]): the limit in MB, or None if there is no limit
+    """
+    if memoryInput is None:
+        return None
+    if isinstance(memoryInput, (int, float)) and not isinstance(memoryInput, bool):
+        return float(memoryInput) * 1024
+    memoryScale: Dict[str, float] = {"MB": 1, "GB": 1024, "TB": 1024 ** 2}
+    memoryData: List[str] = str(memoryInput).split()
+    if len(memoryData) != 2 or memoryData[1].upper() not in memoryScale:
+        raise ValueError(f"Could not read memory value {memoryInput}, use the format \"64 GB\"")
+    return float(memoryData[0]) * memoryScale[memoryData[1].upper()]
+#####################################################################################
+def get_measurements_file(batchOutDir: DirectoryPath) -> FilePath:
+    return p.join(batchOutDir, "00_drMD_logs", "memory_measurements.csv")
+#####################################################################################
+def predict_peak_memory(batchOutDir: DirectoryPath, kind: str, size: float) -> float:
+    """
+    Predicts the peak memory of a task, using a straight line fitted to the
+    peak memory of previous tasks of the same kind in this batch
+
+    Args:
+        batchOutDir (DirectoryPath): the outputDir of the batch
+        kind (str): "simulation" or "clustering"
+        size (float): atom count for simulations, MB of data for clustering
+
+    Returns:
+        peakMB (float): predicted peak memory in MB
+    """
+    intercept, slope = fit_memory_model(batchOutDir, kind)
+    return (intercept + slope * size) * SAFETY_FACTOR
+#####################################################################################
+def fit_memory_model(batchOutDir: DirectoryPath, kind: str) -> Tuple[float, float]:
+    """
+    Fits peakMB = intercept + slope * size to measured tasks by least squares
+    With fewer than two different sizes the slope can't be fitted, so the default slope
+    is kept and the intercept is raised to cover the largest measurement
+    """
+    defaultIntercept, defaultSlope = DEFAULT_MEMORY_MODELS[kind]
+    measurements: List[Tuple[float, float]] = read_measurements(batchOutDir, kind)
+    if len(measurements) == 0:
+        return defaultIntercept, defaultSlope
+    sizes: List[float] = [size for size, _ in measurements]
+    peaks: List[float] = [peakMB for _, peakMB in measurements]
+    if len(set(sizes)) < 2:
+        return max([peakMB - defaultSlope * size for size, peakMB in measurements]), defaultSlope
+
+    meanSize: float = sum(sizes) / len(sizes)
+    meanPeak: float = sum(peaks) / len(peaks)
+    slope: float = (sum([(size - meanSize) * (peakMB - meanPeak) for size, peakMB in measurements]) /
+                     sum([(size - meanSize) ** 2 for size in sizes]))
+    ## memory never goes down as systems get bigger
+    slope = max(0.0, slope)
+    intercept: float = meanPeak - slope * meanSize
+    return intercept, slope
+#####################################################################################
+def read_measurements(batchOutDir: DirectoryPath, kind: str) -> List[Tuple[float, float]]:
+    measurementsFile: FilePath = get_measurements_file(batchOutDir)
+    if not p.isfile(measurementsFile):
+        return []
+    measurements: List[Tuple[float, float]] = []
+    with open(measurementsFile, "r") as f:
+        for row in csv.reader(f):
+            if len(row) != len(MEMORY_COLUMNS) or row[0] != kind:
+                continue
+            try:
+                measurements.append((float(row[2]), float(row[3])))
+            except ValueError:
+                continue
+    return measurements
+#####################################################################################
+def get_peak_rss() -> float:
+    """
+    Returns the peak resident memory of this process so far, in MB
+    """
+    ## ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+#####################################################################################
+def read_proc_status(fieldName: str) -> Optional[float]:
+    """
+    Reads a memory field (eg. VmHWM) of this process from /proc/self/status, in MB
+    Returns None where /proc is not available
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{fieldName}:"):
+                    ## values are in kB
+                    return float(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+#####################################################################################
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident memory (VmHWM) of this process to its current resident memory
+    This is only possible on Linux, returns False if the peak could not be reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return read_proc_status("VmHWM") is not None
+#####################################################################################
+@contextmanager
+def measure_peak_memory(batchOutDir: DirectoryPath, kind: str, label: str, size: float) -> Iterator[None]:
+    """
+    Measures the peak memory of a task and records it with record_peak_memory
+    On Linux the peak of the process is reset when the task starts, so earlier tasks in the same process don't count.
+    Elsewhere the peak can't be reset, so a task is only recorded if it raised the peak of the process
+    Tasks that overlap another measured task in the same process (eg. with parallelBranches) are not recorded,
+    as their peaks can't be told apart. Tasks that raise an exception are not recorded either
+
+    Args:
+        batchOutDir (DirectoryPath): the outputDir of the batch
+        kind (str): "simulation" or "clustering"
+        label (str): description of the task
+        size (float): atom count for simulations, MB of data for clustering
+    """
+    measurement: Dict = {"overlapped": False}
+    with MEASUREMENT_LOCK:
+        for otherMeasurement in ACTIVE_MEASUREMENTS:
+            otherMeasurement["overlapped"] = True
+        measurement["overlapped"] = len(ACTIVE_MEASUREMENTS) > 0
+        ACTIVE_MEASUREMENTS.append(measurement)
+        isReset: bool = reset_peak_rss()
+        startPeakMB: float = get_peak_rss()
+    try:
+        yield
+    finally:
+        with MEASUREMENT_LOCK:
+            ACTIVE_MEASUREMENTS.remove(measurement)
+    if measurement["overlapped"]:
+        return
+    if isReset:
+        peakMB: Optional[float] = read_proc_status("VmHWM")
+    else:
+        peakMB = get_peak_rss()
+        if peakMB <= startPeakMB:
+            return
+    if peakMB is not None:
+        record_peak_memory(batchOutDir, kind, label, size, peakMB)
+#####################################################################################
+def record_peak_memory(batchOutDir: DirectoryPath, kind: str, label: str, size: float, peakMB: float) -> None:
+    """
+    Appends the peak memory of a task to 00_drMD_logs/memory_measurements.csv
+    Lines are appended without a header, so several processes can write to the file at once
+    """
+    measurementsFile: FilePath = get_measurements_file(batchOutDir)
+    os.makedirs(p.dirname(measurementsFile), exist_ok=True)
+    with open(measurementsFile, "a") as f:
+        f.write(f"{kind},{label},{size},{peakMB:.1f}\n")
+#####################################################################################
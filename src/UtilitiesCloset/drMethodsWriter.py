@@ -624,6 +624,11 @@ def write_per_step_simulation_methods(methodsFile: FilePath, sim: dict, stepInde
             else:
                 methods.write(f"This simulation was performed using a timestep of {sim['timestep']}. ")
 
+        ## deal with replicas
+        if sim.get("replicas", 1) > 1:
+            methods.write(f"This step, and each step following on from it, was run as {sim['replicas']} independent replicas. ")
+            methods.write(f"Each replica started from the same structure, with initial velocities drawn from a Maxwell-Boltzmann distribution using a different random seed. ")
+
         ## deal with metadynamics   
         if sim["simulationType"] == "META":
             write_metadynamics_simulation_methods(methodsFile, sim)
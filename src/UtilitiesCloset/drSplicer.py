@@ -7,9 +7,6 @@ import pandas as pd
 ## OPENMM LIBRARIES
 from openmm import unit
 
-## MDTRAJ LIBRARIES
-import mdtraj as md
-
 ## drMD LIBRARIES
 from ExaminationRoom import drLogger
 from UtilitiesCloset import drSelector
@@ -112,7 +109,8 @@ def merge_partial_reports(simDir: DirectoryPath, matchString: str, removePartial
 def merge_dcd_files(dcdFiles: list[FilePath],
                     pdbFile: FilePath,
                     outputDcd: FilePath) -> FilePath:
-    
+    ## mdtraj is only needed when partial trajectories are merged
+    import mdtraj as md
     traj = md.load_dcd(dcdFiles[0], top = pdbFile)
     for file in dcdFiles[1:]:
         newTraj = md.load_dcd(file, top = pdbFile)
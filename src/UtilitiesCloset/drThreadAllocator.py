@@ -0,0 +1,213 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import json
+import glob
+import multiprocessing as mp
+
+## CLEAN CODE
+from typing import Dict, List, Optional
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+#####################################################################################
+def get_allocation_file(batchOutDir: DirectoryPath) -> FilePath:
+    """
+    Returns the path of the file that tells running simulations how many CPU threads they may use
+    """
+    return p.join(batchOutDir, "00_drMD_logs", "thread_allocations.json")
+#####################################################################################
+def get_available_cpus() -> int:
+    """
+    Counts the CPU cores this process is allowed to run on
+    This respects cpusets set by schedulers like SLURM, where mp.cpu_count() would report the whole node
+    """
+    return len(get_available_cpu_ids())
+#####################################################################################
+def get_available_cpu_ids() -> List[int]:
+    """
+    Lists the ids of the CPU cores this process is allowed to run on
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(mp.cpu_count()))
+#####################################################################################
+def get_numa_nodes() -> List[List[int]]:
+    """
+    Groups the available CPU cores by NUMA node, using the topology in /sys
+    If the topology can't be read, all cores are treated as one node
+
+    Returns:
+        numaNodes (List[List[int]]): available core ids in each NUMA node
+    """
+    availableCpus: set = set(get_available_cpu_ids())
+    numaNodes: List[List[int]] = []
+    nodeDirs: List[DirectoryPath] = sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+                                             key=lambda nodeDir: int(p.basename(nodeDir)[4:]))
+    for nodeDir in nodeDirs:
+        try:
+            with open(p.join(nodeDir, "cpulist"), "r") as f:
+                nodeCpus: List[int] = parse_cpu_list(f.read())
+        except (OSError, ValueError):
+            return [sorted(availableCpus)]
+        nodeCpus = [cpuId for cpuId in nodeCpus if cpuId in availableCpus]
+        if len(nodeCpus) > 0:
+            numaNodes.append(nodeCpus)
+    ## cores missing from the topology are put in a node of their own
+    missingCpus: List[int] = sorted(availableCpus - set([cpuId for nodeCpus in numaNodes for cpuId in nodeCpus]))
+    if len(missingCpus) > 0:
+        numaNodes.append(missingCpus)
+    return numaNodes
+#####################################################################################
+def parse_cpu_list(cpuList: str) -> List[int]:
+    """
+    Parses a kernel cpulist string (eg. "0-3,8-11") into a list of core ids
+    """
+    cpuIds: List[int] = []
+    for cpuRange in cpuList.strip().split(","):
+        if cpuRange == "":
+            continue
+        if "-" in cpuRange:
+            start, end = cpuRange.split("-")
+            cpuIds.extend(range(int(start), int(end) + 1))
+        else:
+            cpuIds.append(int(cpuRange))
+    return cpuIds
+#####################################################################################
+def assign_core_sets(nSlots: int, coresPerSlot: int) -> List[List[int]]:
+    """
+    Gives each simulation slot its own set of CPU cores
+    Slots are filled from one NUMA node at a time, so that a slot's threads share a memory controller
+    Cores left over on each node are pooled for slots that can't fit inside a single node
+    The kernel lists physical cores before their hyperthread siblings, so consecutive cores are used
+
+    Args:
+        nSlots (int): number of simulation slots (parallelCPU)
+        coresPerSlot (int): cores for each slot (subprocessCpus)
+
+    Returns:
+        coreSets (List[List[int]]): core ids for each slot
+    """
+    coreSets: List[List[int]] = []
+    leftoverCpus: List[int] = []
+    for nodeCpus in get_numa_nodes():
+        while len(nodeCpus) >= coresPerSlot and len(coreSets) < nSlots:
+            coreSets.append(nodeCpus[:coresPerSlot])
+            nodeCpus = nodeCpus[coresPerSlot:]
+        leftoverCpus.extend(nodeCpus)
+    while len(leftoverCpus) >= coresPerSlot and len(coreSets) < nSlots:
+        coreSets.append(leftoverCpus[:coresPerSlot])
+        leftoverCpus = leftoverCpus[coresPerSlot:]
+    ## if more cores were asked for than are available, slots have to share cores
+    allCpus: List[int] = get_available_cpu_ids()
+    while len(coreSets) < nSlots:
+        firstCore: int = (len(coreSets) * coresPerSlot) % len(allCpus)
+        coreSets.append([allCpus[(firstCore + offset) % len(allCpus)] for offset in range(min(coresPerSlot, len(allCpus)))])
+    return coreSets
+#####################################################################################
+def balance_threads(systemNames: List[str], totalCpus: int, minThreads: int) -> Dict[str, int]:
+    """
+    Shares CPU cores evenly between running systems
+    Cores that don't divide evenly go to the systems that started first
+
+    Args:
+        systemNames (List[str]): names of running systems, in the order they started
+        totalCpus (int): CPU cores to share
+        minThreads (int): no system gets fewer threads than this
+
+    Returns:
+        allocations (Dict[str, int]): threads for each system
+    """
+    if len(systemNames) == 0:
+        return {}
+    threadsEach, spareCpus = divmod(totalCpus, len(systemNames))
+    return {systemName: max(minThreads, threadsEach + (1 if index < spareCpus else 0))
+            for index, systemName in enumerate(systemNames)}
+#####################################################################################
+def balance_core_sets(runningCoreSets: Dict[str, List[int]]) -> Dict[str, List[int]]:
+    """
+    Shares the available CPU cores between running systems that are pinned to core sets
+    Each system keeps its own cores and is topped up with free cores, from its own NUMA node where possible
+
+    Args:
+        runningCoreSets (Dict[str, List[int]]): current core set of each running system, in the order they started
+
+    Returns:
+        coreSets (Dict[str, List[int]]): new core set of each running system
+    """
+    allCpus: List[int] = get_available_cpu_ids()
+    nodeOfCpu: Dict[int, int] = {cpuId: nodeIndex for nodeIndex, nodeCpus in enumerate(get_numa_nodes()) for cpuId in nodeCpus}
+    usedCpus: set = set([cpuId for coreSet in runningCoreSets.values() for cpuId in coreSet])
+    freeCpus: List[int] = [cpuId for cpuId in allCpus if cpuId not in usedCpus]
+    targetThreads: Dict[str, int] = balance_threads(list(runningCoreSets), len(allCpus), 1)
+
+    coreSets: Dict[str, List[int]] = {}
+    for systemName, coreSet in runningCoreSets.items():
+        coreSet = list(coreSet)
+        homeNode: Optional[int] = nodeOfCpu.get(coreSet[0], None) if len(coreSet) > 0 else None
+        ## free cores on the same node come first
+        freeCpus.sort(key=lambda cpuId: nodeOfCpu.get(cpuId, -1) != homeNode)
+        while len(coreSet) < targetThreads[systemName] and len(freeCpus) > 0:
+            coreSet.append(freeCpus.pop(0))
+        coreSets[systemName] = sorted(coreSet)
+    return coreSets
+#####################################################################################
+def write_thread_allocations(batchOutDir: DirectoryPath,
+                              threadAllocations: Dict[str, int],
+                                cpuAllocations: Optional[Dict[str, List[int]]] = None) -> None:
+    """
+    Writes thread allocations (and core sets, if simulations are pinned) to a temporary file,
+    then renames it over the allocation file
+    The rename is atomic, so simulations never read a half written file
+    """
+    allocationFile: FilePath = get_allocation_file(batchOutDir)
+    tmpFile: FilePath = f"{allocationFile}.{os.getpid()}.tmp"
+    with open(tmpFile, "w") as f:
+        json.dump({"threads": threadAllocations, "cpus": cpuAllocations or {}}, f)
+    os.replace(tmpFile, allocationFile)
+#####################################################################################
+def clear_thread_allocations(batchOutDir: DirectoryPath) -> None:
+    """
+    Removes the allocation file left by a previous run of a batch
+    """
+    allocationFile: FilePath = get_allocation_file(batchOutDir)
+    if p.isfile(allocationFile):
+        os.remove(allocationFile)
+#####################################################################################
+def read_allocations(runConfig: Dict) -> Dict[str, Dict]:
+    """
+    Reads the allocation file of the batch a system belongs to
+    """
+    allocationFile: FilePath = get_allocation_file(p.dirname(runConfig["pathInfo"]["outputDir"]))
+    try:
+        with open(allocationFile, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+#####################################################################################
+def read_thread_allocation(runConfig: Dict) -> Optional[int]:
+    """
+    Reads the number of threads allocated to a system, or None if it has no allocation
+
+    Args:
+        runConfig (dict): per-system config dictionary
+
+    Returns:
+        threads (Optional[int]): threads allocated to this system
+    """
+    return read_allocations(runConfig).get("threads", {}).get(runConfig["proteinInfo"]["proteinName"], None)
+#####################################################################################
+def read_cpu_allocation(runConfig: Dict) -> Optional[List[int]]:
+    """
+    Reads the core set allocated to a pinned system, or None if it is not pinned
+    """
+    return read_allocations(runConfig).get("cpus", {}).get(runConfig["proteinInfo"]["proteinName"], None)
+#####################################################################################
+def pin_to_cpus(cpuIds: List[int]) -> None:
+    """
+    Restricts the calling process to a set of CPU cores
+    Threads started afterwards (eg. OpenMM's thread pool) inherit this core set
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpuIds)
+#####################################################################################
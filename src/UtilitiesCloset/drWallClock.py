@@ -0,0 +1,185 @@
+## BASIC PYTHON LIBRARIES
+import os
+import time
+import signal
+
+## CLEAN CODE
+from typing import Dict, List, Optional, Set
+
+## exit code used when drMD stops to stay inside wallTimeBudget, or after SIGTERM / SIGINT (EX_TEMPFAIL)
+## resubmitting the same batch carries on from where it stopped
+RESUMABLE_EXIT_CODE: int = 75
+## seconds kept back to write checkpoints and exit cleanly
+SAFETY_MARGIN: float = 60.0
+## set by the stop handlers when SIGTERM or SIGINT is received
+STOP_SIGNAL: Optional[int] = None
+## whether a second stop signal kills this process, see install_stop_handlers
+FORCE_STOP_ON_REPEAT: bool = True
+## system processes started by this process, killed along with it by a second stop signal
+CHILD_PIDS: Set[int] = set()
+## set when the system running in this process must stop, while the rest of the batch carries on
+SYSTEM_STOP_REASON: Optional[str] = None
+
+#####################################################################################
+class WallTimeExceeded(Exception):
+    """
+    Raised when there is not enough of wallTimeBudget left to carry on safely
+    """
+    pass
+#####################################################################################
+class StopRequested(WallTimeExceeded):
+    """
+    Raised when drMD has received SIGTERM or SIGINT
+    Running steps are checkpointed and paused in the same way as when wallTimeBudget runs out
+    """
+    pass
+#####################################################################################
+class SystemStopped(WallTimeExceeded):
+    """
+    Raised when the system running in this process has been stopped on its own,
+    eg. because another worker has taken over its claim, see stop_system
+    Steps stop between chunks in the same way as for StopRequested, but the batch is not paused
+    """
+    pass
+#####################################################################################
+def install_stop_handlers(forceStopOnRepeat: bool = True) -> None:
+    """
+    Makes SIGTERM and SIGINT ask drMD to stop at the next safe point, rather than killing it
+    A second signal kills drMD straight away, along with any system processes it has started
+
+    System processes are started with forceStopOnRepeat=False. Schedulers and Ctrl-C signal every process
+    in the job, and the supervisor passes the signal on as well, so a system process often gets the same
+    stop twice. It ignores repeats and is left to checkpoint, or is killed by a supervisor that gets a second signal
+
+    Args:
+        forceStopOnRepeat (bool): whether a second signal kills this process
+    """
+    global FORCE_STOP_ON_REPEAT
+    FORCE_STOP_ON_REPEAT = forceStopOnRepeat
+    for stopSignal in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(stopSignal, request_stop)
+#####################################################################################
+def request_stop(signum: int, frame: object) -> None:
+    global STOP_SIGNAL
+    if STOP_SIGNAL is None:
+        STOP_SIGNAL = signum
+        return
+    if not FORCE_STOP_ON_REPEAT:
+        return
+    for childPid in CHILD_PIDS:
+        try:
+            os.kill(childPid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+#####################################################################################
+def track_child(pid: int) -> None:
+    """
+    Adds a system process to those killed along with this one by a second stop signal
+    """
+    CHILD_PIDS.add(pid)
+#####################################################################################
+def untrack_child(pid: int) -> None:
+    CHILD_PIDS.discard(pid)
+#####################################################################################
+def stop_requested() -> bool:
+    return STOP_SIGNAL is not None
+#####################################################################################
+def stop_system(reason: str) -> None:
+    """
+    Asks the system running in this process to stop at the next safe point, raising SystemStopped
+    Can be called from any thread
+    """
+    global SYSTEM_STOP_REASON
+    SYSTEM_STOP_REASON = reason
+#####################################################################################
+def clear_system_stop() -> None:
+    global SYSTEM_STOP_REASON
+    SYSTEM_STOP_REASON = None
+#####################################################################################
+def make_stop_error(label: str) -> WallTimeExceeded:
+    """
+    Returns SystemStopped if the running system has been stopped on its own,
+    StopRequested if a stop signal has been received, otherwise WallTimeExceeded
+    """
+    if SYSTEM_STOP_REASON is not None:
+        return SystemStopped(f"{SYSTEM_STOP_REASON}, stopping {label}")
+    if STOP_SIGNAL is not None:
+        return StopRequested(f"{signal.Signals(STOP_SIGNAL).name} received, stopping {label}")
+    return WallTimeExceeded(f"wallTimeBudget reached {label}")
+#####################################################################################
+def start_wall_clock() -> None:
+    """
+    Records when this drMD run started, child processes inherit it through the environment
+    """
+    os.environ["DRMD_START_TIME"] = str(time.time())
+#####################################################################################
+def get_start_time() -> float:
+    """
+    Returns when this drMD run started, starting the clock if no run has
+    """
+    if "DRMD_START_TIME" not in os.environ:
+        start_wall_clock()
+    return float(os.environ["DRMD_START_TIME"])
+#####################################################################################
+def parse_wall_time(wallTimeInput: object) -> Optional[float]:
+    """
+    Converts a wall time into seconds
+    Accepts scheduler style times ("HH:MM:SS" or "D-HH:MM:SS"), drMD style times ("12 h") or plain seconds
+
+    Args:
+        wallTimeInput (str | None): wallTimeBudget from hardwareInfo
+
+    Returns:
+        seconds (Optional[float]): the wall time in seconds, or None if there is no budget
+    """
+    if wallTimeInput is None:
+        return None
+    ## YAML reads an unquoted 23:30:00 as a number of seconds
+    if isinstance(wallTimeInput, (int, float)) and not isinstance(wallTimeInput, bool):
+        return float(wallTimeInput)
+    wallTimeInput = str(wallTimeInput).strip()
+    if ":" in wallTimeInput:
+        days: int = 0
+        if "-" in wallTimeInput:
+            dayText, wallTimeInput = wallTimeInput.split("-")
+            days = int(dayText)
+        timeParts: List[float] = [float(part) for part in wallTimeInput.split(":")]
+        seconds: float = 0
+        for timePart in timeParts:
+            seconds = seconds * 60 + timePart
+        return days * 86400 + seconds
+    timescale: Dict[str, float] = {"s": 1, "min": 60, "h": 3600, "day": 86400}
+    timeData: List[str] = wallTimeInput.split()
+    if len(timeData) != 2 or timeData[1] not in timescale:
+        raise ValueError(f"Could not read wall time {wallTimeInput}, use the format \"12 h\" or \"12:00:00\"")
+    return float(timeData[0]) * timescale[timeData[1]]
+#####################################################################################
+def get_time_left(hardwareInfo: Dict) -> Optional[float]:
+    """
+    Returns the seconds left in wallTimeBudget, or None if there is no budget
+    """
+    wallTimeBudget: Optional[float] = parse_wall_time(hardwareInfo.get("wallTimeBudget", None))
+    if wallTimeBudget is None:
+        return None
+    return wallTimeBudget - (time.time() - get_start_time())
+#####################################################################################
+def has_time_for(hardwareInfo: Dict, seconds: float) -> bool:
+    """
+    Checks whether a task predicted to take this many seconds can finish inside wallTimeBudget
+    Always False once drMD, or the system running in this process, has been asked to stop
+    """
+    if stop_requested() or SYSTEM_STOP_REASON is not None:
+        return False
+    timeLeft: Optional[float] = get_time_left(hardwareInfo)
+    return timeLeft is None or timeLeft > seconds + SAFETY_MARGIN
+#####################################################################################
+def check_time_left(hardwareInfo: Dict, label: str) -> None:
+    """
+    Raises WallTimeExceeded instead of starting a task when wallTimeBudget has (almost) run out,
+    or StopRequested if drMD has been asked to stop
+    """
+    if not has_time_for(hardwareInfo, 0):
+        raise make_stop_error(f"before {label}")
+#####################################################################################
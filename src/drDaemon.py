@@ -0,0 +1,223 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import sys
+import copy
+import json
+import socket
+import socketserver
+import threading
+import argpass
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+## drMD LIBRARIES
+import drMD
+from Triage import drConfigTriage
+from ExaminationRoom import drLogger
+from UtilitiesCloset import drSplash
+
+## CLEAN CODE
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
+
+######################################################################################################
+def main() -> None:
+    """
+    Runs a long-lived drMD daemon, or submits a batch to one
+
+    Start a daemon with 8 warm workers, each running simulations on 2 threads:
+        python drDaemon.py --socket /tmp/drMD.sock --workers 8 --threads 2
+    Submit a batch and print status updates until it has finished:
+        python drDaemon.py --socket /tmp/drMD.sock --submit config.yaml
+    """
+    parser = argpass.ArgumentParser()
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--submit", default=None)
+    args = parser.parse_args()
+
+    if args.submit is not None:
+        ## status updates are printed as they arrive, the exit code says whether every system finished
+        allSucceeded: bool = True
+        for statusUpdate in submit_to_daemon(args.socket, p.abspath(args.submit)):
+            print(json.dumps(statusUpdate), flush=True)
+            if statusUpdate["status"] in ["failed", "rejected"]:
+                allSucceeded = False
+        sys.exit(0 if allSucceeded else 1)
+
+    drSplash.print_drMD_logo()
+    DrMDDaemon(args.socket, args.workers, args.threads).serve_forever()
+######################################################################################################
+def submit_to_daemon(socketPath: FilePath, batchConfig: Union[Dict, FilePath]) -> Iterator[Dict]:
+    """
+    Submits a batch to a running daemon and yields its status updates as they arrive
+    Each update is a dictionary with a "status" key:
+        queued, done or failed for each system (with its "system" name)
+        rejected if the batch config is not valid
+        batch_done once every system and aftercare has finished
+
+    Args:
+        socketPath (FilePath): the Unix socket the daemon is listening on
+        batchConfig (Union[Dict, FilePath]): a batch config dictionary, or the path to a batch config YAML file
+
+    Yields:
+        statusUpdate (Dict): status updates from the daemon
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socketPath)
+        connection.sendall((json.dumps({"batchConfig": batchConfig}) + "\n").encode())
+        with connection.makefile("r") as replies:
+            for reply in replies:
+                statusUpdate: Dict = json.loads(reply)
+                yield statusUpdate
+                if statusUpdate["status"] in ["batch_done", "rejected"]:
+                    return
+######################################################################################################
+def warm_up_worker(subprocessCpus: int) -> None:
+    """
+    Initialiser for daemon workers
+    Sets thread counts, then imports the simulation stack and loads the OpenMM platform plugins
+    so that none of this is repeated when a system is run
+    """
+    drMD.manage_cpu_usage_for_subprocesses("ON", subprocessCpus)
+    import openmm
+    from Surgery import drOperator, drSim, drPrep
+    for platformIndex in range(openmm.Platform.getNumPlatforms()):
+        openmm.Platform.getPlatform(platformIndex).getName()
+######################################################################################################
+def run_daemon_system(pdbFile: FilePath, batchConfig: Dict) -> Optional[Dict]:
+    """
+    Runs one system of a submitted batch in a warm worker, through the same path as drMD.py
+    """
+    errorData: Optional[Dict] = drMD.process_pdb_file(pdbFile, batchConfig)
+    drMD.drCheckup.wait_for_checkups()
+    return errorData
+######################################################################################################
+class DrMDDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A Unix socket server that keeps a pool of warm workers between batches
+    Each connection submits one batch, which is handled in its own thread
+    Systems from every batch share the same pool, first come first served
+    """
+    daemon_threads = True
+
+    def __init__(self, socketPath: FilePath, nWorkers: int, subprocessCpus: int):
+        if p.exists(socketPath):
+            os.remove(socketPath)
+        self.nWorkers: int = nWorkers
+        self.subprocessCpus: int = subprocessCpus
+        self.poolLock = threading.Lock()
+        self.executor: ProcessPoolExecutor = self.make_executor()
+        super().__init__(socketPath, DrMDRequestHandler)
+        drLogger.log_info(f"drMD daemon listening on {socketPath} with {nWorkers} warm workers", True, True)
+
+    def make_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.nWorkers,
+                                    initializer=warm_up_worker,
+                                      initargs=(self.subprocessCpus,))
+
+    def submit(self, function, *args) -> Future:
+        """
+        Submits work to the warm pool, replacing the pool if a worker has died
+        """
+        with self.poolLock:
+            try:
+                return self.executor.submit(function, *args)
+            except BrokenProcessPool:
+                drLogger.log_info("A daemon worker died, starting a new pool", True, True)
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.make_executor()
+                return self.executor.submit(function, *args)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+######################################################################################################
+class DrMDRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads a batch submission from a client, runs it and streams status updates back
+    """
+    def handle(self) -> None:
+        try:
+            request: Dict = json.loads(self.rfile.readline())
+            batchConfig, pdbFiles = prepare_batch(request["batchConfig"], self.server.nWorkers, self.server.subprocessCpus)
+        except (ValueError, KeyError, SystemExit) as e:
+            self.send_status({"status": "rejected", "error": str(e)})
+            return
+
+        systemFutures: Dict[Future, str] = {}
+        pdbFilesByName: Dict[str, FilePath] = {}
+        for pdbFile in pdbFiles:
+            pdbName: str = p.splitext(p.basename(pdbFile))[0]
+            pdbFilesByName[pdbName] = pdbFile
+            systemFutures[self.server.submit(run_daemon_system, pdbFile, batchConfig)] = pdbName
+            self.send_status({"status": "queued", "system": pdbName})
+
+        ## a worker that dies breaks the whole pool, taking down every queued system of every batch with it,
+        ## so systems that failed that way are resumed in the new pool up to workerCrashRetries times
+        workerCrashRetries: int = batchConfig["miscInfo"]["workerCrashRetries"]
+        crashCounts: Dict[str, int] = {}
+        while len(systemFutures) > 0:
+            doneFutures, _ = wait(systemFutures, return_when=FIRST_COMPLETED)
+            for future in doneFutures:
+                pdbName = systemFutures.pop(future)
+                try:
+                    errorData: Optional[Dict] = future.result()
+                except BrokenProcessPool as e:
+                    crashCounts[pdbName] = crashCounts.get(pdbName, 0) + 1
+                    if crashCounts[pdbName] <= workerCrashRetries:
+                        drLogger.log_info(f"Worker pool broke while running {pdbName}, retrying ({crashCounts[pdbName]}/{workerCrashRetries})", True, True)
+                        systemFutures[self.server.submit(run_daemon_system, pdbFilesByName[pdbName], batchConfig)] = pdbName
+                        continue
+                    errorData = {"pdbName": pdbName, "errorType": "WorkerCrash", "errorMessage": str(e)}
+                except Exception as e:
+                    errorData = {"pdbName": pdbName, "errorType": type(e).__name__, "errorMessage": str(e)}
+                if errorData is None:
+                    self.send_status({"status": "done", "system": pdbName,
+                                       "runDir": p.join(batchConfig["pathInfo"]["outputDir"], pdbName)})
+                else:
+                    self.send_status({"status": "failed", "system": pdbName,
+                                       "error": errorData.get("errorMessage", str(errorData))})
+
+        ## aftercare imports plotting libraries, so it is run in a worker rather than the daemon
+        try:
+            self.server.submit(drMD.run_aftercare, batchConfig).result()
+        except Exception as e:
+            drLogger.log_info(f"Aftercare failed for {batchConfig['pathInfo']['outputDir']}: {e}", True, True)
+        self.send_status({"status": "batch_done", "outputDir": batchConfig["pathInfo"]["outputDir"]})
+
+    def send_status(self, statusUpdate: Dict) -> None:
+        ## a client that has gone away does not stop its batch
+        try:
+            self.wfile.write((json.dumps(statusUpdate) + "\n").encode())
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+######################################################################################################
+def prepare_batch(batchConfig: Union[Dict, FilePath], nWorkers: int, subprocessCpus: int) -> Tuple[Dict, List[FilePath]]:
+    """
+    Reads and validates a submitted batch config, sets up its output directory
+    and works out which systems still need to be run
+    The daemon's own workers and threads replace parallelCPU and subprocessCpus, and wallTimeBudget is ignored
+
+    Returns:
+        batchConfig (dict): the validated batch config
+        pdbFiles (List[FilePath]): systems to run, most expensive first
+    """
+    if isinstance(batchConfig, dict):
+        batchConfig = copy.deepcopy(batchConfig)
+    else:
+        batchConfig = drConfigTriage.read_input_yaml(batchConfig)
+    batchConfig = drConfigTriage.validate_config(batchConfig)
+    batchConfig["hardwareInfo"]["parallelCPU"] = nWorkers
+    batchConfig["hardwareInfo"]["subprocessCpus"] = subprocessCpus
+    ## the daemon outlives any scheduler allocation, so batches are never paused for wall time
+    batchConfig["hardwareInfo"]["wallTimeBudget"] = None
+    drMD.set_up_batch(batchConfig)
+    pdbFiles: List[FilePath] = drMD.plan_remaining_systems(batchConfig)
+    return batchConfig, pdbFiles
+######################################################################################################
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,44 @@
 ## BASIC PYTHON LIBRARIES
 import os
 from os import path as p
-import numpy as np
+import sys
 import yaml
-import itertools
+import threading
+import copy
 
 ## ERROR HANDLING ##
 import traceback
 import inspect
 
 ## PARALLELISATION LIBRARIES
+import multiprocessing as mp
+import multiprocessing.connection
+from queue import Queue, Empty
+from collections import deque
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait
 
 ## CUSTOM DR MD MODULES
-from Triage import drConfigTriage, drPdbTriage, drConfigWriter
+from Triage import drConfigTriage, drPdbTriage, drConfigWriter, drBatchPlanner
 from Surgery import drOperator
-from ExaminationRoom import  drCleanup, drLogger
-from UtilitiesCloset import drSplash, drMethodsWriter
+## drCleanup and drMethodsWriter are imported in run_aftercare, simulation workers don't need them
+from ExaminationRoom import drLogger, drCheckup
+from UtilitiesCloset import drSplash, drClaimer, drLedger, drThreadAllocator, drWallClock
 
 ## CLEAN CODE
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, List, Iterator, Union
 from UtilitiesCloset.drCustomClasses import FilePath, DirectoryPath
 
+## results from system processes that have been read from the result queue, but not yet collected
+RESULTS_RECEIVED: Dict[str, Optional[Dict]] = {}
+## seconds the supervisor waits for a system process to exit before checking for stop signals
+SUPERVISOR_POLL: float = 1.0
+## seconds to wait for the result of a system process that has exited cleanly, before treating it as a crash
+RESULT_TIMEOUT: float = 30.0
+## yielded by iterate_queue when the next system has not been prepared yet
+QUEUE_EMPTY: str = "queue empty"
 ######################################################################################################
-def main(batchConfigYaml: Optional[FilePath] = None) -> None:
+def main(batchConfigYaml: Optional[FilePath] = None, workerMode: bool = False) -> None:
     '''
     Main function for drMD
     Unpacks batchConfig dictionary 
@@ -35,16 +46,23 @@ def main(batchConfigYaml: Optional[FilePath] = None) -> None:
     Based on desired CPU useage, manages CPU useage per run
 
     Args:
-        Nothing
+        batchConfigYaml (FilePath): path to the batch config file, read from the command line if not given
+        workerMode (bool): if True, claim systems through lock files in 00_drMD_logs
+                            so that several drMD processes (on one or many nodes) can share a batch
     Returns:
         Nothing
     '''
+    ## wallTimeBudget is counted from here, and SIGTERM / SIGINT pause the batch rather than killing it
+    drWallClock.start_wall_clock()
+    drWallClock.install_stop_handlers()
     ## print drMD logo
     drSplash.print_drMD_logo()
 
     ## if run from command line, use argpass to get batch config file
-    if __name__ == "__main__":
-        batchConfigYaml: FilePath = drConfigTriage.get_config_input_arg()
+    if batchConfigYaml is None:
+        commandLineArgs = drConfigTriage.get_command_line_args()
+        batchConfigYaml: FilePath = commandLineArgs.config
+        workerMode: bool = commandLineArgs.worker
     ## read bacth config file into a dictionary
     try:
         batchConfig: dict = drConfigTriage.read_input_yaml(batchConfigYaml)
@@ -52,13 +70,133 @@ def main(batchConfigYaml: Optional[FilePath] = None) -> None:
         drSplash.print_config_error(e)
 
     batchConfig  = drConfigTriage.validate_config(batchConfig)
+    ## choose parallelCPU and subprocessCpus if set to "auto", and predict when each system will finish
+    batchConfig = drBatchPlanner.plan_hardware(batchConfig)
 
     ## unpack batchConfig into variables for this function
     outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
-    yamlDir: DirectoryPath = p.join(outDir,"00_configs")
-    pdbDir: DirectoryPath = batchConfig["pathInfo"]["inputDir"]
-    parallelCPU: int = batchConfig["hardwareInfo"]["parallelCPU"]
     subprocessCpus: int = batchConfig["hardwareInfo"]["subprocessCpus"]
+    parallelPrep: int = batchConfig["hardwareInfo"]["parallelPrep"]
+
+    ## in worker mode, only one worker runs each shared (non per-system) task
+    claimDir: Optional[DirectoryPath] = drClaimer.get_claim_dir(outDir) if workerMode else None
+    claimTimeout: int = batchConfig["hardwareInfo"]["claimTimeout"]
+
+    ## make output directories and run pdbTriage
+    set_up_batch(batchConfig, workerMode)
+
+    ## set environment variables for OpenMP and OpenMM - this should limit their CPU useage
+    manage_cpu_usage_for_subprocesses("ON",subprocessCpus)
+
+    if parallelPrep > 0 and workerMode:
+        drLogger.log_info("parallelPrep is not used in worker mode, systems will be prepared in their simulation slots", True, True)
+    ## screening rounds need every system to finish a round before the next one starts
+    screeningInfo: Optional[Dict] = batchConfig.get("screeningInfo", None)
+    if screeningInfo is not None and workerMode:
+        drLogger.log_info("screeningInfo is not used in worker mode, every system will run the whole protocol", True, True)
+    ## mutants can only be built once the wild type has finished fromStep
+    mutantInfo: Optional[Dict] = batchConfig.get("mutantInfo", None)
+    if mutantInfo is not None and workerMode:
+        drLogger.log_info("mutantInfo is not used in worker mode, no mutants will be built", True, True)
+    try:
+        if screeningInfo is not None and not workerMode:
+            run_screening(batchConfig)
+        elif mutantInfo is not None and not workerMode:
+            run_mutant_scan(batchConfig)
+        else:
+            run_batch(batchConfig, workerMode)
+    ## running steps have been checkpointed, resubmitting the batch carries on from there
+    except drWallClock.WallTimeExceeded as e:
+        drCheckup.wait_for_checkups()
+        drLogger.log_info(f"{e}, exiting with code {drWallClock.RESUMABLE_EXIT_CODE}. Resubmit this batch to carry on", True, True)
+        manage_cpu_usage_for_subprocesses("OFF")
+        sys.exit(drWallClock.RESUMABLE_EXIT_CODE)
+
+    ## in worker mode, aftercare is run once for each set of finished systems, by whichever worker claims it
+    if workerMode:
+        ledgerFile: FilePath = drLedger.get_ledger_file(outDir)
+        aftercareHash: str = drLedger.hash_batch_task(batchConfig,
+                                                       drLedger.get_finished_systems(ledgerFile, drLedger.hash_batch_config(batchConfig)))
+        if not drClaimer.claim_task(claimDir, "00_aftercare", claimTimeout, aftercareHash):
+            drLogger.log_info("Aftercare is being handled by another worker", True, True)
+            manage_cpu_usage_for_subprocesses("OFF")
+            return
+
+    run_aftercare(batchConfig)
+    if workerMode:
+        drClaimer.release_task(claimDir, "00_aftercare", succeeded=True, taskHash=aftercareHash)
+
+    ## unset envorment variables for OpenMP and OpenMM
+    manage_cpu_usage_for_subprocesses("OFF")
+######################################################################################################
+def run_batch(batchConfig: Dict, workerMode: bool = False, pdbFiles: Optional[List[FilePath]] = None) -> None:
+    """
+    Runs systems in serial, in parallel or through the prep pipeline, depending on hardwareInfo
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+        workerMode (bool): whether drMD is running in worker mode
+        pdbFiles (List[FilePath], optional): systems to run, every PDB file in inputDir if not given
+    """
+    parallelCPU: int = batchConfig["hardwareInfo"]["parallelCPU"]
+    parallelPrep: int = batchConfig["hardwareInfo"]["parallelPrep"]
+    ## stalled simulations can only be restarted when each system runs in its own process
+    stallTolerance: float = batchConfig["miscInfo"]["stallTolerance"]
+    if parallelPrep > 0 and not workerMode:
+        run_pipelined(batchConfig, pdbFiles)
+    elif parallelCPU == 1 and stallTolerance == 0:
+        run_serial(batchConfig, workerMode, pdbFiles)
+    else:
+        run_parallel(batchConfig, workerMode, pdbFiles)
+######################################################################################################
+def run_screening(batchConfig: Dict) -> None:
+    """
+    Runs a batch as successive rounds of screening
+    Every system runs up to the first step in screeningInfo.stepNames, then only the most stable
+    keepFraction of them carry on to the next step in stepNames, and so on.
+    Survivors carry on from the end of the step they were screened on, rather than starting again
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary, with screeningInfo
+    """
+    from ExaminationRoom import drScreener
+    pdbFiles: List[FilePath] = drBatchPlanner.get_pdb_files(batchConfig)
+    for roundIndex, (roundConfig, roundStepName) in enumerate(drScreener.get_screening_rounds(batchConfig)):
+        if len(pdbFiles) == 0:
+            break
+        drLogger.log_info(f"Screening round {roundIndex + 1}: running {len(pdbFiles)} systems up to {roundStepName or 'the end of the protocol'}", True, True)
+        run_batch(roundConfig, False, pdbFiles)
+        if roundStepName is not None:
+            pdbFiles = drScreener.select_survivors(batchConfig, pdbFiles, roundStepName)
+######################################################################################################
+def run_mutant_scan(batchConfig: Dict) -> None:
+    """
+    Runs a batch as a mutant scan
+    The wild type is run up to mutantInfo.fromStep, then each mutant is built from its equilibrated coordinates.
+    Mutants are minimised and relaxed around their mutations, then run the steps after fromStep,
+    scheduled together with the rest of the wild type protocol and any other systems in inputDir
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary, with mutantInfo
+    """
+    from Surgery import drMutator
+    wildTypePdb: FilePath = drMutator.get_wild_type_pdb(batchConfig)
+    drLogger.log_info(f"Mutant scan: running {p.splitext(p.basename(wildTypePdb))[0]} up to {batchConfig['mutantInfo']['fromStep']}", True, True)
+    run_batch(drMutator.get_wild_type_config(batchConfig), False, [wildTypePdb])
+    mutantPdbs: List[FilePath] = drMutator.build_mutants(batchConfig)
+    run_batch(batchConfig, False, drBatchPlanner.get_pdb_files(batchConfig) + mutantPdbs)
+######################################################################################################
+def set_up_batch(batchConfig: Dict, workerMode: bool = False) -> None:
+    '''
+    Creates the log and config directories for a batch and runs pdbTriage
+    In worker mode, pdbTriage is only run by the worker that claims it
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+        workerMode (bool): whether drMD is running in worker mode
+    '''
+    outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
+    pdbDir: DirectoryPath = batchConfig["pathInfo"]["inputDir"]
 
     ## create logDir if it doesn't exist
     logDir: DirectoryPath = p.join(outDir, "00_drMD_logs")
@@ -68,25 +206,38 @@ def main(batchConfigYaml: Optional[FilePath] = None) -> None:
     if not skipPdbTriage:
         ## run pdbTriage to detect commmon problems with pdb files
         pdbTriageLog = p.join(logDir,"pdb_triage.log")
-        if not p.exists(pdbTriageLog):
+        if not workerMode and not p.exists(pdbTriageLog):
             drPdbTriage.pdb_triage(pdbDir, batchConfig)
-
-    ## set environment variables for OpenMP and OpenMM - this should limit their CPU useage
-    manage_cpu_usage_for_subprocesses("ON",subprocessCpus)
+        elif workerMode:
+            claimDir: DirectoryPath = drClaimer.get_claim_dir(outDir)
+            ## pdbTriage is run again when PDB files are added to inputDir or the config changes
+            triageHash: str = drLedger.hash_batch_task(batchConfig, [drClaimer.get_task_name(pdbFile)
+                                                                     for pdbFile in drBatchPlanner.get_pdb_files(batchConfig)])
+            if drClaimer.claim_task(claimDir, "00_pdb_triage", batchConfig["hardwareInfo"]["claimTimeout"], triageHash):
+                drPdbTriage.pdb_triage(pdbDir, batchConfig)
+                drClaimer.release_task(claimDir, "00_pdb_triage", succeeded=True, taskHash=triageHash)
 
     ## create yamlDir if it doesn't exist, this will be used to store per-run yaml files
-    os.makedirs(yamlDir,exist_ok=True)
-    ## run simulations in serial or paralell
-    if parallelCPU == 1:
-        run_serial(batchConfig)
-    elif parallelCPU > 1:
-        run_parallel(batchConfig)
+    os.makedirs(p.join(outDir,"00_configs"),exist_ok=True)
+######################################################################################################
+def run_aftercare(batchConfig: Dict) -> None:
+    '''
+    Runs post simulation operations once every system in a batch has finished
+    Writes a methods section if desired, then runs drCleanup
 
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+    '''
+    from ExaminationRoom import drCleanup
+    from UtilitiesCloset import drMethodsWriter
+
+    outDir: DirectoryPath = batchConfig["pathInfo"]["outputDir"]
+    yamlDir: DirectoryPath = p.join(outDir,"00_configs")
     ## write a methods section if desired
     writeMyMethodsSection = batchConfig["miscInfo"].get("writeMyMethodsSection", False)
 
     ## set up logging for post simulation processes
-    drLogger.setup_logging(p.join(batchConfig["pathInfo"]["outputDir"], "00_drMD_logs", "aftercare.log"))
+    drLogger.setup_logging(p.join(outDir, "00_drMD_logs", "aftercare.log"))
     ## write methods section if desired
     if writeMyMethodsSection:
         try:
@@ -100,9 +251,6 @@ def main(batchConfigYaml: Optional[FilePath] = None) -> None:
     ## close logging for post simulation processes
     drLogger.close_logging()
 
-    ## unset envorment variables for OpenMP and OpenMM
-    manage_cpu_usage_for_subprocesses("OFF")
-
 ######################################################################################################
 def manage_cpu_usage_for_subprocesses(mode: str, subprocessCpus: Optional[int] = None) -> None:
     '''
@@ -130,39 +278,156 @@ def manage_cpu_usage_for_subprocesses(mode: str, subprocessCpus: Optional[int] =
 
 
 ###################################################################################################### 
-def run_serial(batchConfig: Dict) -> None:
+def run_serial(batchConfig: Dict, workerMode: bool = False, pdbFiles: Optional[List[FilePath]] = None) -> None:
     """
     Process each PDB file in the given directory serially.
 
     Args:
         batchConfig (dict): Batch configuration dictionary.
-        pdbDir (str): Path to the directory containing PDB files.
-        outDir (str): Path to the output directory.
-        yamlDir (str): Path to the directory to write YAML configuration files.
-        simInfo (dict): Simulation information dictionary.
+        workerMode (bool): if True, only process PDB files claimed by this worker
+        pdbFiles (List[FilePath], optional): systems to run, every PDB file in inputDir if not given
 
     Returns:
         None
     """
     botchedSimulations = []
-    ## unpack batchConfig to get pdbDir
-    pdbDir: DirectoryPath = batchConfig["pathInfo"]["inputDir"]
-    ## create a list of PDB files
-    pdbFiles = [p.join(pdbDir, pdbFile) for pdbFile in os.listdir(pdbDir) if p.splitext(pdbFile)[1] == ".pdb"]
+    ## create a list of PDB files, most expensive systems first
+    pdbFiles: List[FilePath] = plan_remaining_systems(batchConfig, pdbFiles)
     # Iterate over each file in the PDB directory
-    for pdbFile in pdbFiles:
+    for pdbFile in iterate_pdb_files(pdbFiles, batchConfig, workerMode):
         # Process the PDB file
-        runConfigYaml: FilePath = drConfigWriter.make_per_protein_config(pdbFile, batchConfig)
-        pdbName = p.splitext(p.basename(pdbFile))[0]
-        try:
-            drOperator.drMD_protocol(runConfigYaml)
-        except Exception as e:
-            errorData = handle_exceptions(e, pdbName)
+        errorData: Optional[Dict] = process_pdb_file(pdbFile, batchConfig, workerMode)
+        if errorData is not None:
             botchedSimulations.append(errorData)
+    ## make sure all vitals reports have been written before aftercare
+    drCheckup.wait_for_checkups()
 
     if len(botchedSimulations) > 0:
          drSplash.print_botched(botchedSimulations)
 ######################################################################################################
+def plan_remaining_systems(batchConfig: Dict, pdbFiles: Optional[List[FilePath]] = None) -> List[FilePath]:
+    """
+    Uses the run ledger to drop systems that have already finished with this batch config,
+    then orders the remaining systems most expensive first
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+        pdbFiles (List[FilePath], optional): systems to plan, every PDB file in inputDir if not given
+
+    Returns:
+        pdbFiles (List[FilePath]): PDB files still to be run, in scheduling order
+    """
+    ledgerFile: FilePath = drLedger.get_ledger_file(batchConfig["pathInfo"]["outputDir"])
+    allPdbFiles: List[FilePath] = pdbFiles if pdbFiles is not None else drBatchPlanner.get_pdb_files(batchConfig)
+    drLedger.register_systems(ledgerFile, allPdbFiles)
+    finishedSystems: set = set(drLedger.get_finished_systems(ledgerFile, drLedger.hash_batch_config(batchConfig)))
+    remainingPdbFiles: List[FilePath] = [pdbFile for pdbFile in allPdbFiles
+                                          if p.splitext(p.basename(pdbFile))[0] not in finishedSystems]
+    if len(remainingPdbFiles) < len(allPdbFiles):
+        drLogger.log_info(f"Skipping {len(allPdbFiles) - len(remainingPdbFiles)} systems that have already finished", True, True)
+    return drBatchPlanner.plan_batch_order(batchConfig, remainingPdbFiles)
+######################################################################################################
+def iterate_pdb_files(pdbFiles: List[FilePath], batchConfig: Dict, workerMode: bool) -> Iterator[FilePath]:
+    """
+    In normal mode, simply iterates over pdbFiles
+    In worker mode, only yields PDB files that this worker has claimed
+    pdbFiles are the systems the ledger does not have as done with this batch config,
+    so any done or failed markers they have are left over from an earlier run and are cleared
+
+    Args:
+        pdbFiles (List[FilePath]): PDB files in scheduling order
+        batchConfig (dict): Batch configuration dictionary.
+        workerMode (bool): whether to claim PDB files before processing them
+
+    Returns:
+        pdbIterator (Iterator[FilePath]): PDB files to process
+    """
+    if not workerMode:
+        return iter(pdbFiles)
+    claimDir: DirectoryPath = drClaimer.get_claim_dir(batchConfig["pathInfo"]["outputDir"])
+    drClaimer.clear_task_markers(claimDir, [drClaimer.get_task_name(pdbFile) for pdbFile in pdbFiles])
+    return drClaimer.iterate_claimed_tasks(pdbFiles, claimDir, batchConfig["hardwareInfo"]["claimTimeout"],
+                                            taskHash=drLedger.hash_batch_config(batchConfig))
+######################################################################################################
+def process_pdb_file(pdbFile: FilePath,
+                      batchConfig: Dict,
+                        workerMode: bool = False,
+                          preparedSystem: Optional[Tuple[FilePath, Tuple[FilePath, FilePath, FilePath]]] = None) -> Optional[Dict]:
+    """
+    Writes a per-protein config for a PDB file and runs the drMD protocol on it
+    In worker mode, the claim on the PDB file is kept alive while it runs and released afterwards
+    If another worker takes the claim over, the system is stopped here and reported as lost
+
+    Args:
+        pdbFile (FilePath): the input PDB file
+        batchConfig (dict): Batch configuration dictionary.
+        workerMode (bool): whether this PDB file has been claimed by this worker
+        preparedSystem (Tuple, optional): per-protein config and prepared files from the prep pool
+
+    Returns:
+        errorData (Optional[Dict]): error data if the simulation failed, otherwise None
+    """
+    pdbName = p.splitext(p.basename(pdbFile))[0]
+    errorData: Optional[Dict] = None
+    if workerMode:
+        claimDir: DirectoryPath = drClaimer.get_claim_dir(batchConfig["pathInfo"]["outputDir"])
+        try:
+            with drClaimer.hold_claim(claimDir, pdbName, batchConfig["hardwareInfo"]["claimTimeout"]):
+                errorData = run_pdb_file(pdbFile, batchConfig, preparedSystem)
+        ## the system now belongs to another worker, so its claim and ledger record are left to that worker
+        except drWallClock.SystemStopped as e:
+            drLogger.log_info(f"{pdbName} is being run by another worker: {e}", True, True)
+            return {"pdbName": pdbName,
+                    "errorType": "ClaimLost",
+                    "errorMessage": str(e),
+                    "functionName": "Unknown",
+                    "lineNumber": "Unknown",
+                    "lineOfCode": "Unknown",
+                    "scriptName": "Unknown",
+                    "fullTraceBack": []}
+        ## a paused system is left unclaimed, for whichever worker is running when the batch is resubmitted
+        except drWallClock.WallTimeExceeded as e:
+            drClaimer.abandon_task(claimDir, pdbName)
+            raise e
+        drClaimer.release_task(claimDir, pdbName, succeeded=errorData is None, taskHash=drLedger.hash_batch_config(batchConfig))
+    else:
+        errorData = run_pdb_file(pdbFile, batchConfig, preparedSystem)
+    return errorData
+######################################################################################################
+def run_pdb_file(pdbFile: FilePath,
+                  batchConfig: Dict,
+                    preparedSystem: Optional[Tuple[FilePath, Tuple[FilePath, FilePath, FilePath]]] = None) -> Optional[Dict]:
+    """
+    Runs the drMD protocol on one PDB file, returning error data if it fails
+    If the system has already been prepared by the prep pool, only the simulation stage is run
+    WallTimeExceeded is passed on, the system is paused rather than failed
+    """
+    pdbName = p.splitext(p.basename(pdbFile))[0]
+    drWallClock.check_time_left(batchConfig["hardwareInfo"], pdbName)
+    ledgerFile: FilePath = drLedger.get_ledger_file(batchConfig["pathInfo"]["outputDir"])
+    ## systems from the prep pool were marked as running when their prep started
+    if preparedSystem is None:
+        drLedger.update_system(ledgerFile, pdbName, state = drLedger.RUNNING)
+    try:
+        if preparedSystem is None:
+            runConfigYaml: FilePath = drConfigWriter.make_per_protein_config(pdbFile, batchConfig)
+            drOperator.drMD_protocol(runConfigYaml)
+        else:
+            runConfigYaml, preparedFiles = preparedSystem
+            drOperator.run_simulation_stage(runConfigYaml, preparedFiles)
+    ## another worker has taken this system over and keeps its ledger record
+    except drWallClock.SystemStopped as e:
+        raise e
+    except drWallClock.WallTimeExceeded as e:
+        drLedger.update_system(ledgerFile, pdbName, state = drLedger.PAUSED)
+        raise e
+    ## prep failures call exit(), this is caught so that the system is reported rather than killing the process
+    except (Exception, SystemExit) as e:
+        drLedger.update_system(ledgerFile, pdbName, state = drLedger.FAILED)
+        return handle_exceptions(e, pdbName)
+    drLedger.update_system(ledgerFile, pdbName, state = drLedger.DONE)
+    return None
+######################################################################################################
 def handle_exceptions(e, pdbName):
     tb = traceback.extract_tb(e.__traceback__)
     if tb:
@@ -193,91 +458,661 @@ def handle_exceptions(e, pdbName):
 
 
 ######################################################################################################
-def run_parallel(batchConfig: Dict) -> None:
+def run_parallel(batchConfig: Dict, workerMode: bool = False, pdbFiles: Optional[List[FilePath]] = None) -> None:
     """
-    Process each PDB file in the given directory in parallel using multiple worker threads.
+    Process each PDB file in the given directory in parallel using multiple worker processes.
+    PDB files are placed on a queue, each system is run in its own process as soon as a core is free
+    so that no core sits idle while others still have work to do.
+    In worker mode, systems are instead claimed through lock files
 
     Args:
-        parallelCPU (int): Number of worker threads to use.
         batchConfig (dict): Batch configuration dictionary.
-        pdbDir (str): Path to the directory containing PDB files.
-        outDir (str): Path to the output directory.
-        yamlDir (str): Path to the directory to write YAML configuration files.
-        simInfo (dict): Simulation information dictionary.
+        workerMode (bool): if True, only process PDB files claimed by this worker
+        pdbFiles (List[FilePath], optional): systems to run, every PDB file in inputDir if not given
+
+    Returns:
+        None
+    """
+    # Get list of PDB files in the directory, most expensive systems first
+    pdbFiles: List[FilePath] = plan_remaining_systems(batchConfig, pdbFiles)
+    ## create a queue of PDB files, followed by a stop signal
+    pdbQueue: Queue = Queue()
+    if not workerMode:
+        for pdbFile in pdbFiles:
+            pdbQueue.put((pdbFile, None))
+        pdbQueue.put(None)
+
+    botchedSimulations: List[Dict] = run_simulation_workers(pdbQueue, pdbFiles, batchConfig, workerMode)
+
+    if len(botchedSimulations) > 0:
+         drSplash.print_botched(botchedSimulations)
+######################################################################################################
+def run_pipelined(batchConfig: Dict, pdbFiles: Optional[List[FilePath]] = None) -> None:
+    """
+    Runs the batch as a two-stage pipeline
+    A pool of parallelPrep processes prepares systems (pdb2pqr, antechamber, tleap etc.)
+    and hands them to parallelCPU simulation workers through a bounded queue
+    This means that the next system is prepared while the current one is being simulated,
+    and systems that fail preparation never take up a simulation slot
+
+    Args:
+        batchConfig (dict): Batch configuration dictionary.
+        pdbFiles (List[FilePath], optional): systems to run, every PDB file in inputDir if not given
 
     Returns:
         None
     """
-    
-    ## read input directory from batchConfig
-    pdbDir = batchConfig["pathInfo"]["inputDir"]
     parallelCpus: int = batchConfig["hardwareInfo"]["parallelCPU"]
+    parallelPrep: int = batchConfig["hardwareInfo"]["parallelPrep"]
 
-    # Get list of PDB files in the directory
-    pdbFiles: list[str] = sorted([p.join(pdbDir, pdbFile) for pdbFile in os.listdir(pdbDir) if p.splitext(pdbFile)[1] == ".pdb"])
-    ## construct inputArgs for multiprocessing
-    inputArgs: list[tuple] = [(pdbFile, batchConfig) for pdbFile in pdbFiles]
-    ## create batched inputs
-    batchedArgsWithPos = [(batch, pos) for pos, batch in enumerate(np.array_split(inputArgs, parallelCpus))]
-    ## add a dummy batch to be used for printing logging
-    batchedArgsWithPos = [(["dummy"], -1)] + batchedArgsWithPos
+    # Get list of PDB files in the directory, most expensive systems first
+    pdbFiles: List[FilePath] = plan_remaining_systems(batchConfig, pdbFiles)
+    manager = mp.Manager()
+    ## bounded, so that prep only runs a few systems ahead of the simulation workers
+    preparedQueue = manager.Queue(maxsize=parallelCpus)
+    prepBotched: List[Dict] = []
+    stopPrep: threading.Event = threading.Event()
 
+    prepThread = threading.Thread(target=run_prep_pool,
+                                   args=(pdbFiles, batchConfig, preparedQueue, parallelPrep, prepBotched, stopPrep),
+                                     daemon=True)
+    prepThread.start()
     try:
-        ## run simulations in parallel
-        botchedSimulations = process_map(per_core_worker, batchedArgsWithPos, 
-                    max_workers=parallelCpus)
-    except BrokenProcessPool:
-        print("BrokenProcessPool: Terminating remaining processes")
-
-    botchedSimulations = list(itertools.chain.from_iterable(botchedSimulations))
+        simBotched: List[Dict] = run_simulation_workers(preparedQueue, pdbFiles, batchConfig, False)
+        prepThread.join()
+    ## when the batch pauses (or anything else goes wrong), prep workers may be blocked on the full prepared queue,
+    ## so the prep pool is cancelled and the queue drained until it has shut down
+    except BaseException as e:
+        stopPrep.set()
+        drain_prepared_queue(preparedQueue, prepThread, batchConfig)
+        raise e
+    finally:
+        manager.shutdown()
 
+    botchedSimulations: List[Dict] = prepBotched + simBotched
     if len(botchedSimulations) > 0:
          drSplash.print_botched(botchedSimulations)
 ######################################################################################################
-def per_core_worker(batchedArgsWithPos: Tuple[Dict, int]) -> None:
+def run_prep_pool(pdbFiles: List[FilePath],
+                   batchConfig: Dict,
+                     preparedQueue: mp.Queue,
+                       parallelPrep: int,
+                         prepBotched: List[Dict],
+                           stopPrep: threading.Event) -> None:
     """
-    Each core is passed a batch of arguments to process
-    This function unpacks the arguments and handles the progress bar
+    Prepares PDB files in a pool of processes, prepared systems are put on preparedQueue by the prep workers
+    Once every system has been prepared (or has failed) a stop signal is sent to the simulation workers
+    Once stopPrep is set, systems that have not started preparing are cancelled
 
     Args:
-        batchedArgsWithPos List[(Tuple[Dict, int])]: 
-            Alist of tuples containing input argunents for process_pdb_file and 
-            the position of the core for the loading bar
+        pdbFiles (List[FilePath]): PDB files in scheduling order
+        batchConfig (dict): Batch configuration dictionary.
+        preparedQueue (mp.Queue): queue feeding the simulation workers
+        parallelPrep (int): number of prep processes
+        prepBotched (List[Dict]): error data for systems that failed preparation is appended here
+        stopPrep (threading.Event): set when the simulation workers have stopped taking systems
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=parallelPrep) as prepPool:
+            prepFutures: Dict[Future, FilePath] = {prepPool.submit(prep_worker, pdbFile, batchConfig, preparedQueue): pdbFile
+                                                    for pdbFile in pdbFiles}
+            pendingFutures: set = set(prepFutures)
+            while len(pendingFutures) > 0:
+                if stopPrep.is_set():
+                    for future in pendingFutures:
+                        future.cancel()
+                finishedFutures, pendingFutures = wait(pendingFutures, timeout=SUPERVISOR_POLL)
+                for future in finishedFutures:
+                    if future.cancelled():
+                        continue
+                    collect_prep_result(future, prepFutures[future], prepBotched)
+    finally:
+        preparedQueue.put(None)
+######################################################################################################
+def collect_prep_result(future: Future, pdbFile: FilePath, prepBotched: List[Dict]) -> None:
+    """
+    Adds the error data of a prep worker that failed to prepBotched
+    """
+    try:
+        errorData: Optional[Dict] = future.result()
+    except Exception as e:
+        pdbName: str = p.splitext(p.basename(pdbFile))[0]
+        drLogger.log_info(f"Preparation of {pdbName} failed: {e}", True, True)
+        errorData = handle_exceptions(e, pdbName)
+    if errorData is not None:
+        prepBotched.append(errorData)
+######################################################################################################
+def drain_prepared_queue(preparedQueue: mp.Queue, prepThread: threading.Thread, batchConfig: Dict) -> None:
+    """
+    Empties the prepared queue until the prep pool has shut down, so that no prep worker is left blocked on it
+    Systems that were prepared but not simulated are marked as paused, they carry on when the batch is resubmitted
+    """
+    ledgerFile: FilePath = drLedger.get_ledger_file(batchConfig["pathInfo"]["outputDir"])
+    while True:
+        prepFinished: bool = not prepThread.is_alive()
+        try:
+            queuedSystem = preparedQueue.get(timeout=SUPERVISOR_POLL)
+        except Empty:
+            if prepFinished:
+                return
+            continue
+        if queuedSystem is not None:
+            drLedger.update_system(ledgerFile, p.splitext(p.basename(queuedSystem[0]))[0], state = drLedger.PAUSED)
+######################################################################################################
+def prep_worker(pdbFile: FilePath, batchConfig: Dict, preparedQueue: mp.Queue) -> Optional[Dict]:
+    """
+    Writes a per-protein config and runs the prep stage for one PDB file
+    The prepared system is put on preparedQueue, blocking if the simulation workers are busy
+    Failures are reported straight away, rather than when the batch has finished
+
+    Args:
+        pdbFile (FilePath): the input PDB file
+        batchConfig (dict): Batch configuration dictionary.
+        preparedQueue (mp.Queue): queue feeding the simulation workers
+
     Returns:
-        None
+        errorData (Optional[Dict]): error data if preparation failed, otherwise None
+    """
+    pdbName: str = p.splitext(p.basename(pdbFile))[0]
+    ## with no time left in wallTimeBudget, the system is left to be prepared when the batch is resubmitted
+    if not drWallClock.has_time_for(batchConfig["hardwareInfo"], 0):
+        return None
+    ledgerFile: FilePath = drLedger.get_ledger_file(batchConfig["pathInfo"]["outputDir"])
+    drLedger.update_system(ledgerFile, pdbName, state = drLedger.RUNNING)
+    try:
+        runConfigYaml: FilePath = drConfigWriter.make_per_protein_config(pdbFile, batchConfig)
+        preparedFiles: Tuple[FilePath, FilePath, FilePath] = drOperator.run_prep_stage(runConfigYaml)
+    ## prep failures call exit(), so SystemExit must be caught here to keep the prep worker alive
+    except (Exception, SystemExit) as e:
+        drLogger.log_info(f"Preparation of {pdbName} failed, it will not be simulated", True, True)
+        drLedger.update_system(ledgerFile, pdbName, state = drLedger.FAILED)
+        return handle_exceptions(e, pdbName)
+    preparedQueue.put((pdbFile, (runConfigYaml, preparedFiles)))
+    return None
+######################################################################################################
+def run_simulation_workers(pdbQueue: Queue, pdbFiles: List[FilePath], batchConfig: Dict, workerMode: bool) -> List[Dict]:
     """
-    perWorkerBotchedSimulations: list[Dict] = []
-    ## unpack batchedArgsWithPos into the batch of arguments for 
-    batchedArgs, pos = batchedArgsWithPos
+    Runs each system in its own process, with up to parallelCPU processes at a time
+    Systems are pulled from pdbQueue until a stop signal is received (or claimed through lock files in worker mode)
+    A process that dies (eg. a segfault in OpenMM, or the OOM killer) only takes its own system with it,
+    that system is resumed in a new process up to workerCrashRetries times before it is reported as failed
+    A system whose simulation stalls is restarted in the same way, while the stalled step has firstAidMaxRetries left
+    (stall restarts and firstAid retries of a step are counted together in the ledger)
+    Once wallTimeBudget runs out or a stop signal is received, no more systems are started and WallTimeExceeded
+    is raised when the running systems have finished or checkpointed
 
-    ## create a list of colors for the loading bar
-    cmap = plt.get_cmap('plasma', 32)
-    colors = [mcolors.rgb2hex(cmap(i)) for i in range(32)]
-    ## create a dummy progress bar to be used for printing logs
-    if pos == -1:
-        with tqdm(total=1, position=0, bar_format='{desc}', 
-                  colour="#000000", leave=True) as dummy_progress:
-            dummy_progress.set_description_str("Logs:")
-            dummy_progress.refresh()
-    ## run simulations in parallel
+    Args:
+        pdbQueue (Queue): queue of (pdbFile, preparedSystem) tuples, followed by None
+        pdbFiles (List[FilePath]): PDB files in scheduling order
+        batchConfig (dict): Batch configuration dictionary.
+        workerMode (bool): if True, only process PDB files claimed by this worker
+
+    Returns:
+        botchedSimulations (List[Dict]): error data for any failed simulations
+    """
+    parallelCpus: int = batchConfig["hardwareInfo"]["parallelCPU"]
+    workerCrashRetries: int = batchConfig["miscInfo"]["workerCrashRetries"]
+    if workerMode:
+        systemIterator: Iterator = ((pdbFile, None) for pdbFile in iterate_pdb_files(pdbFiles, batchConfig, workerMode))
     else:
-        with tqdm(desc=f"Core {str(pos)}", total=len(batchedArgs), 
-                position=pos+1, colour=colors[pos % len(colors)], 
-                leave=False) as progress:
-            for args in batchedArgs:
-                pdbFile, batchConfig = args
-                pdbName = p.splitext(p.basename(pdbFile))[0]
-                runConfigYaml: FilePath = drConfigWriter.make_per_protein_config(pdbFile, batchConfig)
-                try:
-                    drOperator.drMD_protocol(runConfigYaml)
-        
-                except Exception as e:
-                    errorData = handle_exceptions(e, pdbName)
-                    perWorkerBotchedSimulations.append(errorData)
+        systemIterator: Iterator = iterate_queue(pdbQueue)
+
+    ## create a dummy progress bar to be used for printing logs, and a progress bar per core
+    colors: List[str] = get_progress_bar_colors()
+    logBar = tqdm(total=1, position=0, bar_format='{desc}', colour="#000000", leave=True)
+    logBar.set_description_str("Logs:")
+    logBar.refresh()
+    coreBars: List[tqdm] = [tqdm(desc=f"Core {str(pos)}", position=pos+1,
+                                  colour=colors[pos % len(colors)], leave=False) for pos in range(parallelCpus)]
+
+    resultQueue: mp.Queue = mp.Queue()
+    runningSystems: Dict[int, Dict] = {}
+    retrySystems: deque = deque()
+    crashCounts: Dict[str, int] = {}
+    botchedSimulations: List[Dict] = []
+    noMoreSystems: bool = False
+    waitingForSystems: bool = False
+    batchPaused: bool = False
+    stopForwarded: bool = False
+    ## with elasticThreads, running systems are given spare cores once there is nothing left to start
+    ## other workers may be using cores on this node in worker mode, so threads are not rebalanced there
+    elasticThreads: bool = batchConfig["hardwareInfo"]["elasticThreads"] and not workerMode
+    threadAllocations: Dict[str, int] = {}
+    if elasticThreads:
+        drThreadAllocator.clear_thread_allocations(batchConfig["pathInfo"]["outputDir"])
+    ## with pinCpus, each core position gets its own set of CPU cores
+    coreSets: Optional[List[List[int]]] = None
+    if batchConfig["hardwareInfo"]["pinCpus"] and batchConfig["hardwareInfo"]["platform"] == "CPU" and not workerMode:
+        coreSets = drThreadAllocator.assign_core_sets(parallelCpus, batchConfig["hardwareInfo"]["subprocessCpus"])
+    try:
+        while True:
+            if not batchPaused and not drWallClock.has_time_for(batchConfig["hardwareInfo"], 0):
+                batchPaused = True
+            if batchPaused:
+                noMoreSystems = True
+                retrySystems.clear()
+            ## system processes checkpoint and exit when they are sent SIGTERM
+            ## most will have had the signal already, from the scheduler or Ctrl-C, and ignore a repeat
+            if drWallClock.stop_requested() and not stopForwarded:
+                for runningSystem in runningSystems.values():
+                    runningSystem["process"].terminate()
+                stopForwarded = True
+            ## start systems on any free cores, retries first
+            waitingForSystems = False
+            for pos in range(parallelCpus):
+                if pos in runningSystems:
+                    continue
+                if len(retrySystems) > 0:
+                    queuedSystem = retrySystems.popleft()
+                elif not noMoreSystems:
+                    queuedSystem = next(systemIterator, None)
+                    if queuedSystem is None:
+                        noMoreSystems = True
+                        continue
+                    ## the next system is still being prepared, carry on supervising the running ones meanwhile
+                    if queuedSystem is QUEUE_EMPTY:
+                        waitingForSystems = True
+                        break
+                else:
+                    continue
+                runningSystems[pos] = start_system_process(queuedSystem, batchConfig, workerMode, resultQueue,
+                                                            coreSets[pos] if coreSets is not None else None)
+
+            if len(runningSystems) == 0:
+                if waitingForSystems:
                     continue
-                progress.update(1)
-            progress.close()  
-    return perWorkerBotchedSimulations
+                break
+
+            if elasticThreads:
+                threadAllocations = update_thread_allocations(runningSystems, batchConfig,
+                                                               noMoreSystems and len(retrySystems) == 0, threadAllocations, coreSets)
+
+            ## wait until at least one system process has exited, waking up regularly to check for stop signals
+            mp.connection.wait([runningSystem["process"].sentinel for runningSystem in runningSystems.values()], timeout=SUPERVISOR_POLL)
+            for pos, runningSystem in list(runningSystems.items()):
+                process: mp.Process = runningSystem["process"]
+                if process.is_alive():
+                    continue
+                process.join()
+                drWallClock.untrack_child(process.pid)
+                del runningSystems[pos]
+                pdbFile, _ = runningSystem["queuedSystem"]
+                pdbName: str = p.splitext(p.basename(pdbFile))[0]
+
+                if process.exitcode == 0:
+                    try:
+                        errorData: Optional[Dict] = collect_system_result(resultQueue, pdbName)
+                    ## eg. a sys.exit(0) in a dependency, this is handled like any other crash below
+                    except Empty:
+                        drLogger.log_info(f"Process running {pdbName} exited without reporting a result", True, True)
+                    else:
+                        if errorData is not None:
+                            botchedSimulations.append(errorData)
+                        coreBars[pos].update(1)
+                        continue
+
+                ## the system was checkpointed and stopped, to stay inside wallTimeBudget or after a stop signal
+                if process.exitcode == drWallClock.RESUMABLE_EXIT_CODE:
+                    batchPaused = True
+                    continue
+
+                ## the simulation stalled, the system is restarted from its last checkpoint
+                ## the stalled process counted the restart as a retry of its step in the ledger, see drLogger.handle_stall
+                if process.exitcode == drLogger.STALLED_EXIT_CODE:
+                    stepRetries: int = drLedger.get_step_retries(drLedger.get_ledger_file(batchConfig["pathInfo"]["outputDir"]), pdbName)
+                    if stepRetries <= batchConfig["miscInfo"]["firstAidMaxRetries"]:
+                        drLogger.log_info(f"Simulation of {pdbName} stalled, restarting from its last checkpoint ({stepRetries}/{batchConfig['miscInfo']['firstAidMaxRetries']})", True, True)
+                        retrySystems.append(runningSystem["queuedSystem"])
+                        continue
+                    drLogger.log_info(f"Simulation of {pdbName} stalled, giving up after {stepRetries} retries", True, True)
+                    botchedSimulations.append(mark_system_crashed(pdbName, process.exitcode, stepRetries, batchConfig, workerMode))
+                    coreBars[pos].update(1)
+                    continue
+
+                ## the process died before it could report back
+                crashCounts[pdbName] = crashCounts.get(pdbName, 0) + 1
+                if crashCounts[pdbName] <= workerCrashRetries:
+                    drLogger.log_info(f"Process running {pdbName} died with exit code {process.exitcode}, retrying ({crashCounts[pdbName]}/{workerCrashRetries})", True, True)
+                    retrySystems.append(runningSystem["queuedSystem"])
+                    continue
+                drLogger.log_info(f"Process running {pdbName} died with exit code {process.exitcode}, giving up after {crashCounts[pdbName]} attempts", True, True)
+                botchedSimulations.append(mark_system_crashed(pdbName, process.exitcode, crashCounts[pdbName], batchConfig, workerMode))
+                coreBars[pos].update(1)
+        if batchPaused:
+            if len(botchedSimulations) > 0:
+                drSplash.print_botched(botchedSimulations)
+            raise drWallClock.make_stop_error("before every system had finished")
+    finally:
+        ## only reached with systems still running if something went wrong in this process
+        for runningSystem in runningSystems.values():
+            runningSystem["process"].terminate()
+            runningSystem["process"].join()
+            drWallClock.untrack_child(runningSystem["process"].pid)
+        for coreBar in coreBars:
+            coreBar.close()
+        logBar.close()
+        if elasticThreads:
+            drThreadAllocator.clear_thread_allocations(batchConfig["pathInfo"]["outputDir"])
+
+    return botchedSimulations
+######################################################################################################
+def update_thread_allocations(runningSystems: Dict[int, Dict],
+                               batchConfig: Dict,
+                                 queueDrained: bool,
+                                   threadAllocations: Dict[str, int],
+                                     coreSets: Optional[List[List[int]]] = None) -> Dict[str, int]:
+    """
+    Shares the CPU cores of this machine between running systems once the queue has drained,
+    so that the last systems of a batch use cores freed up by systems that have finished
+    Running simulations read their allocation between chunks of steps, see drSim.run_steps
+
+    Args:
+        runningSystems (Dict[int, Dict]): running systems, keyed by core position
+        batchConfig (dict): Batch configuration dictionary.
+        queueDrained (bool): whether there are no more systems waiting to start
+        threadAllocations (Dict[str, int]): allocations that were last written
+        coreSets (List[List[int]], optional): core set of each core position, if systems are pinned
+
+    Returns:
+        threadAllocations (Dict[str, int]): allocations that are now in place
+    """
+    subprocessCpus: int = batchConfig["hardwareInfo"]["subprocessCpus"]
+    runningNames: Dict[int, str] = {pos: p.splitext(p.basename(runningSystems[pos]["queuedSystem"][0]))[0]
+                                     for pos in sorted(runningSystems)}
+    cpuAllocations: Optional[Dict[str, List[int]]] = None
+    if queueDrained and coreSets is not None:
+        cpuAllocations = drThreadAllocator.balance_core_sets({pdbName: coreSets[pos] for pos, pdbName in runningNames.items()})
+        newAllocations: Dict[str, int] = {pdbName: len(cpuIds) for pdbName, cpuIds in cpuAllocations.items()}
+    elif queueDrained:
+        newAllocations = drThreadAllocator.balance_threads(list(runningNames.values()),
+                                                            drThreadAllocator.get_available_cpus(),
+                                                              subprocessCpus)
+    else:
+        newAllocations = {pdbName: subprocessCpus for pdbName in runningNames.values()}
+    ## simulations never give threads back, so keep their largest allocation
+    newAllocations = {pdbName: max(threads, threadAllocations.get(pdbName, 0)) for pdbName, threads in newAllocations.items()}
+    if newAllocations != threadAllocations:
+        drThreadAllocator.write_thread_allocations(batchConfig["pathInfo"]["outputDir"], newAllocations, cpuAllocations)
+    return newAllocations
+######################################################################################################
+def start_system_process(queuedSystem: Tuple[FilePath, Optional[Tuple]],
+                          batchConfig: Dict,
+                            workerMode: bool,
+                              resultQueue: mp.Queue,
+                                coreSet: Optional[List[int]] = None) -> Dict:
+    """
+    Starts a new process to run one system, pinned to coreSet if one is given
+
+    Returns:
+        runningSystem (Dict): the process and the system it is running
+    """
+    pdbFile, preparedSystem = queuedSystem
+    process: mp.Process = mp.Process(target=run_system_process,
+                                      args=(pdbFile, batchConfig, workerMode, preparedSystem, resultQueue, coreSet))
+    process.start()
+    drWallClock.track_child(process.pid)
+    return {"process": process, "queuedSystem": queuedSystem}
+######################################################################################################
+def run_system_process(pdbFile: FilePath,
+                        batchConfig: Dict,
+                          workerMode: bool,
+                            preparedSystem: Optional[Tuple],
+                              resultQueue: mp.Queue,
+                                coreSet: Optional[List[int]] = None) -> None:
+    """
+    Target of each system process, runs the system and puts its error data (or None) on resultQueue
+    """
+    pdbName: str = p.splitext(p.basename(pdbFile))[0]
+    ## the supervisor decides whether a second signal kills this process, see drWallClock.install_stop_handlers
+    drWallClock.install_stop_handlers(forceStopOnRepeat=False)
+    ## a stalled simulation can't be interrupted, so this process exits and the supervisor restarts it
+    drLogger.enable_stall_exit()
+    ## pin before OpenMM starts its thread pool, so every thread stays on this core set
+    if coreSet is not None:
+        drThreadAllocator.pin_to_cpus(coreSet)
+        manage_cpu_usage_for_subprocesses("ON", len(coreSet))
+    try:
+        errorData: Optional[Dict] = process_pdb_file(pdbFile, batchConfig, workerMode, preparedSystem)
+    ## the supervisor reads this exit code as "paused", not as a crash
+    except drWallClock.WallTimeExceeded:
+        drCheckup.wait_for_checkups()
+        sys.exit(drWallClock.RESUMABLE_EXIT_CODE)
+    ## make sure all vitals reports have been written before this process exits
+    drCheckup.wait_for_checkups()
+    resultQueue.put((pdbName, errorData))
+######################################################################################################
+def collect_system_result(resultQueue: mp.Queue, pdbName: str) -> Optional[Dict]:
+    """
+    Gets the result of a system process that exited cleanly
+    Results from other systems that arrive first are kept until they are asked for
+    Raises queue.Empty if the result has not arrived within RESULT_TIMEOUT seconds
+    """
+    if pdbName in RESULTS_RECEIVED:
+        return RESULTS_RECEIVED.pop(pdbName)
+    while True:
+        resultName, errorData = resultQueue.get(timeout=RESULT_TIMEOUT)
+        if resultName == pdbName:
+            return errorData
+        RESULTS_RECEIVED[resultName] = errorData
+######################################################################################################
+def mark_system_crashed(pdbName: str, exitCode: int, nAttempts: int, batchConfig: Dict, workerMode: bool) -> Dict:
+    """
+    Records a system whose process kept dying as failed, in the ledger and (in worker mode) its claim
+
+    Returns:
+        errorData (Dict): error data in the same format as handle_exceptions
+    """
+    drLedger.update_system(drLedger.get_ledger_file(batchConfig["pathInfo"]["outputDir"]), pdbName, state = drLedger.FAILED)
+    if workerMode:
+        drClaimer.release_task(drClaimer.get_claim_dir(batchConfig["pathInfo"]["outputDir"]), pdbName, succeeded=False,
+                                taskHash=drLedger.hash_batch_config(batchConfig))
+    ## negative exit codes mean the process was killed by a signal
+    if exitCode == drLogger.STALLED_EXIT_CODE:
+        errorMessage: str = f"Simulation stalled with no retries left, after {nAttempts} firstAid retries and stall restarts"
+    else:
+        errorMessage = (f"Process was killed by signal {-exitCode}" if exitCode < 0
+                          else f"Process exited with code {exitCode}") + f" on each of {nAttempts} attempts"
+    return {"pdbName": pdbName,
+            "errorType": "Stalled" if exitCode == drLogger.STALLED_EXIT_CODE else "WorkerCrash",
+            "errorMessage": errorMessage,
+            "functionName": "Unknown",
+            "lineNumber": "Unknown",
+            "lineOfCode": "Unknown",
+            "scriptName": "Unknown",
+            "fullTraceBack": []}
+######################################################################################################
+def get_progress_bar_colors() -> List[str]:
+    """
+    Returns 32 hex colours from the plasma colour map, used for the per-core progress bars
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as mcolors
+    cmap = plt.get_cmap('plasma', 32)
+    return [mcolors.rgb2hex(cmap(i)) for i in range(32)]
+######################################################################################################
+def iterate_queue(pdbQueue: Queue) -> Iterator[Tuple[FilePath, Optional[Tuple]]]:
+    """
+    Pulls systems from a queue, one at a time, until a stop signal (None) is received
+    Each system is a (pdbFile, preparedSystem) tuple, preparedSystem is None if the system still needs preparing
+    QUEUE_EMPTY is yielded if no system arrives within SUPERVISOR_POLL seconds,
+    so that the supervisor never blocks on the queue while systems are running or a stop is pending
+    """
+    while True:
+        try:
+            queuedSystem = pdbQueue.get(timeout=SUPERVISOR_POLL)
+        except Empty:
+            yield QUEUE_EMPTY
+            continue
+        if queuedSystem is None:
+            return
+        yield queuedSystem
+######################################################################################################
+## NON-BLOCKING PYTHON API
+######################################################################################################
+def submit_batch(batchConfig: Union[Dict, FilePath]) -> "BatchHandle":
+    """
+    Submits a batch of simulations and returns straight away
+    Each system is run in its own process, up to parallelCPU at a time
+    Systems are prepared in their simulation slots, parallelPrep and worker mode are not used here
+
+    Args:
+        batchConfig (Union[Dict, FilePath]): a batch config dictionary, or the path to a batch config YAML file
+
+    Returns:
+        batchHandle (BatchHandle): handle with a future for each system
+    """
+    if isinstance(batchConfig, dict):
+        batchConfig = copy.deepcopy(batchConfig)
+    else:
+        try:
+            batchConfig = drConfigTriage.read_input_yaml(batchConfig)
+        except SystemExit:
+            raise ValueError(f"Could not read batch config {batchConfig}")
+    ## config triage prints its own report before exiting
+    try:
+        batchConfig = drConfigTriage.validate_config(batchConfig)
+    except SystemExit:
+        raise ValueError("Batch config is not valid, see the config triage report above")
+    batchConfig = drBatchPlanner.plan_hardware(batchConfig)
+    ## worker processes inherit the start time of the wall clock
+    drWallClock.start_wall_clock()
+
+    set_up_batch(batchConfig)
+    pdbFiles: List[FilePath] = plan_remaining_systems(batchConfig)
+
+    ## worker processes set their own OpenMP and OpenMM thread counts, so this process is left alone
+    executor: ProcessPoolExecutor = ProcessPoolExecutor(max_workers=batchConfig["hardwareInfo"]["parallelCPU"],
+                                                         initializer=manage_cpu_usage_for_subprocesses,
+                                                           initargs=("ON", batchConfig["hardwareInfo"]["subprocessCpus"]))
+    workerFutures: Dict[str, Future] = {p.splitext(p.basename(pdbFile))[0]: executor.submit(run_submitted_system, pdbFile, batchConfig)
+                                         for pdbFile in pdbFiles}
+    return BatchHandle(batchConfig, workerFutures, executor)
+######################################################################################################
+def run_submitted_system(pdbFile: FilePath, batchConfig: Dict) -> Tuple[DirectoryPath, Optional[Dict]]:
+    """
+    Runs one system of a submitted batch in a worker process
+
+    Returns:
+        runDir (DirectoryPath): the output directory of the system
+        errorData (Optional[Dict]): error data if the system failed, otherwise None
+    """
+    runDir: DirectoryPath = p.join(batchConfig["pathInfo"]["outputDir"], p.splitext(p.basename(pdbFile))[0])
+    errorData: Optional[Dict] = process_pdb_file(pdbFile, batchConfig)
+    ## the system future should only resolve once its vitals reports have been written
+    drCheckup.wait_for_checkups()
+    return runDir, errorData
+######################################################################################################
+class BatchHandle:
+    """
+    Handle for a batch submitted with submit_batch
+
+    Attributes:
+        batchConfig (Dict): the validated batch config
+        systemFutures (Dict[str, Future]): one future per system, keyed by system name.
+            Each resolves to the output directory of the system, or raises a RuntimeError if the system failed
+        botchedSimulations (List[Dict]): error data for failed systems, filled in as they fail
+    """
+    def __init__(self, batchConfig: Dict, workerFutures: Dict[str, Future], executor: ProcessPoolExecutor):
+        self.batchConfig: Dict = batchConfig
+        self.botchedSimulations: List[Dict] = []
+        self.systemFutures: Dict[str, Future] = {}
+        self._workerFutures: Dict[str, Future] = workerFutures
+        self._executor: ProcessPoolExecutor = executor
+        self._cancelled: bool = False
+
+        for systemName, workerFuture in workerFutures.items():
+            systemFuture: Future = Future()
+            self.systemFutures[systemName] = systemFuture
+            workerFuture.add_done_callback(lambda future, systemFuture=systemFuture: self._resolve(future, systemFuture))
+
+        ## aftercare is run in the background once every system has finished
+        self._batchExecutor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1)
+        self._batchFuture: Future = self._batchExecutor.submit(self._finish_batch)
+    ##########################################
+    def _resolve(self, workerFuture: Future, systemFuture: Future) -> None:
+        """
+        Passes the outcome of a worker process on to the matching system future
+        """
+        if workerFuture.cancelled():
+            systemFuture.cancel()
+            return
+        if workerFuture.exception() is not None:
+            systemFuture.set_exception(workerFuture.exception())
+            return
+        runDir, errorData = workerFuture.result()
+        if errorData is None:
+            systemFuture.set_result(runDir)
+            return
+        self.botchedSimulations.append(errorData)
+        systemFuture.set_exception(RuntimeError(f"{errorData['pdbName']} failed with {errorData['errorType']}: {errorData['errorMessage']}"))
+    ##########################################
+    def _finish_batch(self) -> List[Dict]:
+        """
+        Waits for every system, then runs aftercare unless the batch was cancelled
+        """
+        wait(list(self._workerFutures.values()))
+        self._executor.shutdown(wait=True)
+        if self._cancelled:
+            drLogger.log_info("Batch was cancelled, skipping aftercare", True, True)
+        else:
+            run_aftercare(self.batchConfig)
+        return self.botchedSimulations
+    ##########################################
+    def status(self) -> Dict[str, str]:
+        """
+        Returns the state of each system: pending, running, done, failed or cancelled
+        """
+        systemStates: Dict[str, str] = {}
+        for systemName, workerFuture in self._workerFutures.items():
+            systemFuture: Future = self.systemFutures[systemName]
+            if workerFuture.cancelled():
+                systemStates[systemName] = "cancelled"
+            elif systemFuture.done():
+                systemStates[systemName] = "failed" if systemFuture.exception() is not None else "done"
+            elif workerFuture.running():
+                systemStates[systemName] = "running"
+            else:
+                systemStates[systemName] = "pending"
+        return systemStates
+    ##########################################
+    def progress(self) -> Dict[str, int]:
+        """
+        Returns the number of systems in each state
+        """
+        systemStates: Dict[str, str] = self.status()
+        return {state: list(systemStates.values()).count(state)
+                 for state in ["pending", "running", "done", "failed", "cancelled"]}
+    ##########################################
+    def cancel(self) -> int:
+        """
+        Cancels every system that has not started yet
+        Systems that are already running are left to finish, they can be resumed by submitting the batch again
+
+        Returns:
+            nCancelled (int): number of systems cancelled
+        """
+        self._cancelled = True
+        nCancelled: int = sum([workerFuture.cancel() for workerFuture in self._workerFutures.values()])
+        drLogger.log_info(f"Cancelled {nCancelled} systems", True, True)
+        return nCancelled
+    ##########################################
+    def done(self) -> bool:
+        """
+        Returns True once every system and aftercare have finished
+        """
+        return self._batchFuture.done()
+    ##########################################
+    def result(self, timeout: Optional[float] = None) -> List[Dict]:
+        """
+        Blocks until every system and aftercare have finished
+
+        Args:
+            timeout (float, optional): seconds to wait before raising a TimeoutError
+
+        Returns:
+            botchedSimulations (List[Dict]): error data for any failed systems
+        """
+        return self._batchFuture.result(timeout=timeout)
 ######################################################################################################
 
 if __name__ == "__main__":
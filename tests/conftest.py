@@ -0,0 +1,6 @@
+## BASIC PYTHON LIBRARIES
+import sys
+from os import path as p
+
+## drMD modules import each other from the src directory, as they do when drMD.py is run
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
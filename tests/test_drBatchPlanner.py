@@ -0,0 +1,31 @@
+## BASIC PYTHON LIBRARIES
+import pytest
+
+## drMD LIBRARIES
+from Triage import drBatchPlanner
+
+#####################################################################################
+@pytest.mark.parametrize("parallelCPU, subprocessCpus, expected", [("auto", 4, (1, 4)),
+                                                                    (2, "auto", (2, 1)),
+                                                                    ("auto", "auto", (1, 1)),
+                                                                    (3, 2, (3, 2))])
+def test_plan_hardware_off_cpu_only_replaces_auto(tmp_path, parallelCPU, subprocessCpus, expected):
+    batchConfig = {"pathInfo": {"outputDir": str(tmp_path)},
+                   "hardwareInfo": {"platform": "CUDA", "parallelCPU": parallelCPU, "subprocessCpus": subprocessCpus}}
+    hardwareInfo = drBatchPlanner.plan_hardware(batchConfig)["hardwareInfo"]
+    assert (hardwareInfo["parallelCPU"], hardwareInfo["subprocessCpus"]) == expected
+#####################################################################################
+def test_throughput_is_recorded_with_the_threads_used(tmp_path):
+    inputPdb = tmp_path / "protA.pdb"
+    inputPdb.write_text("ATOM      1  CA  ALA A   1       0.000   0.000   0.000\n" * 3)
+    simDir = tmp_path / "protA" / "02_NVT"
+    simDir.mkdir(parents=True)
+    (simDir / "progress_report.csv").write_text("Progress (%),Speed (ns/day)\n50,86.4\n100,86.4\n")
+    config = {"pathInfo": {"inputPdb": str(inputPdb), "outputDir": str(tmp_path / "protA")},
+              "hardwareInfo": {"platform": "CPU", "subprocessCpus": 4}}
+    ## eg. elasticThreads moved the step onto more threads than subprocessCpus
+    drBatchPlanner.record_step_throughput(config, {"stepName": "02_NVT", "simulationType": "NVT", "timestep": "2 fs"}, str(simDir), 6)
+    measurement = (tmp_path / "00_drMD_logs" / "throughput_measurements.csv").read_text().strip().split(",")
+    assert measurement[:5] == ["CPU", "protA", "02_NVT", "3", "6"]
+    assert float(measurement[5]) == pytest.approx(500.0)
+#####################################################################################
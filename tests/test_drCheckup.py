@@ -0,0 +1,27 @@
+## BASIC PYTHON LIBRARIES
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+## drMD LIBRARIES
+from ExaminationRoom import drCheckup, drLogger
+
+#####################################################################################
+def test_stalled_process_terminates_checkup_pool(monkeypatch):
+    monkeypatch.setattr(drLogger, "STALL_CLEANUPS", [])
+    checkupPool = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn"))
+    monkeypatch.setattr(drCheckup, "CHECKUP_POOL", checkupPool)
+    ## stands in for a vitals report that is still running
+    checkupPool.submit(time.sleep, 60)
+    time.sleep(1)
+    checkupProcesses = list(checkupPool._processes.values())
+    assert len(checkupProcesses) == 1 and checkupProcesses[0].is_alive()
+    drLogger.add_stall_cleanup(drCheckup.terminate_checkups)
+    drLogger.add_stall_cleanup(drCheckup.terminate_checkups)
+    assert drLogger.STALL_CLEANUPS == [drCheckup.terminate_checkups]
+    for cleanup in drLogger.STALL_CLEANUPS:
+        cleanup()
+    assert not checkupProcesses[0].is_alive()
+    assert drCheckup.CHECKUP_POOL is None
+    checkupPool.shutdown(wait=False)
+#####################################################################################
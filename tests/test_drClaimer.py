@@ -0,0 +1,133 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import time
+import multiprocessing as mp
+import pytest
+
+## drMD LIBRARIES
+from UtilitiesCloset import drClaimer, drWallClock
+
+## number of processes racing for each task
+N_RACERS: int = 8
+#####################################################################################
+def race_for_tasks(claimDir, taskNames, claimTimeout, barrier, results):
+    barrier.wait()
+    for taskName in taskNames:
+        if drClaimer.claim_task(claimDir, taskName, claimTimeout):
+            results.put((taskName, os.getpid()))
+#####################################################################################
+def run_race(claimDir, taskNames, claimTimeout):
+    context = mp.get_context("fork")
+    barrier = context.Barrier(N_RACERS)
+    results = context.Queue()
+    racers = [context.Process(target=race_for_tasks, args=(claimDir, taskNames, claimTimeout, barrier, results))
+              for _ in range(N_RACERS)]
+    for racer in racers:
+        racer.start()
+    for racer in racers:
+        racer.join()
+        assert racer.exitcode == 0
+    winners = {}
+    while not results.empty():
+        taskName, pid = results.get()
+        winners.setdefault(taskName, []).append(pid)
+    return winners
+#####################################################################################
+def make_claim(claimDir, taskName, age):
+    claimFile = p.join(claimDir, f"{taskName}.claim")
+    with open(claimFile, "w") as f:
+        f.write("deadhost 1 0.0\n")
+    os.utime(claimFile, (time.time() - age, time.time() - age))
+    return claimFile
+#####################################################################################
+def test_one_winner_per_task(tmp_path):
+    claimDir = str(tmp_path)
+    taskNames = [f"task_{i}" for i in range(20)]
+    winners = run_race(claimDir, taskNames, claimTimeout=60)
+    assert sorted(winners) == sorted(taskNames)
+    assert all(len(pids) == 1 for pids in winners.values())
+#####################################################################################
+def test_live_claim_is_not_taken_over(tmp_path):
+    claimDir = str(tmp_path)
+    make_claim(claimDir, "task", age=10)
+    assert run_race(claimDir, ["task"], claimTimeout=60) == {}
+#####################################################################################
+def test_expired_claim_is_taken_over_once(tmp_path):
+    claimDir = str(tmp_path)
+    taskNames = [f"task_{i}" for i in range(10)]
+    for taskName in taskNames:
+        make_claim(claimDir, taskName, age=120)
+    winners = run_race(claimDir, taskNames, claimTimeout=60)
+    assert sorted(winners) == sorted(taskNames)
+    assert all(len(pids) == 1 for pids in winners.values())
+    ## the new claims belong to the winners and nothing is left over from the takeover
+    for taskName, pids in winners.items():
+        with open(p.join(claimDir, f"{taskName}.claim")) as f:
+            assert f.read().split()[1] == str(pids[0])
+    assert not any(".expired." in file for file in os.listdir(claimDir))
+#####################################################################################
+def test_claim_expires_after_claim_timeout(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+    assert not drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+    time.sleep(1.5)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+#####################################################################################
+def test_heartbeat_keeps_claim_alive(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+    with drClaimer.hold_claim(claimDir, "task", claimTimeout=1):
+        time.sleep(1.5)
+        assert not drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+#####################################################################################
+def test_finished_task_is_not_claimed(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=60)
+    drClaimer.release_task(claimDir, "task", succeeded=False)
+    assert drClaimer.is_task_finished(claimDir, "task")
+    assert not drClaimer.claim_task(claimDir, "task", claimTimeout=60)
+    assert os.listdir(claimDir) == ["task.failed"]
+#####################################################################################
+def test_markers_only_count_for_their_hash(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=60, taskHash="old")
+    drClaimer.release_task(claimDir, "task", succeeded=True, taskHash="old")
+    assert drClaimer.is_task_finished(claimDir, "task", "old")
+    assert not drClaimer.claim_task(claimDir, "task", claimTimeout=60, taskHash="old")
+    ## the config has changed since the task was run
+    assert not drClaimer.is_task_finished(claimDir, "task", "new")
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=60, taskHash="new")
+#####################################################################################
+def test_cleared_markers_are_claimed_again(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=60, taskHash="hash")
+    drClaimer.release_task(claimDir, "task", succeeded=False, taskHash="hash")
+    drClaimer.clear_task_markers(claimDir, ["task", "other_task"])
+    assert not drClaimer.is_task_finished(claimDir, "task", "hash")
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=60, taskHash="hash")
+#####################################################################################
+def test_lost_claim_stops_the_task(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+    with pytest.raises(drWallClock.SystemStopped):
+        with drClaimer.hold_claim(claimDir, "task", claimTimeout=1):
+            ## another worker takes the claim over
+            with open(p.join(claimDir, "task.claim"), "w") as f:
+                f.write("otherhost 2 0.0\n")
+            for _ in range(20):
+                drWallClock.check_time_left({}, "the next chunk")
+                time.sleep(0.1)
+    ## the other worker's claim is left alone, and the next task can run
+    with open(p.join(claimDir, "task.claim")) as f:
+        assert f.read() == "otherhost 2 0.0\n"
+    assert drWallClock.has_time_for({}, 0)
+#####################################################################################
+def test_lost_claim_is_reported_after_the_task_finishes(tmp_path):
+    claimDir = str(tmp_path)
+    assert drClaimer.claim_task(claimDir, "task", claimTimeout=1)
+    with pytest.raises(drWallClock.SystemStopped):
+        with drClaimer.hold_claim(claimDir, "task", claimTimeout=1):
+            os.remove(p.join(claimDir, "task.claim"))
+            time.sleep(0.5)
+#####################################################################################
@@ -0,0 +1,19 @@
+## BASIC PYTHON LIBRARIES
+import os
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+
+## drMD LIBRARIES
+import drDaemon
+
+#####################################################################################
+def test_pool_is_replaced_after_a_worker_dies(tmp_path):
+    daemon = drDaemon.DrMDDaemon(str(tmp_path / "drMD.sock"), 1, 1)
+    try:
+        with pytest.raises(BrokenProcessPool):
+            daemon.submit(os._exit, 1).result()
+        ## resubmitted work runs in a new pool
+        assert daemon.submit(pow, 2, 3).result() == 8
+    finally:
+        daemon.server_close()
+#####################################################################################
@@ -0,0 +1,96 @@
+## BASIC PYTHON LIBRARIES
+import os
+import time
+import multiprocessing as mp
+
+## drMD LIBRARIES
+from UtilitiesCloset import drGovernor
+
+## processes competing for the governor
+N_WORKERS: int = 4
+#####################################################################################
+def set_up(tmp_path, governorCpus=4, memoryLimit="1000 MB"):
+    drGovernor.set_up_governor(str(tmp_path), {"governorCpus": governorCpus, "memoryLimit": memoryLimit})
+    drGovernor.POLL_INTERVAL = 0.01
+#####################################################################################
+def hold_repeatedly(tmp_path, cpus, memoryMB, inUse, peak, lock):
+    set_up(tmp_path)
+    for _ in range(10):
+        with drGovernor.hold_resources("test task", cpus=cpus, memoryMB=memoryMB):
+            with lock:
+                inUse[0] += cpus
+                inUse[1] += memoryMB
+                peak[0] = max(peak[0], inUse[0])
+                peak[1] = max(peak[1], inUse[1])
+            time.sleep(0.01)
+            with lock:
+                inUse[0] -= cpus
+                inUse[1] -= memoryMB
+#####################################################################################
+def acquire_and_die(tmp_path):
+    set_up(tmp_path)
+    assert drGovernor.try_acquire(f"{os.getpid()}:0", 4, None, 600.0)
+    os._exit(0)
+#####################################################################################
+def test_processes_share_cpus_and_memory(tmp_path):
+    context = mp.get_context("fork")
+    lock = context.Lock()
+    inUse = context.Array("d", 2, lock=False)
+    peak = context.Array("d", 2, lock=False)
+    ## each task alone fits, but any three together would exceed both limits
+    workers = [context.Process(target=hold_repeatedly, args=(tmp_path, 2 - i % 2, 400.0, inUse, peak, lock))
+               for i in range(N_WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    assert 0 < peak[0] <= 4
+    assert 0 < peak[1] <= 1000
+    ## every holder released its resources
+    set_up(tmp_path)
+    with drGovernor.locked_state() as state:
+        assert state["holders"] == {}
+#####################################################################################
+def test_dead_holder_is_reaped(tmp_path):
+    set_up(tmp_path)
+    context = mp.get_context("fork")
+    holder = context.Process(target=acquire_and_die, args=(tmp_path,))
+    holder.start()
+    holder.join()
+    with drGovernor.locked_state() as state:
+        assert len(state["holders"]) == 1
+    assert drGovernor.try_acquire("me", 4, None, 600.0)
+    with drGovernor.locked_state() as state:
+        assert list(state["holders"]) == ["me"]
+#####################################################################################
+def test_live_holder_blocks(tmp_path):
+    set_up(tmp_path)
+    assert drGovernor.try_acquire(f"{os.getpid()}:1", 3, None)
+    assert not drGovernor.try_acquire(f"{os.getpid()}:2", 2, None)
+    assert drGovernor.try_acquire(f"{os.getpid()}:3", 1, None)
+#####################################################################################
+def test_oversized_task_waits_for_empty_pool(tmp_path):
+    set_up(tmp_path)
+    small, oversized, other = f"{os.getpid()}:1", f"{os.getpid()}:2", f"{os.getpid()}:3"
+    assert drGovernor.try_acquire(small, 1, None, 100.0)
+    assert not drGovernor.try_acquire(oversized, 1, None, 2000.0)
+    drGovernor.release(small)
+    assert drGovernor.try_acquire(oversized, 1, None, 2000.0)
+    ## nothing else that needs memory is let in alongside it
+    assert not drGovernor.try_acquire(other, 1, None, 10.0)
+    drGovernor.release(oversized)
+    assert drGovernor.try_acquire(other, 1, None, 10.0)
+#####################################################################################
+def test_tool_limits(tmp_path):
+    drGovernor.set_up_governor(str(tmp_path), {"governorCpus": 8, "toolLimits": {"sqm": 1}})
+    assert drGovernor.try_acquire(f"{os.getpid()}:1", 1, "sqm")
+    assert not drGovernor.try_acquire(f"{os.getpid()}:2", 1, "sqm")
+    assert drGovernor.try_acquire(f"{os.getpid()}:3", 1, "tleap")
+#####################################################################################
+def test_governor_off_never_waits(tmp_path):
+    drGovernor.set_up_governor(str(tmp_path), {"governorCpus": 0})
+    assert drGovernor.GOVERNOR_FILE is None
+    with drGovernor.hold_resources("test task", cpus=1000, memoryMB=1e9):
+        pass
+#####################################################################################
@@ -0,0 +1,205 @@
+## BASIC PYTHON LIBRARIES
+import copy
+import sqlite3
+from os import path as p
+
+## drMD LIBRARIES
+from UtilitiesCloset import drLedger
+
+#####################################################################################
+def make_run_config():
+    return {"miscInfo": {"trajectorySelections": None},
+            "simulationInfo": [{"stepName": "01_minimisation", "simulationType": "EM", "maxIterations": -1},
+                               {"stepName": "02_NVT", "simulationType": "NVT", "duration": "100 ps", "temperature": 300},
+                               {"stepName": "03_NPT", "simulationType": "NPT", "duration": "1 ns", "temperature": 300},
+                               {"stepName": "04_branch_a", "simulationType": "NPT", "duration": "1 ns", "temperature": 300,
+                                 "startFrom": "02_NVT"},
+                               {"stepName": "05_branch_b", "simulationType": "NPT", "duration": "1 ns", "temperature": 310,
+                                 "startFrom": "02_NVT"}]}
+#####################################################################################
+def make_prepared_system(tmp_path, coords="coords"):
+    inputCoords = tmp_path / "system.inpcrd"
+    amberParams = tmp_path / "system.prmtop"
+    inputCoords.write_text(coords)
+    amberParams.write_text("params")
+    return str(inputCoords), str(amberParams)
+#####################################################################################
+def changed_steps(oldHashes, newHashes):
+    return [i for i, (oldHash, newHash) in enumerate(zip(oldHashes, newHashes)) if oldHash != newHash]
+#####################################################################################
+def test_hash_steps_is_stable(tmp_path):
+    inputCoords, amberParams = make_prepared_system(tmp_path)
+    stepHashes = drLedger.hash_steps(make_run_config(), inputCoords, amberParams)
+    assert len(set(stepHashes)) == 5
+    assert drLedger.hash_steps(make_run_config(), inputCoords, amberParams) == stepHashes
+#####################################################################################
+def test_changed_step_invalidates_only_downstream_steps(tmp_path):
+    inputCoords, amberParams = make_prepared_system(tmp_path)
+    oldHashes = drLedger.hash_steps(make_run_config(), inputCoords, amberParams)
+
+    runConfig = make_run_config()
+    runConfig["simulationInfo"][2]["duration"] = "2 ns"
+    ## 03_NPT has no children, the branches start from 02_NVT
+    assert changed_steps(oldHashes, drLedger.hash_steps(runConfig, inputCoords, amberParams)) == [2]
+
+    runConfig = make_run_config()
+    runConfig["simulationInfo"][1]["temperature"] = 310
+    assert changed_steps(oldHashes, drLedger.hash_steps(runConfig, inputCoords, amberParams)) == [1, 2, 3, 4]
+
+    runConfig = make_run_config()
+    runConfig["simulationInfo"][3]["temperature"] = 320
+    assert changed_steps(oldHashes, drLedger.hash_steps(runConfig, inputCoords, amberParams)) == [3]
+#####################################################################################
+def test_changed_prepared_system_invalidates_every_step(tmp_path):
+    inputCoords, amberParams = make_prepared_system(tmp_path)
+    oldHashes = drLedger.hash_steps(make_run_config(), inputCoords, amberParams)
+    inputCoords, amberParams = make_prepared_system(tmp_path, coords="moved coords")
+    assert changed_steps(oldHashes, drLedger.hash_steps(make_run_config(), inputCoords, amberParams)) == [0, 1, 2, 3, 4]
+#####################################################################################
+def test_step_hash_round_trip(tmp_path):
+    simDir = str(tmp_path / "01_minimisation")
+    assert drLedger.read_step_hash(simDir) is None
+    drLedger.write_step_hash(simDir, "abc123")
+    assert drLedger.read_step_hash(simDir) == "abc123"
+#####################################################################################
+def test_hash_batch_config_ignores_hardwareInfo():
+    batchConfig = {"hardwareInfo": {"parallelCPU": 1}, "simulationInfo": make_run_config()["simulationInfo"]}
+    otherHardware = copy.deepcopy(batchConfig)
+    otherHardware["hardwareInfo"]["parallelCPU"] = 8
+    otherProtocol = copy.deepcopy(batchConfig)
+    otherProtocol["simulationInfo"][0]["maxIterations"] = 100
+    assert drLedger.hash_batch_config(otherHardware) == drLedger.hash_batch_config(batchConfig)
+    assert drLedger.hash_batch_config(otherProtocol) != drLedger.hash_batch_config(batchConfig)
+#####################################################################################
+def test_attempts_increment_on_each_run(tmp_path):
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    drLedger.register_systems(ledgerFile, ["/inputs/protA.pdb"])
+    assert drLedger.get_system(ledgerFile, "protA")["attempts"] == 0
+
+    drLedger.update_system(ledgerFile, "protA", state=drLedger.RUNNING)
+    drLedger.update_system(ledgerFile, "protA", state=drLedger.FAILED)
+    drLedger.update_system(ledgerFile, "protA", state=drLedger.RUNNING)
+    record = drLedger.get_system(ledgerFile, "protA")
+    assert record["attempts"] == 2
+    assert record["state"] == drLedger.RUNNING
+    assert record["endTime"] is None
+
+    drLedger.update_step(ledgerFile, "protA", "01_minimisation", stepIndex=0, state=drLedger.RUNNING)
+    drLedger.update_step(ledgerFile, "protA", "01_minimisation", state=drLedger.PAUSED)
+    drLedger.update_step(ledgerFile, "protA", "01_minimisation", state=drLedger.RUNNING)
+    drLedger.update_step(ledgerFile, "protA", "01_minimisation", state=drLedger.DONE, saveFile="01_minimisation.xml")
+    stepRecord = drLedger.get_steps(ledgerFile, "protA")["01_minimisation"]
+    assert stepRecord["attempts"] == 2
+    assert stepRecord["stepIndex"] == 0
+    assert stepRecord["saveFile"] == "01_minimisation.xml"
+    assert stepRecord["endTime"] >= stepRecord["startTime"]
+#####################################################################################
+def test_step_retries_are_counted_across_processes(tmp_path):
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    assert drLedger.get_step_retries(ledgerFile, "protA") == 0
+    ## a firstAid retry, then a stall restart of another step
+    assert drLedger.count_step_retry(ledgerFile, "protA", "02_NVT") == 1
+    assert drLedger.count_step_retry(ledgerFile, "protA", "02_NVT") == 2
+    assert drLedger.count_step_retry(ledgerFile, "protA", "03_NPT") == 1
+    assert drLedger.get_step_retries(ledgerFile, "protA", "03_NPT") == 1
+    assert drLedger.get_step_retries(ledgerFile, "protA") == 2
+    ## a fresh run of the step starts with the full budget again
+    drLedger.update_step(ledgerFile, "protA", "02_NVT", state=drLedger.RUNNING, retries=0)
+    assert drLedger.get_step_retries(ledgerFile, "protA", "02_NVT") == 0
+#####################################################################################
+def test_register_systems_keeps_existing_records(tmp_path):
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    assert p.dirname(ledgerFile) == str(tmp_path / "00_drMD_logs")
+    drLedger.register_systems(ledgerFile, ["/inputs/protA.pdb"])
+    drLedger.update_system(ledgerFile, "protA", state=drLedger.DONE, configHash="hash")
+    drLedger.register_systems(ledgerFile, ["/inputs/protA.pdb", "/inputs/protB.pdb"])
+    assert drLedger.get_system(ledgerFile, "protA")["state"] == drLedger.DONE
+    assert drLedger.get_system(ledgerFile, "protB")["state"] == drLedger.PENDING
+#####################################################################################
+def test_get_finished_systems(tmp_path):
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    assert drLedger.get_finished_systems(str(tmp_path / "missing.db"), "hash") == []
+    drLedger.register_systems(ledgerFile, [f"/inputs/prot{name}.pdb" for name in "ABCD"])
+    drLedger.update_system(ledgerFile, "protA", state=drLedger.DONE, configHash="hash")
+    drLedger.update_system(ledgerFile, "protB", state=drLedger.DONE, configHash="oldHash")
+    drLedger.update_system(ledgerFile, "protC", state=drLedger.FAILED, configHash="hash")
+    drLedger.update_system(ledgerFile, "protD", state=drLedger.RUNNING, configHash="hash")
+    assert drLedger.get_finished_systems(ledgerFile, "hash") == ["protA"]
+#####################################################################################
+def make_prep_config(tmp_path):
+    inputDir = tmp_path / "inputs"
+    inputDir.mkdir(exist_ok=True)
+    for fileName, contents in [("protA.pdb", "ATOM\n"), ("LIG.frcmod", "params\n")]:
+        if not (inputDir / fileName).exists():
+            (inputDir / fileName).write_text(contents)
+    return {"pathInfo": {"inputDir": str(inputDir), "inputPdb": str(inputDir / "protA.pdb"),
+                         "outputDir": str(tmp_path / "outputs" / "protA")},
+            "proteinInfo": {"proteinName": "protA", "protons": True},
+            "ligandInfo": [{"ligandName": "LIG", "protons": True, "charge": 0}],
+            "miscInfo": {"pH": 7.4, "boxGeometry": "cubic", "boxSize": 10, "skipPdbTriage": False,
+                         "trajectorySelections": None}}
+#####################################################################################
+def test_hash_prep_settings(tmp_path):
+    prepHash = drLedger.hash_prep_settings(make_prep_config(tmp_path))
+
+    renamed = make_prep_config(tmp_path)
+    renamed["proteinInfo"]["proteinName"] = "protB"
+    renamed["simulationInfo"] = make_run_config()["simulationInfo"]
+    assert drLedger.hash_prep_settings(renamed) == prepHash
+
+    otherPh = make_prep_config(tmp_path)
+    otherPh["miscInfo"]["pH"] = 5.0
+    otherLigand = make_prep_config(tmp_path)
+    otherLigand["ligandInfo"][0]["charge"] = -1
+    otherBox = make_prep_config(tmp_path)
+    otherBox["miscInfo"]["boxSize"] = 12
+    for changedConfig in [otherPh, otherLigand, otherBox]:
+        assert drLedger.hash_prep_settings(changedConfig) != prepHash
+
+    (tmp_path / "inputs" / "LIG.frcmod").write_text("new params\n")
+    assert drLedger.hash_prep_settings(make_prep_config(tmp_path)) != prepHash
+#####################################################################################
+def test_old_ledger_gains_prepHash_column(tmp_path):
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    connection = sqlite3.connect(ledgerFile)
+    with connection:
+        connection.execute("CREATE TABLE systems (systemName TEXT PRIMARY KEY, pdbFile TEXT, configYaml TEXT, configHash TEXT, "
+                           "state TEXT, attempts INTEGER DEFAULT 0, startTime REAL, endTime REAL, prepState TEXT, "
+                           "solvatedPdb TEXT, inputCoords TEXT, amberParams TEXT)")
+        connection.execute("INSERT INTO systems (systemName, prepState) VALUES ('protA', 'done')")
+    connection.close()
+    record = drLedger.get_system(ledgerFile, "protA")
+    assert record["prepState"] == drLedger.DONE and record["prepHash"] is None
+#####################################################################################
+def test_old_ledger_gains_step_columns(tmp_path):
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    connection = sqlite3.connect(ledgerFile)
+    with connection:
+        connection.execute("CREATE TABLE steps (systemName TEXT, stepName TEXT, stepIndex INTEGER, state TEXT, "
+                           "attempts INTEGER DEFAULT 0, startTime REAL, endTime REAL, saveFile TEXT, "
+                           "PRIMARY KEY (systemName, stepName))")
+        connection.execute("INSERT INTO steps (systemName, stepName, state) VALUES ('protA', '02_NVT', 'running')")
+    connection.close()
+    assert drLedger.get_step_retries(ledgerFile, "protA") == 0
+    assert drLedger.count_step_retry(ledgerFile, "protA", "02_NVT") == 1
+    ## and the restoredFrom column of steps reused from the memo store
+    drLedger.update_step(ledgerFile, "protA", "02_NVT", state=drLedger.DONE, restoredFrom="memoKey")
+    assert drLedger.get_steps(ledgerFile, "protA")["02_NVT"]["restoredFrom"] == "memoKey"
+#####################################################################################
+def test_changed_prep_settings_are_not_skipped(tmp_path):
+    from Surgery import drPrep
+    config = make_prep_config(tmp_path)
+    prepDir = tmp_path / "outputs" / "protA" / "00_prep"
+    (prepDir / "WHOLE").mkdir(parents=True)
+    prepFiles = tuple(str(prepDir / "WHOLE" / fileName) for fileName in ["protA_solvated.pdb", "protA.inpcrd", "protA.prmtop"])
+    for prepFile in prepFiles:
+        open(prepFile, "w").close()
+    ledgerFile = drLedger.get_ledger_file_for_run(config)
+    drLedger.update_system(ledgerFile, "protA", prepState=drLedger.DONE, prepHash=drLedger.hash_prep_settings(config),
+                           solvatedPdb=prepFiles[0], inputCoords=prepFiles[1], amberParams=prepFiles[2])
+    assert drPrep.choose_to_skip_prep(config, str(prepDir), "protA") == (True, prepFiles)
+
+    config["miscInfo"]["pH"] = 5.0
+    ## the prep files on disk are not used either
+    assert drPrep.choose_to_skip_prep(config, str(prepDir), "protA") == (False, None)
+#####################################################################################
@@ -0,0 +1,61 @@
+## BASIC PYTHON LIBRARIES
+import sys
+from os import path as p
+from queue import Queue, Empty
+import multiprocessing as mp
+import pytest
+
+## drMD LIBRARIES
+import drMD
+from UtilitiesCloset import drLedger
+from ExaminationRoom import drLogger
+
+#####################################################################################
+def exit_without_result(pdbFile, batchConfig, workerMode=False, preparedSystem=None):
+    ## as a dependency calling sys.exit(0) would
+    sys.exit(0)
+#####################################################################################
+def stall(pdbFile, batchConfig, workerMode=False, preparedSystem=None):
+    runConfig = {"pathInfo": {"outputDir": p.join(batchConfig["pathInfo"]["outputDir"], "system")}}
+    drLogger.handle_stall("02_NVT", "system", 600, runConfig)
+#####################################################################################
+def make_batch_config(tmp_path):
+    return {"pathInfo": {"outputDir": str(tmp_path)},
+            "hardwareInfo": {"parallelCPU": 1, "subprocessCpus": 1, "platform": "CPU",
+                             "elasticThreads": False, "pinCpus": False},
+            "miscInfo": {"workerCrashRetries": 1, "firstAidMaxRetries": 1}}
+#####################################################################################
+def test_missing_result_is_an_error(monkeypatch):
+    monkeypatch.setattr(drMD, "RESULT_TIMEOUT", 1.0)
+    with pytest.raises(Empty):
+        drMD.collect_system_result(mp.Queue(), "system")
+#####################################################################################
+def test_missing_result_is_retried_then_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(drMD, "process_pdb_file", exit_without_result)
+    monkeypatch.setattr(drMD, "RESULT_TIMEOUT", 1.0)
+    pdbFile = str(tmp_path / "system.pdb")
+    batchConfig = make_batch_config(tmp_path)
+    pdbQueue = Queue()
+    pdbQueue.put((pdbFile, None))
+    pdbQueue.put(None)
+    botchedSimulations = drMD.run_simulation_workers(pdbQueue, [pdbFile], batchConfig, False)
+    assert [errorData["errorType"] for errorData in botchedSimulations] == ["WorkerCrash"]
+    assert "2 attempts" in botchedSimulations[0]["errorMessage"]
+    assert drLedger.get_system(drLedger.get_ledger_file(str(tmp_path)), "system")["state"] == drLedger.FAILED
+#####################################################################################
+def test_stalls_share_the_firstAid_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(drMD, "process_pdb_file", stall)
+    pdbFile = str(tmp_path / "system.pdb")
+    batchConfig = {**make_batch_config(tmp_path), "miscInfo": {"workerCrashRetries": 5, "firstAidMaxRetries": 3}}
+    ## firstAid has already retried the step twice, so one stall restart is left
+    ledgerFile = drLedger.get_ledger_file(str(tmp_path))
+    drLedger.count_step_retry(ledgerFile, "system", "02_NVT")
+    drLedger.count_step_retry(ledgerFile, "system", "02_NVT")
+    pdbQueue = Queue()
+    pdbQueue.put((pdbFile, None))
+    pdbQueue.put(None)
+    botchedSimulations = drMD.run_simulation_workers(pdbQueue, [pdbFile], batchConfig, False)
+    assert [errorData["errorType"] for errorData in botchedSimulations] == ["Stalled"]
+    assert drLedger.get_step_retries(ledgerFile, "system", "02_NVT") == 4
+    assert drLedger.get_system(ledgerFile, "system")["state"] == drLedger.FAILED
+#####################################################################################
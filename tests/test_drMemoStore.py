@@ -0,0 +1,121 @@
+## BASIC PYTHON LIBRARIES
+import os
+
+## drMD LIBRARIES
+from UtilitiesCloset import drMemoStore
+
+#####################################################################################
+def make_run_config(tmp_path, protName="protA"):
+    inputDir = tmp_path / "inputs"
+    inputDir.mkdir(exist_ok=True)
+    if not (inputDir / "protA.pdb").exists():
+        (inputDir / "protA.pdb").write_text("ATOM\n")
+    return {"pathInfo": {"inputDir": str(inputDir), "inputPdb": str(inputDir / "protA.pdb"),
+                         "outputDir": str(tmp_path / "outputs" / protName)},
+            "proteinInfo": {"proteinName": protName, "protons": True},
+            "miscInfo": {"pH": 7.4, "boxGeometry": "cubic", "boxSize": 10, "skipPdbTriage": False},
+            "hardwareInfo": {"memoStoreDir": str(tmp_path / "memo"), "memoStoreSize": "1 GB"},
+            "simulationInfo": [{"stepName": "01_minimisation", "simulationType": "EM", "maxIterations": -1},
+                               {"stepName": "02_NVT", "simulationType": "NVT", "duration": "100 ps", "temperature": 300},
+                               {"stepName": "03_NPT", "simulationType": "NPT", "duration": "1 ns", "temperature": 300}]}
+#####################################################################################
+def make_entry(memoDir, memoKey, sizeMB, age):
+    entryDir = os.path.join(memoDir, memoKey)
+    os.makedirs(entryDir)
+    with open(os.path.join(entryDir, drMemoStore.STATE_FILE), "wb") as f:
+        f.write(b"x" * int(sizeMB * 1024 ** 2))
+    os.utime(entryDir, (1e9 - age, 1e9 - age))
+#####################################################################################
+def test_renamed_steps_and_systems_have_the_same_keys(tmp_path):
+    memoKeys = drMemoStore.hash_memo_keys(make_run_config(tmp_path))
+    renamed = make_run_config(tmp_path, protName="protB")
+    for i, sim in enumerate(renamed["simulationInfo"]):
+        sim["stepName"] = f"step_{i}"
+    renamed["hardwareInfo"]["memoStoreSize"] = "5 GB"
+    assert drMemoStore.hash_memo_keys(renamed) == memoKeys
+#####################################################################################
+def test_changed_prep_or_step_gives_different_keys(tmp_path):
+    memoKeys = drMemoStore.hash_memo_keys(make_run_config(tmp_path))
+
+    otherPh = make_run_config(tmp_path)
+    otherPh["miscInfo"]["pH"] = 6.0
+    assert not set(drMemoStore.hash_memo_keys(otherPh)) & set(memoKeys)
+
+    otherStep = make_run_config(tmp_path)
+    otherStep["simulationInfo"][1]["temperature"] = 310
+    otherKeys = drMemoStore.hash_memo_keys(otherStep)
+    assert otherKeys[0] == memoKeys[0]
+    assert otherKeys[1] != memoKeys[1] and otherKeys[2] != memoKeys[2]
+
+    (tmp_path / "inputs" / "protA.pdb").write_text("ATOM moved\n")
+    assert not set(drMemoStore.hash_memo_keys(make_run_config(tmp_path))) & set(memoKeys)
+#####################################################################################
+def test_store_and_restore_step(tmp_path):
+    runConfig = make_run_config(tmp_path)
+    memoKey = drMemoStore.hash_memo_keys(runConfig)[1]
+    simDir = tmp_path / "outputs" / "protA" / "02_NVT"
+    simDir.mkdir(parents=True)
+    (simDir / "02_NVT.xml").write_text("<State/>")
+    (simDir / "protA.pdb").write_text("ATOM\n")
+    (simDir / "trajectory.dcd").write_bytes(b"frames")
+    (simDir / "trajectory.pdb").write_text("ATOM trajectory\n")
+    (simDir / "checkpoint.chk").write_bytes(b"checkpoint")
+    (simDir / "00_reporters_and_plots").mkdir()
+    (simDir / "00_reporters_and_plots" / "rmsd_report.csv").write_text("Backbone RMSD (Angstrom)\n1.0\n")
+    drMemoStore.store_step(runConfig, memoKey, str(simDir), str(simDir / "02_NVT.xml"))
+
+    otherConfig = make_run_config(tmp_path, protName="protB")
+    otherSimDir = tmp_path / "outputs" / "protB" / "step_1"
+    assert drMemoStore.restore_step(otherConfig, "missingKey", str(otherSimDir)) is None
+    restoredXml = drMemoStore.restore_step(otherConfig, memoKey, str(otherSimDir))
+    assert restoredXml == str(otherSimDir / "step_1.xml")
+    assert (otherSimDir / "step_1.xml").read_text() == "<State/>"
+    assert (otherSimDir / "protB.pdb").read_text() == "ATOM\n"
+    ## later stages read the trajectory and reports of the step
+    assert (otherSimDir / "trajectory.dcd").read_bytes() == b"frames"
+    assert (otherSimDir / "trajectory.pdb").read_text() == "ATOM trajectory\n"
+    assert (otherSimDir / "00_reporters_and_plots" / "rmsd_report.csv").is_file()
+    assert sorted(os.listdir(otherSimDir)) == ["00_reporters_and_plots", "protB.pdb", "step_1.xml", "trajectory.dcd", "trajectory.pdb"]
+#####################################################################################
+def test_entries_without_step_files_are_not_restored(tmp_path):
+    ## stored by an older drMD, with only the state and endpoint
+    runConfig = make_run_config(tmp_path)
+    entryDir = os.path.join(runConfig["hardwareInfo"]["memoStoreDir"], "oldKey")
+    os.makedirs(entryDir)
+    with open(os.path.join(entryDir, drMemoStore.STATE_FILE), "w") as f:
+        f.write("<State/>")
+    assert drMemoStore.restore_step(runConfig, "oldKey", str(tmp_path / "outputs" / "protA" / "02_NVT")) is None
+#####################################################################################
+def test_eviction_removes_least_recently_used(tmp_path):
+    memoDir = str(tmp_path / "memo")
+    for age, memoKey in enumerate(["newest", "newer", "older", "oldest"]):
+        make_entry(memoDir, memoKey, sizeMB=1, age=age)
+    drMemoStore.evict_entries(memoDir, memoStoreSizeMB=2.5)
+    assert sorted(os.listdir(memoDir)) == ["newer", "newest"]
+    ## nothing is evicted while the store is under memoStoreSize
+    drMemoStore.evict_entries(memoDir, memoStoreSizeMB=None)
+    drMemoStore.evict_entries(memoDir, memoStoreSizeMB=10)
+    assert sorted(os.listdir(memoDir)) == ["newer", "newest"]
+#####################################################################################
+def test_eviction_keeps_keepKey(tmp_path):
+    memoDir = str(tmp_path / "memo")
+    make_entry(memoDir, "justStored", sizeMB=2, age=10)
+    make_entry(memoDir, "other", sizeMB=1, age=0)
+    drMemoStore.evict_entries(memoDir, memoStoreSizeMB=1.5, keepKey="justStored")
+    assert os.listdir(memoDir) == ["justStored"]
+#####################################################################################
+def test_store_step_stays_under_memoStoreSize(tmp_path):
+    runConfig = make_run_config(tmp_path)
+    runConfig["hardwareInfo"]["memoStoreSize"] = "3 MB"
+    memoDir = runConfig["hardwareInfo"]["memoStoreDir"]
+    simDir = tmp_path / "outputs" / "protA" / "02_NVT"
+    simDir.mkdir(parents=True)
+    (simDir / "02_NVT.xml").write_bytes(b"x" * 1024 ** 2)
+    for i in range(5):
+        drMemoStore.store_step(runConfig, f"key{i}", str(simDir), str(simDir / "02_NVT.xml"))
+    entries = [entry for entry in os.listdir(memoDir) if not entry.startswith(".")]
+    sizeMB = sum(os.path.getsize(os.path.join(memoDir, entry, file)) for entry in entries
+                 for file in os.listdir(os.path.join(memoDir, entry))) / 1024 ** 2
+    assert sizeMB <= 3
+    assert "key4" in entries
+#####################################################################################
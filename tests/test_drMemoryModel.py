@@ -0,0 +1,73 @@
+## BASIC PYTHON LIBRARIES
+import csv
+import threading
+
+## drMD LIBRARIES
+from UtilitiesCloset import drMemoryModel
+
+#####################################################################################
+def allocate(sizeMB):
+    block = bytearray(int(sizeMB * 1024 ** 2))
+    ## touch every page so that it is resident
+    block[::4096] = b"x" * len(block[::4096])
+    return block
+#####################################################################################
+def test_parse_memory():
+    assert drMemoryModel.parse_memory(None) is None
+    assert drMemoryModel.parse_memory("500 MB") == 500
+    assert drMemoryModel.parse_memory("2 gb") == 2048
+    assert drMemoryModel.parse_memory(1) == 1024
+#####################################################################################
+def test_fit_memory_model(tmp_path):
+    batchOutDir = str(tmp_path)
+    assert drMemoryModel.fit_memory_model(batchOutDir, "simulation") == drMemoryModel.DEFAULT_MEMORY_MODELS["simulation"]
+    for size, peakMB in [(1000, 600.0), (3000, 1000.0)]:
+        drMemoryModel.record_peak_memory(batchOutDir, "simulation", "label", size, peakMB)
+    drMemoryModel.record_peak_memory(batchOutDir, "clustering", "label", 1, 1e6)
+    intercept, slope = drMemoryModel.fit_memory_model(batchOutDir, "simulation")
+    assert abs(intercept - 400.0) < 1e-6 and abs(slope - 0.2) < 1e-6
+#####################################################################################
+def test_each_task_is_measured_on_its_own(tmp_path):
+    batchOutDir = str(tmp_path)
+    with drMemoryModel.measure_peak_memory(batchOutDir, "simulation", "big", 2):
+        block = allocate(300)
+        del block
+    with drMemoryModel.measure_peak_memory(batchOutDir, "simulation", "small", 1):
+        block = allocate(10)
+        del block
+    with open(drMemoryModel.get_measurements_file(batchOutDir)) as f:
+        peaks = {row[1]: float(row[3]) for row in csv.reader(f)}
+    if drMemoryModel.reset_peak_rss():
+        ## the small task does not inherit the peak of the big one
+        assert peaks["big"] - peaks["small"] > 200
+    else:
+        assert list(peaks) == ["big"]
+#####################################################################################
+def test_overlapping_tasks_are_not_recorded(tmp_path):
+    batchOutDir = str(tmp_path)
+    started, finish = threading.Event(), threading.Event()
+
+    def other_task():
+        with drMemoryModel.measure_peak_memory(batchOutDir, "simulation", "other", 1):
+            started.set()
+            finish.wait()
+
+    otherThread = threading.Thread(target=other_task)
+    otherThread.start()
+    started.wait()
+    with drMemoryModel.measure_peak_memory(batchOutDir, "simulation", "this", 1):
+        pass
+    finish.set()
+    otherThread.join()
+    assert drMemoryModel.read_measurements(batchOutDir, "simulation") == []
+#####################################################################################
+def test_failed_task_is_not_recorded(tmp_path):
+    batchOutDir = str(tmp_path)
+    try:
+        with drMemoryModel.measure_peak_memory(batchOutDir, "simulation", "failed", 1):
+            raise RuntimeError("simulation blew up")
+    except RuntimeError:
+        pass
+    assert drMemoryModel.read_measurements(batchOutDir, "simulation") == []
+    assert drMemoryModel.ACTIVE_MEASUREMENTS == []
+#####################################################################################
@@ -0,0 +1,121 @@
+## BASIC PYTHON LIBRARIES
+import pandas as pd
+import pytest
+
+## drMD LIBRARIES
+from Surgery import drMutator
+
+## atoms of each residue of a small test system, side chains are trimmed to a few atoms
+RESIDUE_ATOMS = {"ALA": ["N", "H", "CA", "HA", "CB", "HB1", "HB2", "HB3", "C", "O"],
+                 "GLY": ["N", "H", "CA", "HA2", "HA3", "C", "O"],
+                 "SER": ["N", "H", "CA", "HA", "CB", "HB2", "HB3", "OG", "HG", "C", "O"]}
+#####################################################################################
+def make_system(waterOxygens):
+    """
+    Three residues along x (ALA 1 at 0 A, GLY 2 at 4 A, SER 3 at 8 A) followed by waters
+    Every water has the same residue number, as happens in large systems
+    """
+    rows = []
+    for resId, resName in enumerate(["ALA", "GLY", "SER"], start=1):
+        for atomName in RESIDUE_ATOMS[resName]:
+            rows.append({"ATOM_NAME": atomName, "RES_NAME": resName, "CHAIN_ID": "A", "RES_ID": resId,
+                         "X": 4.0 * (resId - 1), "Y": 0.0, "Z": 0.0})
+    for x, y, z in waterOxygens:
+        for atomName, offset in [("O", 0.0), ("H1", 0.9), ("H2", -0.9)]:
+            rows.append({"ATOM_NAME": atomName, "RES_NAME": "HOH", "CHAIN_ID": "W", "RES_ID": 1,
+                         "X": x + offset, "Y": y, "Z": z})
+    systemDf = pd.DataFrame(rows)
+    systemDf.insert(0, "ATOM_ID", range(1, len(systemDf) + 1))
+    return systemDf
+#####################################################################################
+def get_residue(systemDf, resId):
+    residueDf = systemDf[(systemDf["CHAIN_ID"] == "A") & (systemDf["RES_ID"] == resId)]
+    return residueDf["RES_NAME"].unique().tolist(), set(residueDf["ATOM_NAME"])
+#####################################################################################
+@pytest.mark.parametrize("resId, newResName, expectedResName, expectedAtoms", [
+    ## the CB is kept, the rest of the side chain is rebuilt by tleap
+    (1, "LEU", "LEU", {"N", "H", "CA", "CB", "C", "O"}),
+    ## glycine has no CB to keep, and a glycine CB would point the wrong way
+    (1, "GLY", "GLY", {"N", "H", "CA", "C", "O"}),
+    (2, "ALA", "ALA", {"N", "H", "CA", "C", "O"}),
+    ## proline has no backbone amide hydrogen
+    (3, "PRO", "PRO", {"N", "CA", "CB", "C", "O"}),
+    ## histidine is protonated on the epsilon nitrogen, as in prep
+    (3, "HIS", "HIE", {"N", "H", "CA", "CB", "C", "O"})])
+def test_kept_atoms(resId, newResName, expectedResName, expectedAtoms):
+    wildTypeDf = make_system([])
+    mutantDf = drMutator.mutate_system(wildTypeDf, [("A", resId, newResName)])
+    assert get_residue(mutantDf, resId) == ([expectedResName], expectedAtoms)
+    ## other residues are left alone
+    for otherResId in {1, 2, 3} - {resId}:
+        assert get_residue(mutantDf, otherResId) == get_residue(wildTypeDf, otherResId)
+    assert mutantDf["ATOM_ID"].tolist() == list(range(1, len(mutantDf) + 1))
+#####################################################################################
+def test_clashing_waters_are_removed_whole():
+    ## mutating ALA 1 clears waters around its CB at the origin
+    wildTypeDf = make_system([(0.0, 3.0, 0.0),
+                              (0.0, drMutator.WATER_CLEARANCE - 0.5, 0.0),
+                              (0.0, drMutator.WATER_CLEARANCE + 0.5, 0.0),
+                              (0.0, 20.0, 0.0)])
+    mutantDf = drMutator.mutate_system(wildTypeDf, [("A", 1, "LEU")])
+    waterDf = mutantDf[mutantDf["RES_NAME"] == "HOH"]
+    assert waterDf["ATOM_NAME"].tolist() == ["O", "H1", "H2"] * 2
+    assert sorted(waterDf[waterDf["ATOM_NAME"] == "O"]["Y"].tolist()) == [drMutator.WATER_CLEARANCE + 0.5, 20.0]
+    assert mutantDf["ATOM_ID"].tolist() == list(range(1, len(mutantDf) + 1))
+#####################################################################################
+def test_waters_cleared_around_each_mutation():
+    wildTypeDf = make_system([(0.0, 3.0, 0.0), (8.0, 3.0, 0.0), (4.0, 20.0, 0.0)])
+    mutantDf = drMutator.mutate_system(wildTypeDf, [("A", 1, "LEU"), ("A", 3, "THR")])
+    assert mutantDf[(mutantDf["RES_NAME"] == "HOH") & (mutantDf["ATOM_NAME"] == "O")]["Y"].tolist() == [20.0]
+    assert get_residue(mutantDf, 1)[0] == ["LEU"] and get_residue(mutantDf, 3)[0] == ["THR"]
+#####################################################################################
+def test_missing_residue_is_an_error():
+    with pytest.raises(ValueError):
+        drMutator.mutate_system(make_system([]), [("B", 1, "ALA")])
+#####################################################################################
+def test_parse_mutant_and_name():
+    mutations = drMutator.parse_mutant("A:45:ALA+B:-2:LYS")
+    assert mutations == [("A", 45, "ALA"), ("B", -2, "LYS")]
+    assert drMutator.get_mutant_name("WT", mutations) == "WT_A45ALA_B-2LYS"
+#####################################################################################
+def make_simulation_info():
+    return [{"stepName": "01_minimisation", "simulationType": "EM", "maxIterations": 500},
+            {"stepName": "02_NVT", "simulationType": "NVT", "duration": "100 ps", "temperatureRange": [100, 200, 300]},
+            {"stepName": "03_NPT", "simulationType": "NPT", "duration": "1 ns", "temperature": 300,
+              "restraintInfo": [{"restraintType": "position"}]},
+            {"stepName": "04_production", "simulationType": "NPT", "duration": "10 ns", "temperature": 300},
+            {"stepName": "05_hot_branch", "simulationType": "NPT", "duration": "10 ns", "temperature": 350, "startFrom": "03_NPT"},
+            {"stepName": "06_cold_branch", "simulationType": "NPT", "duration": "10 ns", "temperature": 250, "startFrom": "02_NVT"},
+            {"stepName": "07_after_cold", "simulationType": "NPT", "duration": "10 ns", "temperature": 250},
+            {"stepName": "08_after_hot", "simulationType": "NPT", "duration": "10 ns", "temperature": 350, "startFrom": "05_hot_branch"}]
+#####################################################################################
+def test_mutant_protocol_rewires_descendants_of_fromStep():
+    relaxRestraints = [{"restraintType": "position", "selection": {"keyword": "backbone"}, "parameters": {"k": 1000}}]
+    mutantSimulationInfo = drMutator.make_mutant_protocol(make_simulation_info(), "03_NPT", "50 ps", relaxRestraints)
+    assert [(sim["stepName"], sim.get("startFrom", None)) for sim in mutantSimulationInfo] == [
+        (drMutator.MINIMISATION_STEP, None),
+        (drMutator.RELAXATION_STEP, None),
+        ("04_production", drMutator.RELAXATION_STEP),
+        ("05_hot_branch", drMutator.RELAXATION_STEP),
+        ("08_after_hot", "05_hot_branch")]
+#####################################################################################
+def test_mutant_protocol_relaxation_steps():
+    relaxRestraints = [{"restraintType": "position", "selection": {"keyword": "backbone"}, "parameters": {"k": 1000}}]
+    simulationInfo = make_simulation_info()
+    minimisationSim, relaxationSim = drMutator.make_mutant_protocol(simulationInfo, "02_NVT", "50 ps", relaxRestraints)[:2]
+    ## the batch minimisation is used as a template
+    assert minimisationSim["maxIterations"] == 500
+    assert minimisationSim["restraintInfo"] == relaxRestraints
+    ## the relaxation copies fromStep at the last temperature of its range
+    assert relaxationSim["simulationType"] == "NVT"
+    assert relaxationSim["duration"] == "50 ps"
+    assert relaxationSim["temperature"] == 300 and "temperatureRange" not in relaxationSim
+    assert relaxationSim["restraintInfo"] == relaxRestraints
+    ## the batch config is not changed
+    assert simulationInfo == make_simulation_info()
+#####################################################################################
+def test_mutant_protocol_without_restraints():
+    mutantSimulationInfo = drMutator.make_mutant_protocol(make_simulation_info(), "03_NPT", "50 ps", [])
+    assert "restraintInfo" not in mutantSimulationInfo[0]
+    assert "restraintInfo" not in mutantSimulationInfo[1]
+#####################################################################################
@@ -0,0 +1,26 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import pandas as pd
+
+## drMD LIBRARIES
+from ExaminationRoom import drScreener, drCheckup
+
+#####################################################################################
+def write_rmsd_report(stepDir, rmsdValues):
+    os.makedirs(p.dirname(drCheckup.get_rmsd_report(stepDir)), exist_ok=True)
+    pd.DataFrame({"Timestep (ps)": [10.0 * i for i in range(len(rmsdValues))],
+                  "Backbone RMSD (Angstrom)": rmsdValues}).to_csv(drCheckup.get_rmsd_report(stepDir), index=False)
+#####################################################################################
+def test_score_is_read_from_the_rmsd_report(tmp_path):
+    replicaDirs = [str(tmp_path / "03_NVT_1"), str(tmp_path / "03_NVT_2")]
+    write_rmsd_report(replicaDirs[0], [0.0, 9.0, 1.0, 3.0])
+    write_rmsd_report(replicaDirs[1], [0.0, 9.0, 3.0, 5.0])
+    ## no trajectory files, so the score can only have come from the reports
+    assert drScreener.score_system(replicaDirs) == 3.0
+#####################################################################################
+def test_step_without_rmsd_report_is_not_scored(tmp_path):
+    stepDir = str(tmp_path / "03_NVT")
+    os.makedirs(stepDir)
+    assert drScreener.score_system([stepDir]) is None
+#####################################################################################
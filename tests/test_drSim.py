@@ -0,0 +1,86 @@
+## BASIC PYTHON LIBRARIES
+import signal
+import pytest
+
+## OPENMM LIBRARIES
+import openmm
+from openmm import app
+
+## drMD LIBRARIES
+from Surgery import drSim
+from UtilitiesCloset import drWallClock
+
+#####################################################################################
+def test_temperature_schedule_from_start():
+    assert drSim.get_temperature_schedule(3000, [300, 310, 320]) == [(300, 1000), (310, 1000), (320, 1000)]
+#####################################################################################
+def test_resumed_temperature_schedule_carries_on_from_its_rung():
+    ## stopped part way through the second rung
+    assert drSim.get_temperature_schedule(3000, [300, 310, 320], completedSteps=1400) == [(310, 600), (320, 1000)]
+    ## stopped exactly at the end of a rung
+    assert drSim.get_temperature_schedule(3000, [300, 310, 320], completedSteps=2000) == [(320, 1000)]
+    assert drSim.get_temperature_schedule(3000, [300, 310, 320], completedSteps=3000) == []
+#####################################################################################
+def test_resumed_schedule_adds_up_to_the_full_step():
+    fullSchedule = drSim.get_temperature_schedule(1000, [280, 290, 300, 310])
+    for completedSteps in range(0, 1001, 50):
+        resumedSchedule = drSim.get_temperature_schedule(1000, [280, 290, 300, 310], completedSteps)
+        assert completedSteps + sum(nRungSteps for _, nRungSteps in resumedSchedule) == sum(nRungSteps for _, nRungSteps in fullSchedule)
+#####################################################################################
+def test_branches_share_the_system_threads(monkeypatch):
+    monkeypatch.delenv("OPENMM_CPU_THREADS", raising=False)
+    hardwareInfo = {"platform": "CPU", "subprocessCpus": 8, "parallelBranches": 3}
+    assert drSim.get_branch_threads(hardwareInfo) == 2
+    assert drSim.get_simulation_cpus(hardwareInfo) == 2
+    ## pinned systems set their thread count through the environment
+    monkeypatch.setenv("OPENMM_CPU_THREADS", "2")
+    assert drSim.get_branch_threads(hardwareInfo) == 1
+    assert drSim.get_branch_threads({**hardwareInfo, "parallelBranches": 1}) is None
+    assert drSim.get_simulation_cpus({**hardwareInfo, "parallelBranches": 1}) == 2
+    assert drSim.get_branch_threads({**hardwareInfo, "platform": "CUDA"}) is None
+#####################################################################################
+def test_branch_contexts_use_their_share_of_threads(monkeypatch):
+    monkeypatch.delenv("OPENMM_CPU_THREADS", raising=False)
+    system = openmm.System()
+    system.addParticle(1.0)
+    simulation = drSim.create_simulation(app.Topology(), system, openmm.VerletIntegrator(0.001),
+                                         {"platform": "CPU", "subprocessCpus": 4, "parallelBranches": 2})
+    assert simulation.context.getPlatform().getName() == "CPU"
+    assert simulation.context.getPlatform().getPropertyValue(simulation.context, "Threads") == "2"
+#####################################################################################
+def test_step_function_runs_in_chunks_and_stops_with_checkpoint(tmp_path, monkeypatch):
+    system = openmm.System()
+    system.addParticle(1.0)
+    integrator = openmm.VerletIntegrator(0.001)
+    simulation = app.Simulation(app.Topology(), system, integrator, openmm.Platform.getPlatformByName("Reference"))
+    simulation.context.setPositions([openmm.Vec3(0, 0, 0)])
+    config = {"hardwareInfo": {"platform": "Reference"}}
+    ## stands in for Metadynamics.step, which must be given the simulation to run
+    chunks = []
+    def step_function(currentSimulation, nSteps):
+        chunks.append(nSteps)
+        currentSimulation.step(nSteps)
+    drSim.run_steps(simulation, integrator, 35, {"logInterval": 10}, config, str(tmp_path), stepFunction=step_function)
+    assert chunks[0] == 10 and sum(chunks) == 35
+    assert simulation.currentStep == 35
+    ## a stop request is acted on before the next chunk
+    monkeypatch.setattr(drWallClock, "STOP_SIGNAL", signal.SIGTERM)
+    with pytest.raises(drWallClock.StopRequested):
+        drSim.run_steps(simulation, integrator, 35, {"logInterval": 10}, config, str(tmp_path), stepFunction=step_function)
+    assert sum(chunks) == 35
+    assert (tmp_path / "checkpoint.chk").is_file()
+#####################################################################################
+def test_step_threads_are_read_from_the_context(tmp_path, monkeypatch):
+    monkeypatch.delenv("OPENMM_CPU_THREADS", raising=False)
+    system = openmm.System()
+    system.addParticle(1.0)
+    integrator = openmm.VerletIntegrator(0.001)
+    hardwareInfo = {"platform": "CPU", "subprocessCpus": 4, "parallelBranches": 2}
+    simulation = drSim.create_simulation(app.Topology(), system, integrator, hardwareInfo)
+    simulation.context.setPositions([openmm.Vec3(0, 0, 0)])
+    drSim.run_steps(simulation, integrator, 10, {"logInterval": 10}, {"hardwareInfo": hardwareInfo}, str(tmp_path))
+    ## the branch's share of the threads, not subprocessCpus
+    assert drSim.pop_step_threads(str(tmp_path), hardwareInfo) == 2
+    ## nothing recorded, eg. a GPU step
+    assert drSim.pop_step_threads(str(tmp_path), {**hardwareInfo, "platform": "CUDA"}) == 1
+#####################################################################################
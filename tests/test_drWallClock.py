@@ -0,0 +1,111 @@
+## BASIC PYTHON LIBRARIES
+import os
+from os import path as p
+import sys
+import time
+import signal
+import subprocess
+import textwrap
+
+## drMD LIBRARIES
+from UtilitiesCloset import drWallClock
+
+SRC_DIR: str = p.join(p.dirname(p.dirname(p.abspath(__file__))), "src")
+## a batch of one system run through the real supervisor, the system runs a small OpenMM simulation until it is stopped
+SUPERVISED_BATCH: str = textwrap.dedent("""
+    import os
+    import sys
+    import queue
+    from os import path as p
+    sys.path.insert(0, sys.argv[1])
+    import openmm
+    from openmm import app, unit
+    import drMD
+    from Surgery import drSim
+    from UtilitiesCloset import drWallClock
+
+    outDir = sys.argv[2]
+    ## with more than one core, the queue is left open, as if prep was still working on the next system
+    parallelCpus = int(sys.argv[3])
+
+    def run_small_simulation(pdbFile, batchConfig, workerMode=False, preparedSystem=None):
+        simDir = p.join(outDir, "system", "01_NVT")
+        os.makedirs(simDir, exist_ok=True)
+        system = openmm.System()
+        nonbonded = openmm.NonbondedForce()
+        positions = []
+        for i in range(125):
+            system.addParticle(39.9)
+            nonbonded.addParticle(0.0, 0.34, 0.99)
+            positions.append(openmm.Vec3(i % 5, (i // 5) % 5, i // 25) * 0.4)
+        system.addForce(nonbonded)
+        integrator = openmm.LangevinMiddleIntegrator(120 * unit.kelvin, 1 / unit.picosecond, 0.002 * unit.picoseconds)
+        simulation = app.Simulation(app.Topology(), system, integrator, openmm.Platform.getPlatformByName("Reference"))
+        simulation.context.setPositions(positions * unit.nanometer)
+        open(p.join(outDir, "running"), "w").close()
+        drSim.run_steps(simulation, integrator, 10 ** 9, {"logInterval": 10}, batchConfig, simDir)
+        return None
+
+    drMD.process_pdb_file = run_small_simulation
+    batchConfig = {"pathInfo": {"outputDir": outDir},
+                   "hardwareInfo": {"parallelCPU": parallelCpus, "subprocessCpus": 1, "platform": "CPU",
+                                    "elasticThreads": False, "pinCpus": False},
+                   "miscInfo": {"workerCrashRetries": 2, "firstAidMaxRetries": 2}}
+    drWallClock.start_wall_clock()
+    drWallClock.install_stop_handlers()
+    pdbQueue = queue.Queue()
+    pdbQueue.put((p.join(outDir, "system.pdb"), None))
+    if parallelCpus == 1:
+        pdbQueue.put(None)
+    try:
+        drMD.run_simulation_workers(pdbQueue, [p.join(outDir, "system.pdb")], batchConfig, False)
+    except drWallClock.WallTimeExceeded:
+        sys.exit(drWallClock.RESUMABLE_EXIT_CODE)
+""")
+#####################################################################################
+def run_and_signal_group(tmp_path, stopSignal, parallelCpus=1):
+    ## a new session, so that the signal only reaches the batch and not the test runner
+    batch = subprocess.Popen([sys.executable, "-c", SUPERVISED_BATCH, SRC_DIR, str(tmp_path), str(parallelCpus)],
+                              start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    waitStart = time.time()
+    while not p.isfile(tmp_path / "running"):
+        assert batch.poll() is None, batch.stderr.read().decode()
+        assert time.time() - waitStart < 120
+        time.sleep(0.1)
+    time.sleep(1)
+    ## as sent by a scheduler to every process in the job, or by Ctrl-C to the foreground process group
+    os.killpg(batch.pid, stopSignal)
+    _, stderr = batch.communicate(timeout=120)
+    return batch.returncode, stderr.decode()
+#####################################################################################
+def test_sigterm_to_process_group_checkpoints(tmp_path):
+    returnCode, stderr = run_and_signal_group(tmp_path, signal.SIGTERM)
+    assert returnCode == drWallClock.RESUMABLE_EXIT_CODE, stderr
+    assert p.isfile(tmp_path / "system" / "01_NVT" / "checkpoint.chk")
+#####################################################################################
+def test_sigint_to_process_group_checkpoints(tmp_path):
+    returnCode, stderr = run_and_signal_group(tmp_path, signal.SIGINT)
+    assert returnCode == drWallClock.RESUMABLE_EXIT_CODE, stderr
+    assert p.isfile(tmp_path / "system" / "01_NVT" / "checkpoint.chk")
+#####################################################################################
+def test_stop_while_waiting_for_prep(tmp_path):
+    ## the supervisor must not block on the queue while the next system is being prepared
+    returnCode, stderr = run_and_signal_group(tmp_path, signal.SIGTERM, parallelCpus=2)
+    assert returnCode == drWallClock.RESUMABLE_EXIT_CODE, stderr
+    assert p.isfile(tmp_path / "system" / "01_NVT" / "checkpoint.chk")
+#####################################################################################
+def test_system_process_ignores_repeated_stop_signals(monkeypatch):
+    monkeypatch.setattr(drWallClock, "STOP_SIGNAL", None)
+    previousHandlers = {stopSignal: signal.getsignal(stopSignal) for stopSignal in [signal.SIGTERM, signal.SIGINT]}
+    try:
+        drWallClock.install_stop_handlers(forceStopOnRepeat=False)
+        os.kill(os.getpid(), signal.SIGINT)
+        os.kill(os.getpid(), signal.SIGTERM)
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert drWallClock.STOP_SIGNAL == signal.SIGINT
+        assert isinstance(drWallClock.make_stop_error("test"), drWallClock.StopRequested)
+    finally:
+        for stopSignal, handler in previousHandlers.items():
+            signal.signal(stopSignal, handler)
+        drWallClock.FORCE_STOP_ON_REPEAT = True
+#####################################################################################